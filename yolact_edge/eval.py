@@ -8,16 +8,25 @@ from yolact_edge.data import cfg, set_cfg, set_dataset
 from yolact_edge.yolact import Yolact
 from yolact_edge.utils.augmentations import BaseTransform, BaseTransformVideo, FastBaseTransform, Resize
 from yolact_edge.utils.functions import MovingAverage, ProgressBar
-from yolact_edge.layers.box_utils import jaccard, center_size, mask_iou
+from yolact_edge.layers import Detect
+from yolact_edge.layers.box_utils import jaccard, center_size
 from yolact_edge.utils import timer
 from yolact_edge.utils.functions import SavePath
 from yolact_edge.layers.output_utils import postprocess, undo_image_transformation
 from yolact_edge.utils.tensorrt import convert_to_tensorrt
+from yolact_edge.utils.pipeline import Pipeline, FrameGrabber
+from yolact_edge.utils.metrics import MetricsSink
+from yolact_edge.utils.keyframes import make_keyframe_scheduler
+from yolact_edge.utils.overlay import OverlayRenderer
+from yolact_edge.utils.packed_masks import PackedMasks, packed_mask_iou
+from yolact_edge.utils.detections_writer import DetectionsWriter, convert_to_json
+from yolact_edge.utils.raw_cache import RawOutputCache
 
 import pycocotools
 import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
+import torch.nn.functional as F
 from torch.autograd import Variable
 import argparse
 import time
@@ -35,9 +44,11 @@ import matplotlib.pyplot as plt
 import cv2
 import logging
 import math
+import glob
+import traceback
+import torch.multiprocessing as mp
 
-from multiprocessing.pool import ThreadPool
-from queue import Queue
+from queue import Empty
 
 ##############################################
 # Utility Functions and Argument Parsing
@@ -61,6 +72,12 @@ def parse_args(argv=None):
                         help='Use cuda to evaulate model')
     parser.add_argument('--fast_nms', default=True, type=str2bool,
                         help='Whether to use a faster, but not entirely correct version of NMS.')
+    parser.add_argument('--nms_thresh', default=None, type=float,
+                        help='Override the IoU threshold of NMS (0.5).')
+    parser.add_argument('--nms_conf_thresh', default=None, type=float,
+                        help='Override the score detections need to go into NMS (0.05).')
+    parser.add_argument('--max_num_detections', default=None, type=int,
+                        help='Override the max_num_detections of the config.')
     parser.add_argument('--display_masks', default=True, type=str2bool,
                         help='Whether or not to display masks over bounding boxes')
     parser.add_argument('--display_bboxes', default=True, type=str2bool,
@@ -69,6 +86,8 @@ def parse_args(argv=None):
                         help='Whether or not to display text (class [score])')
     parser.add_argument('--display_scores', default=True, type=str2bool,
                         help='Whether or not to display scores in addition to classes')
+    parser.add_argument('--display_scale', default=1.0, type=float,
+                        help='Draw the output at this fraction of the input resolution, which is faster.')
     parser.add_argument('--display', dest='display', action='store_true',
                         help='Display qualitative results instead of quantitative ones.')
     parser.add_argument('--shuffle', dest='shuffle', action='store_true',
@@ -81,12 +100,43 @@ def parse_args(argv=None):
                         help='Maximum number of images to consider. Use -1 for all.')
     parser.add_argument('--eval_stride', default=5, type=int,
                         help='The default frame eval stride.')
+    parser.add_argument('--eval_workers', default=2, type=int,
+                        help='Worker processes loading images and ground truth ahead of the network. 0 loads them on the main thread.')
+    parser.add_argument('--eval_prefetch', default=2, type=int,
+                        help='Images each of the --eval_workers loads in advance.')
+    parser.add_argument('--eval_shards', default=1, type=int,
+                        help='Split mAP evaluation into this many shards, each run by its own process with its own copy of the model.')
+    parser.add_argument('--shard', default=None, type=int,
+                        help='With --eval_shards, only run this shard (0-based) in this process, e.g. to spread the shards over machines.')
+    parser.add_argument('--shard_dir', default='results/shards/', type=str,
+                        help='Where shards checkpoint their ap_data. Rerunning the same command resumes from the checkpoints, '
+                             'which are only used by runs with the same weights, config and evaluation arguments.')
+    parser.add_argument('--checkpoint_every', default=100, type=int,
+                        help='Images between shard checkpoints.')
+    parser.add_argument('--merge_shards', default=False, dest='merge_shards', action='store_true',
+                        help='Only merge the checkpoints of the --eval_shards shards in --shard_dir and calculate mAP. '
+                             'Pass the same --trained_model, config and evaluation arguments the shards were run with.')
+    parser.add_argument('--raw_output_cache', default='results/raw_outputs/', type=str,
+                        help='Directory for the raw network outputs of --save_raw_outputs and --rescore.')
+    parser.add_argument('--save_raw_outputs', default=False, dest='save_raw_outputs', action='store_true',
+                        help='While evaluating the dataset, also save the network outputs that go into Detect and the ground truth to --raw_output_cache.')
+    parser.add_argument('--raw_cache_conf_floor', default=0.05, type=float,
+                        help='Only save the outputs of priors scoring above this. --rescore can then use any --nms_conf_thresh down to it.')
+    parser.add_argument('--raw_cache_half', default=False, dest='raw_cache_half', action='store_true',
+                        help='Save the mask prototypes as float16, which halves the cache but can change masks slightly.')
+    parser.add_argument('--rescore', default=False, dest='rescore', action='store_true',
+                        help='Calculate mAP from --raw_output_cache with the current NMS and postprocessing settings, without running the network.')
     parser.add_argument('--output_coco_json', dest='output_coco_json', action='store_true',
                         help='Dump detections into the coco json file.')
     parser.add_argument('--bbox_det_file', default='results/bbox_detections.json', type=str,
                         help='Output file for coco bbox results.')
     parser.add_argument('--mask_det_file', default='results/mask_detections.json', type=str,
                         help='Output file for coco mask results.')
+    parser.add_argument('--stream_detections', default=True, type=str2bool,
+                        help='With --output_coco_json, write results to .jsonl files as they come and convert them at the end, '
+                             'instead of keeping them all in memory.')
+    parser.add_argument('--det_workers', default=2, type=int,
+                        help='Processes RLE-encoding masks with --stream_detections. 0 encodes them on the main thread.')
     parser.add_argument('--config', default=None,
                         help='The config object to use.')
     parser.add_argument('--output_web_json', dest='output_web_json', action='store_true',
@@ -117,8 +167,31 @@ def parse_args(argv=None):
                         help='Input->output folder for images.')
     parser.add_argument('--video', default=None, type=str,
                         help='Path to a video or a digit for webcam index.')
+    parser.add_argument('--realtime', default=False, dest='realtime', action='store_true',
+                        help='For --video: always process the newest frame, one at a time, and drop the rest to bound latency.')
+    parser.add_argument('--target_latency', default=100, type=float,
+                        help='With --realtime, frames older than this (in ms) are dropped before processing.')
+    parser.add_argument('--videos', default=None, type=str,
+                        help='Headless batch mode: comma-separated videos or globs and an output folder, as "inputs:output".')
+    parser.add_argument('--video_workers', default=1, type=int,
+                        help='Number of worker processes for --videos, each with its own copy of the model.')
     parser.add_argument('--video_multiframe', default=1, type=int,
                         help='Number of frames to evaluate in parallel.')
+    parser.add_argument('--keyframe_scheduler', default='fixed', choices=['fixed', 'adaptive'], type=str,
+                        help='How video frames are picked to run the full backbone on: every --keyframe_interval frames (fixed), '
+                             'or when motion, a scene change or a drop in confidence calls for it (adaptive).')
+    parser.add_argument('--keyframe_interval', default=5, type=int,
+                        help='Frames between keyframes with --keyframe_scheduler=fixed.')
+    parser.add_argument('--keyframe_motion_threshold', default=0.03, type=float,
+                        help='Mean absolute difference of grayscale thumbnails (in [0, 1]) to the last keyframe that triggers a new one.')
+    parser.add_argument('--keyframe_scene_threshold', default=0.15, type=float,
+                        help='Thumbnail difference treated as a scene change, which triggers a keyframe right away.')
+    parser.add_argument('--keyframe_confidence_drop', default=0.25, type=float,
+                        help='Relative drop of the top detection scores since the keyframe that triggers a new one. 0 disables it.')
+    parser.add_argument('--keyframe_max_interval', default=15, type=int,
+                        help='Most frames between keyframes with --keyframe_scheduler=adaptive.')
+    parser.add_argument('--keyframe_log', default=None, type=str,
+                        help='If set, write every keyframe decision to this CSV file.')
     parser.add_argument('--score_threshold', default=0, type=float,
                         help='Threshold under which detections will be ignored.')
     parser.add_argument('--dataset', default=None, type=str,
@@ -143,13 +216,20 @@ def parse_args(argv=None):
                         help='Enable safe mode for TensorRT engine issues.')
 
     parser.set_defaults(no_bar=False, display=False, resume=False, output_coco_json=False, output_web_json=False,
-                        shuffle=False, benchmark=False, no_sort=False, mask_proto_debug=False, crop=True, detect=False)
+                        realtime=False, shuffle=False, benchmark=False, no_sort=False, mask_proto_debug=False, crop=True, detect=False)
 
     global args
     args = parser.parse_args(argv)
 
     if args.output_web_json:
         args.output_coco_json = True
+
+    if args.eval_shards > 1 and (args.display or args.benchmark or args.output_coco_json):
+        parser.error('--eval_shards only works when calculating mAP.')
+    if args.shard is not None and not 0 <= args.shard < args.eval_shards:
+        parser.error('--shard must be in [0, --eval_shards).')
+    if args.save_raw_outputs and args.eval_shards > 1:
+        parser.error('--save_raw_outputs does not work with --eval_shards.')
     
     if args.seed is not None:
         random.seed(args.seed)
@@ -157,7 +237,7 @@ def parse_args(argv=None):
 iou_thresholds = [x / 100 for x in range(50, 100, 5)]
 coco_cats = {} # Inverted category lookup
 coco_cats_inv = {}
-color_cache = defaultdict(lambda: {})
+renderer = OverlayRenderer()
 
 def prep_coco_cats():
     for coco_cat_id, transformed_cat_id_p1 in get_label_map().items():
@@ -176,12 +256,18 @@ def get_transformed_cat(coco_cat_id):
 ##############################################
 
 def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, mask_alpha=0.45):
+    # Drawing at a reduced resolution saves making the masks at full size in the first place
+    scale = args.display_scale
     if undo_transform:
+        h, w = (h, w) if scale == 1 else (max(1, round(h * scale)), max(1, round(w * scale)))
         img_numpy = undo_image_transformation(img, w, h)
         img_gpu = torch.Tensor(img_numpy).cuda()
     else:
-        img_gpu = img / 255.0
         h, w, _ = img.shape
+        if scale != 1:
+            h, w = max(1, round(h * scale)), max(1, round(w * scale))
+            img = F.interpolate(img.permute(2, 0, 1)[None].float(), size=(h, w), mode='area')[0].permute(1, 2, 0)
+        img_gpu = img / 255.0
     with timer.env('Postprocess'):
         t = postprocess(dets_out, w, h, visualize_lincomb=args.display_lincomb,
                         crop_masks=args.crop, score_threshold=args.score_threshold)
@@ -197,50 +283,18 @@ def prep_display(dets_out, img, h, w, undo_transform=True, class_color=False, ma
             break
     if num_dets_to_consider == 0:
         return (img_gpu * 255).byte().cpu().numpy()
-    def get_color(j, on_gpu=None):
-        global color_cache
-        color_idx = (classes[j] * 5 if class_color else j * 5) % len(COLORS)
-        if on_gpu is not None and color_idx in color_cache[on_gpu]:
-            return color_cache[on_gpu][color_idx]
-        else:
-            color = COLORS[color_idx]
-            if not undo_transform:
-                color = (color[2], color[1], color[0])
-            if on_gpu is not None:
-                color = torch.Tensor(color).to(on_gpu).float() / 255.
-                color_cache[on_gpu][color_idx] = color
-            return color
+    # The image might come in as RGB or BGR, depending
+    bgr = not undo_transform
+    color_idx = renderer.color_indices(classes[:num_dets_to_consider], class_color)
     if args.display_masks and cfg.eval_mask_branch:
-        masks = masks[:num_dets_to_consider, :, :, None]
-        colors = torch.cat([get_color(j, on_gpu=img_gpu.device.index).view(1,1,1,3)
-                            for j in range(num_dets_to_consider)], dim=0)
-        masks_color = masks.repeat(1,1,1,3) * colors * mask_alpha
-        inv_alph_masks = masks * (-mask_alpha) + 1
-        masks_color_summand = masks_color[0]
-        if num_dets_to_consider > 1:
-            inv_alph_cumul = inv_alph_masks[:(num_dets_to_consider-1)].cumprod(dim=0)
-            masks_color_cumul = masks_color[1:] * inv_alph_cumul
-            masks_color_summand += masks_color_cumul.sum(dim=0)
-        img_gpu = img_gpu * inv_alph_masks.prod(dim=0) + masks_color_summand
+        img_gpu = renderer.draw_masks(img_gpu, masks, color_idx, bgr, mask_alpha)
     img_numpy = (img_gpu * 255).byte().cpu().numpy()
     if args.display_text or args.display_bboxes:
-        for j in reversed(range(num_dets_to_consider)):
-            x1, y1, x2, y2 = boxes[j, :]
-            color = get_color(j)
-            score = scores[j]
-            if args.display_bboxes:
-                cv2.rectangle(img_numpy, (x1, y1), (x2, y2), color, 1)
-            if args.display_text:
-                _class = cfg.dataset.class_names[classes[j]]
-                text_str = '%s: %.2f' % (_class, score) if args.display_scores else _class
-                font_face = cv2.FONT_HERSHEY_DUPLEX
-                font_scale = 0.6
-                font_thickness = 1
-                text_w, text_h = cv2.getTextSize(text_str, font_face, font_scale, font_thickness)[0]
-                text_pt = (x1, y1 - 3)
-                text_color = [255, 255, 255]
-                cv2.rectangle(img_numpy, (x1, y1), (x1 + text_w, y1 - text_h - 4), color, -1)
-                cv2.putText(img_numpy, text_str, text_pt, font_face, font_scale, text_color, font_thickness, cv2.LINE_AA)
+        texts = None
+        if args.display_text:
+            names = [cfg.dataset.class_names[classes[j]] for j in range(num_dets_to_consider)]
+            texts = ['%s: %.2f' % (name, score) for name, score in zip(names, scores)] if args.display_scores else names
+        renderer.draw_boxes(img_numpy, boxes, color_idx, bgr, texts=texts, draw_boxes=args.display_bboxes)
     return img_numpy
 
 def prep_benchmark(dets_out, h, w):
@@ -259,16 +313,36 @@ class Detections:
     def __init__(self):
         self.bbox_data = []
         self.mask_data = []
+        self.writer = None
+        if args.output_coco_json and args.stream_detections and not args.output_web_json:
+            # Written out as they come, to .jsonl files next to the final ones
+            self.writer = DetectionsWriter(self.lines_path(args.bbox_det_file), self.lines_path(args.mask_det_file),
+                                           num_workers=args.det_workers)
+    @staticmethod
+    def lines_path(path:str) -> str:
+        return os.path.splitext(path)[0] + '.jsonl'
     def add_bbox(self, image_id:int, category_id:int, bbox:list, score:float):
         bbox = [bbox[0], bbox[1], bbox[2]-bbox[0], bbox[3]-bbox[1]]
         bbox = [round(float(x)*10)/10 for x in bbox]
-        self.bbox_data.append({
+        result = {
             'image_id': int(image_id),
             'category_id': get_coco_cat(int(category_id)),
             'bbox': bbox,
             'score': float(score)
-        })
+        }
+        if self.writer is not None:
+            self.writer.add_bbox(result)
+        else:
+            self.bbox_data.append(result)
     def add_mask(self, image_id:int, category_id:int, segmentation:np.ndarray, score:float):
+        if self.writer is not None:
+            self.writer.add_mask({
+                'image_id': int(image_id),
+                'category_id': get_coco_cat(int(category_id)),
+                'segmentation': None,
+                'score': float(score)
+            }, segmentation)
+            return
         rle = pycocotools.mask.encode(np.asfortranarray(segmentation.astype(np.uint8)))
         rle['counts'] = rle['counts'].decode('ascii')
         self.mask_data.append({
@@ -278,6 +352,11 @@ class Detections:
             'score': float(score)
         })
     def dump(self):
+        if self.writer is not None:
+            self.writer.close()
+            for path in (args.bbox_det_file, args.mask_det_file):
+                convert_to_json(self.lines_path(path), path)
+            return
         dump_arguments = [
             (self.bbox_data, args.bbox_det_file),
             (self.mask_data, args.mask_det_file)
@@ -312,7 +391,7 @@ class Detections:
 
 def _mask_iou(mask1, mask2, iscrowd=False):
     with timer.env('Mask IoU'):
-        ret = mask_iou(mask1, mask2, iscrowd)
+        ret = packed_mask_iou(mask1, mask2, iscrowd)
     return ret.cpu()
 
 def _bbox_iou(bbox1, bbox2, iscrowd=False):
@@ -328,13 +407,15 @@ def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, de
             gt_boxes[:, [0, 2]] *= w
             gt_boxes[:, [1, 3]] *= h
             gt_classes = list(gt[:, 4].astype(int))
-            gt_masks = torch.Tensor(gt_masks).view(-1, h*w)
+            gt_masks = np.asarray(gt_masks).reshape(-1, h, w)
 
             if num_crowd > 0:
                 split = lambda x: (x[-num_crowd:], x[:-num_crowd])
                 crowd_boxes  , gt_boxes   = split(gt_boxes)
                 crowd_masks  , gt_masks   = split(gt_masks)
                 crowd_classes, gt_classes = split(gt_classes)
+                crowd_masks = PackedMasks(crowd_masks)
+            gt_masks = PackedMasks(gt_masks)
 
     with timer.env('Postprocess'):
         classes, scores, boxes, masks = postprocess(dets, w, h, crop_masks=args.crop, score_threshold=args.score_threshold)
@@ -350,7 +431,7 @@ def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, de
             scores = list(scores.cpu().numpy().astype(float))
             box_scores = scores
             mask_scores = scores
-        masks = masks.view(-1, h*w).cuda()
+        masks = masks.view(-1, h, w)
         boxes = boxes.cuda()
 
 
@@ -366,106 +447,161 @@ def prep_metrics(ap_data, dets, img, gt, gt_masks, h, w, num_crowd, image_id, de
             return
     
     with timer.env('Eval Setup'):
-        num_pred = len(classes)
-        num_gt   = len(gt_classes)
-
+        # Bit-packed to their extents, so IoUs only look at where masks can overlap
+        masks = PackedMasks(masks)
         mask_iou_cache = _mask_iou(masks, gt_masks)
         bbox_iou_cache = _bbox_iou(boxes.float(), gt_boxes.float())
 
         if num_crowd > 0:
             crowd_mask_iou_cache = _mask_iou(masks, crowd_masks, iscrowd=True)
             crowd_bbox_iou_cache = _bbox_iou(boxes.float(), crowd_boxes.float(), iscrowd=True)
+            crowd_ious = np.stack([crowd_bbox_iou_cache.numpy(), crowd_mask_iou_cache.numpy()])
+            crowd_classes = np.array(crowd_classes, dtype=int)
         else:
-            crowd_mask_iou_cache = None
-            crowd_bbox_iou_cache = None
-
-        box_indices = sorted(range(num_pred), key=lambda i: -box_scores[i])
-        mask_indices = sorted(box_indices, key=lambda i: -mask_scores[i])
-
-        iou_types = [
-            ('box',  lambda i,j: bbox_iou_cache[i, j].item(),
-                     lambda i,j: crowd_bbox_iou_cache[i,j].item(),
-                     lambda i: box_scores[i], box_indices),
-            ('mask', lambda i,j: mask_iou_cache[i, j].item(),
-                     lambda i,j: crowd_mask_iou_cache[i,j].item(),
-                     lambda i: mask_scores[i], mask_indices)
-        ]
-
-    timer.start('Main loop')
-    for _class in set(classes + gt_classes):
-        ap_per_iou = []
-        num_gt_for_class = sum([1 for x in gt_classes if x == _class])
-        
-        for iouIdx in range(len(iou_thresholds)):
-            iou_threshold = iou_thresholds[iouIdx]
-
-            for iou_type, iou_func, crowd_func, score_func, indices in iou_types:
-                gt_used = [False] * len(gt_classes)
-                
-                ap_obj = ap_data[iou_type][iouIdx][_class]
-                ap_obj.add_gt_positives(num_gt_for_class)
-
-                for i in indices:
-                    if classes[i] != _class:
+            crowd_ious = None
+            crowd_classes = None
+
+        classes = np.array(classes, dtype=int)
+        gt_classes = np.array(gt_classes, dtype=int)
+        box_scores = np.array(box_scores, dtype=np.float64)
+        mask_scores = np.array(mask_scores, dtype=np.float64)
+
+        # Descending by score, with ties in detection order (for masks, in box order)
+        box_indices = np.argsort(-box_scores, kind='stable')
+        mask_indices = box_indices[np.argsort(-mask_scores[box_indices], kind='stable')]
+        orders = np.stack([box_indices, mask_indices])
+        ious = np.stack([bbox_iou_cache.numpy(), mask_iou_cache.numpy()])
+
+    with timer.env('Main loop'):
+        status = match_detections(ious, orders, classes, gt_classes, crowd_ious, crowd_classes)
+
+        # Without crowds nothing is ignored, so there's nothing to filter out
+        any_ignored = bool((status < 0).any())
+
+        for type_idx, (iou_type, type_scores) in enumerate((('box', box_scores), ('mask', mask_scores))):
+            order = orders[type_idx]
+            sorted_classes = classes[order]
+            sorted_scores = type_scores[order]
+
+            for _class in set(classes.tolist()) | set(gt_classes.tolist()):
+                num_gt_for_class = int((gt_classes == _class).sum())
+                of_class = np.nonzero(sorted_classes == _class)[0]
+                class_scores = sorted_scores[of_class]
+                class_status = status[type_idx][:, of_class]
+
+                for iouIdx in range(len(iou_thresholds)):
+                    ap_obj = ap_data[iou_type][iouIdx][_class]
+                    ap_obj.add_gt_positives(num_gt_for_class)
+
+                    if len(of_class) == 0:
                         continue
-                    
-                    max_iou_found = iou_threshold
-                    max_match_idx = -1
-                    for j in range(num_gt):
-                        if gt_used[j] or gt_classes[j] != _class:
-                            continue
-                            
-                        iou = iou_func(i, j)
-
-                        if iou > max_iou_found:
-                            max_iou_found = iou
-                            max_match_idx = j
-                    
-                    if max_match_idx >= 0:
-                        gt_used[max_match_idx] = True
-                        ap_obj.push(score_func(i), True)
+                    if any_ignored:
+                        # Detections that only match a crowd are ignored
+                        keep = class_status[iouIdx] >= 0
+                        ap_obj.push_many(class_scores[keep], class_status[iouIdx, keep] == 1)
                     else:
-                        # If the detection matches a crowd, we can just ignore it
-                        matched_crowd = False
+                        ap_obj.push_many(class_scores, class_status[iouIdx] == 1)
 
-                        if num_crowd > 0:
-                            for j in range(len(crowd_classes)):
-                                if crowd_classes[j] != _class:
-                                    continue
-                                
-                                iou = crowd_func(i, j)
+def match_detections(ious, orders, classes, gt_classes, crowd_ious=None, crowd_classes=None):
+    """
+    Greedily matches detections to ground truth the way COCOEval does, for all IoU thresholds and
+    both IoU types at once: going down the detections in order, each one takes the unmatched gt of
+    its class with the highest IoU over the threshold (the first one if there's a tie).
+
+    ious is [2, num_dets, num_gt] (box and mask IoUs), orders is [2, num_dets] with the detection
+    order for each IoU type, and the crowd arguments are like ious and gt_classes but for crowd
+    annotations. Returns an int8 array of size [2, len(iou_thresholds), num_dets] indexed by the
+    position in the order, with 1 for true positives, 0 for false positives and -1 for detections
+    that match no gt but do match a crowd of their class, which COCOEval ignores.
+    """
+    # float64 like the Python floats this used to compare, so IoUs right at a threshold fall the same way
+    thresholds = np.array(iou_thresholds, dtype=np.float64)
+    type_idx = np.arange(2)[:, None]
+    sorted_classes = classes[orders]
+
+    # Rows in order, and -1 (which never matches) wherever the classes differ
+    ious = ious.astype(np.float64)[type_idx, orders]
+    ious[sorted_classes[:, :, None] != gt_classes[None, None, :]] = -1
+
+    num_dets, num_gt = ious.shape[1], ious.shape[2]
+    status = np.zeros((2, len(thresholds), num_dets), dtype=np.int8)
+
+    if num_gt > 0:
+        used = np.zeros((2, len(thresholds), num_gt), dtype=bool)
+        gt_idx = np.arange(num_gt)
+
+        for k in range(num_dets):
+            if (ious[:, k] < 0).all():
+                continue  # No gt of this class
+
+            candidates = np.where(used, -1, ious[:, None, k, :])
+            best = candidates.argmax(axis=-1)
+            matched = candidates.max(axis=-1) > thresholds
 
-                                if iou > iou_threshold:
-                                    matched_crowd = True
-                                    break
+            status[:, :, k] = matched
+            used |= matched[..., None] & (gt_idx == best[..., None])
 
-                        # All this crowd code so that we can make sure that our eval code gives the
-                        # same result as COCOEval. There aren't even that many crowd annotations to
-                        # begin with, but accuracy is of the utmost importance.
-                        if not matched_crowd:
-                            ap_obj.push(score_func(i), False)
-    timer.stop('Main loop')
+    if crowd_ious is not None and crowd_ious.shape[2] > 0:
+        crowd_ious = crowd_ious.astype(np.float64)[type_idx, orders]
+        crowd_ious[sorted_classes[:, :, None] != crowd_classes[None, None, :]] = -1
+        crowd_max = crowd_ious.max(axis=-1)
+
+        status[(status == 0) & (crowd_max[:, None, :] > thresholds[None, :, None])] = -1
+
+    return status
 
 
 class APDataObject:
     """
     Stores all the information necessary to calculate the AP for one IoU and one class.
     Note: I type annotated this because why not.
+
+    The (score, is_true) pairs are kept in two numpy arrays that grow by doubling, so pushing
+    stays cheap and get_ap can work on whole arrays. Objects filled on different shards of a
+    dataset can be combined with merge (see also merge_ap_data).
     """
 
-    def __init__(self):
-        self.data_points = []
+    def __init__(self, capacity:int=16):
+        self.scores = np.zeros(capacity, dtype=np.float64)
+        self.is_true = np.zeros(capacity, dtype=bool)
+        self.num_points = 0
         self.num_gt_positives = 0
 
+    def _reserve(self, extra:int):
+        needed = self.num_points + extra
+        if needed > len(self.scores):
+            capacity = max(needed, 2 * len(self.scores))
+            scores = np.zeros(capacity, dtype=np.float64)
+            is_true = np.zeros(capacity, dtype=bool)
+            scores[:self.num_points] = self.scores[:self.num_points]
+            is_true[:self.num_points] = self.is_true[:self.num_points]
+            self.scores, self.is_true = scores, is_true
+
     def push(self, score:float, is_true:bool):
-        self.data_points.append((score, is_true))
-    
+        self._reserve(1)
+        self.scores[self.num_points] = score
+        self.is_true[self.num_points] = is_true
+        self.num_points += 1
+
+    def push_many(self, scores:np.ndarray, is_true:np.ndarray):
+        """ push() for arrays of scores and whether each is a true positive. """
+        n = len(scores)
+        self._reserve(n)
+        self.scores[self.num_points:self.num_points + n] = scores
+        self.is_true[self.num_points:self.num_points + n] = is_true
+        self.num_points += n
+
     def add_gt_positives(self, num_positives:int):
         """ Call this once per image. """
         self.num_gt_positives += num_positives
 
+    def merge(self, other:'APDataObject'):
+        """ Adds the data points and gt positives of other, e.g. from another shard of the dataset. """
+        self.push_many(other.scores[:other.num_points], other.is_true[:other.num_points])
+        self.num_gt_positives += other.num_gt_positives
+
     def is_empty(self) -> bool:
-        return len(self.data_points) == 0 and self.num_gt_positives == 0
+        return self.num_points == 0 and self.num_gt_positives == 0
 
     def get_ap(self) -> float:
         """ Warning: result not cached. """
@@ -473,49 +609,60 @@ class APDataObject:
         if self.num_gt_positives == 0:
             return 0
 
-        # Sort descending by score
-        self.data_points.sort(key=lambda x: -x[0])
-
-        precisions = []
-        recalls    = []
-        num_true  = 0
-        num_false = 0
+        # Sort descending by score, keeping the push order for equal scores
+        order = np.argsort(-self.scores[:self.num_points], kind='stable')
+        is_true = self.is_true[:self.num_points][order]
 
         # Compute the precision-recall curve. The x axis is recalls and the y axis precisions.
-        for datum in self.data_points:
-            # datum[1] is whether the detection a true or false positive
-            if datum[1]: num_true += 1
-            else: num_false += 1
-            
-            precision = num_true / (num_true + num_false)
-            recall    = num_true / self.num_gt_positives
-
-            precisions.append(precision)
-            recalls.append(recall)
+        num_true = np.cumsum(is_true)
+        precisions = num_true / np.arange(1, len(is_true) + 1)
+        recalls = num_true / self.num_gt_positives
 
         # Smooth the curve by computing [max(precisions[i:]) for i in range(len(precisions))]
-        # Basically, remove any temporary dips from the curve.
-        # At least that's what I think, idk. COCOEval did it so I do too.
-        for i in range(len(precisions)-1, 0, -1):
-            if precisions[i] > precisions[i-1]:
-                precisions[i-1] = precisions[i]
-
-        # Compute the integral of precision(recall) d_recall from recall=0->1 using fixed-length riemann summation with 101 bars.
-        y_range = [0] * 101 # idx 0 is recall == 0.0 and idx 100 is recall == 1.00
-        x_range = np.array([x / 100 for x in range(101)])
-        recalls = np.array(recalls)
+        # Basically, remove any temporary dips from the curve. COCOEval does it too.
+        precisions = np.maximum.accumulate(precisions[::-1])[::-1]
 
-        # I realize this is weird, but all it does is find the nearest precision(x) for a given x in x_range.
-        # Basically, if the closest recall we have to 0.01 is 0.009 this sets precision(0.01) = precision(0.009).
-        # I approximate the integral this way, because that's how COCOEval does it.
+        # Sample precision(recall) at 101 recalls, taking the precision at the nearest recall
+        # we have at or above each one (0 if there's none), because that's how COCOEval does it.
+        x_range = np.array([x / 100 for x in range(101)])
         indices = np.searchsorted(recalls, x_range, side='left')
-        for bar_idx, precision_idx in enumerate(indices):
-            if precision_idx < len(precisions):
-                y_range[bar_idx] = precisions[precision_idx]
+        y_range = np.zeros(len(x_range))
+        valid = indices < len(precisions)
+        y_range[valid] = precisions[indices[valid]]
 
-        # Finally compute the riemann sum to get our integral.
+        # Finally compute the riemann sum to get our integral, adding up in order like before.
         # avg([precision(x) for x in 0:0.01:1])
-        return sum(y_range) / len(y_range)
+        return sum(y_range.tolist()) / len(y_range)
+
+    def __getstate__(self):
+        # Leave the unused capacity out of pickles
+        state = self.__dict__.copy()
+        state['scores'] = self.scores[:self.num_points].copy()
+        state['is_true'] = self.is_true[:self.num_points].copy()
+        return state
+
+    def __setstate__(self, state):
+        if 'data_points' in state:
+            # An ap_data file from before these were arrays
+            data_points = state.pop('data_points')
+            state['scores'] = np.array([score for score, _ in data_points], dtype=np.float64)
+            state['is_true'] = np.array([is_true for _, is_true in data_points], dtype=bool)
+            state['num_points'] = len(data_points)
+        self.__dict__.update(state)
+
+def new_ap_data():
+    return {
+        'box' : [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds],
+        'mask': [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds]
+    }
+
+def merge_ap_data(ap_data, other):
+    """ Merges the ap_data of another shard into ap_data, in place, and returns ap_data. """
+    for iou_type in ('box', 'mask'):
+        for iou_idx in range(len(iou_thresholds)):
+            for ap_obj, other_obj in zip(ap_data[iou_type][iou_idx], other[iou_type][iou_idx]):
+                ap_obj.merge(other_obj)
+    return ap_data
 
 ##############################################
 # Evaluation Functions (Image, Video, etc.)
@@ -579,23 +726,19 @@ def evalvideo(net:Yolact, path:str):
         exit(-1)
     net = CustomDataParallel(net).cuda()
     transform = torch.nn.DataParallel(FastBaseTransform()).cuda()
-    frame_times = MovingAverage(400)
-    fps = 0
-    frame_time_target = 1 / vid.get(cv2.CAP_PROP_FPS)
-    running = True
+    video_fps = vid.get(cv2.CAP_PROP_FPS)
+    frame_time_target = 1 / video_fps if video_fps > 0 else 0
     frame_idx = 0
-    every_k_frames = 5
+    keyframes = make_keyframe_scheduler(args)
     moving_statistics = {"conf_hist": []}
+    # Read these back with np.fromfile(path, dtype='<f8')
+    inference_times = MetricsSink(args.video + '.inference_times.f64')
 
-    def cleanup_and_exit():
-        print()
-        pool.terminate()
-        vid.release()
-        cv2.destroyAllWindows()
-        exit()
-
-    def get_next_frame(vid):
-        return [vid.read()[1] for _ in range(args.video_multiframe)]
+    def get_next_frame():
+        frames = [vid.read()[1] for _ in range(args.video_multiframe)]
+        frames = [frame for frame in frames if frame is not None]
+        # None ends the stream
+        return frames if len(frames) > 0 else None
 
     def transform_frame(frames):
         with torch.no_grad():
@@ -604,9 +747,10 @@ def evalvideo(net:Yolact, path:str):
 
     def eval_network(inp):
         nonlocal frame_idx
+        start_time = time.time()
         with torch.no_grad():
             frames, imgs = inp
-            if frame_idx % every_k_frames == 0 or cfg.flow.warp_mode == 'none':
+            if keyframes.decide(frame_idx, frames) or cfg.flow.warp_mode == 'none':
                 extras = {"backbone": "full", "interrupt": False, "keep_statistics": True,
                           "moving_statistics": moving_statistics}
                 net_outs = net(imgs, extras=extras)
@@ -616,94 +760,191 @@ def evalvideo(net:Yolact, path:str):
                 extras = {"backbone": "partial", "interrupt": False, "keep_statistics": False,
                           "moving_statistics": moving_statistics}
                 net_outs = net(imgs, extras=extras)
+            keyframes.observe(net_outs["pred_outs"])
             frame_idx += 1
-            return frames, net_outs["pred_outs"]
+        inference_times.record(time.time() - start_time)
+        return frames, net_outs["pred_outs"]
+
+    extract_frame = lambda x, i: (x[0][i] if x[1][i] is None else x[0][i].to(x[1][i]['box'].device), [x[1][i]])
+
+    def split_frames(inp):
+        return [extract_frame(inp, i) for i in range(len(inp[0]))]
 
     def prep_frame(inp):
         with torch.no_grad():
             frame, preds = inp
             return prep_display(preds, frame, None, None, undo_transform=False, class_color=True)
 
-    frame_buffer = Queue()
-    video_fps = 0
-
-    # The function to play video frames
-    def play_video():
-        nonlocal frame_buffer, running, video_fps, is_webcam
-        video_frame_times = MovingAverage(100)
-        frame_time_stabilizer = frame_time_target
-        last_time = None
-        stabilizer_step = 0.0005
-        while running:
-            frame_time_start = time.time()
-            if not frame_buffer.empty():
-                next_time = time.time()
-                if last_time is not None:
-                    video_frame_times.add(next_time - last_time)
-                    video_fps = 1 / video_frame_times.get_avg()
-                cv2.imshow(path, frame_buffer.get())
-                last_time = next_time
+    print('Initializing model... ', end='')
+    eval_network(transform_frame(get_next_frame()))
+    print('Done.')
+
+    # Every stage gets its own thread, and the bounded queues between them hold the faster stages
+    # back so that frames move at the pace of the slowest one.
+    pipeline = Pipeline(queue_size=max(2, 2 * args.video_multiframe))
+    pipeline.add_source('read', get_next_frame)
+    pipeline.add_stage('transform', transform_frame)
+    pipeline.add_stage('network', lambda inp: split_frames(eval_network(inp)), expand=True)
+    pipeline.add_stage('prep', prep_frame)
+    pipeline.start()
+
+    video_frame_times = MovingAverage(100)
+    playback_fps = 0
+    last_time = None
+
+    print()
+    try:
+        while True:
             if cv2.waitKey(1) == 27:  # Press Escape to exit
-                running = False
-            buffer_size = frame_buffer.qsize()
-            if buffer_size < args.video_multiframe:
-                frame_time_stabilizer += stabilizer_step
-            elif buffer_size > args.video_multiframe:
-                frame_time_stabilizer -= stabilizer_step
-                if frame_time_stabilizer < 0:
-                    frame_time_stabilizer = 0
-            new_target = frame_time_stabilizer if is_webcam else max(frame_time_stabilizer, frame_time_target)
-            next_frame_target = max(2 * new_target - video_frame_times.get_avg(), 0)
-            target_time = frame_time_start + next_frame_target - 0.001
-            while time.time() < target_time:
-                time.sleep(0.001)
+                break
+
+            try:
+                frame = pipeline.get(timeout=0.01)
+            except Empty:
+                continue
+            if frame is None:
+                break
+
+            # Don't play a video file back faster than it was recorded
+            if not is_webcam and last_time is not None:
+                delay = last_time + frame_time_target - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            cv2.imshow(path, frame)
+
+            next_time = time.time()
+            if last_time is not None:
+                video_frame_times.add(next_time - last_time)
+                playback_fps = 1 / video_frame_times.get_avg()
+            last_time = next_time
+
+            stats = pipeline.get_stats()
+            fps = args.video_multiframe / max(stats['network']['latency_ms'] / 1000, 1e-9)
+            print('\rProcessing FPS: %.2f | Video Playback FPS: %.2f | Frames in Buffer: %d | %s    ' %
+                  (fps, playback_fps, pipeline.buffered(),
+                   ' '.join('%s %.1fms/%d' % (name, stage['latency_ms'], round(stage['queue'])) for name, stage in stats.items())),
+                  end='')
+    except KeyboardInterrupt:
+        pass
 
-    extract_frame = lambda x, i: (x[0][i] if x[1][i] is None else x[0][i].to(x[1][i]['box'].device), [x[1][i]])
+    pipeline.stop()
+    print()
+    print()
+    print(pipeline.format_stats())
 
-    print('Initializing model... ', end='')
-    eval_network(transform_frame(get_next_frame(vid)))
-    print('Done.')
-    
-    # Sequence of functions to process a frame
-    sequence = [prep_frame, eval_network, transform_frame]
-    n_threads = 4  # You can adjust this as needed
-    pool = ThreadPool(processes=n_threads)
-    print("Number of threads: {}".format(n_threads))
-    pool.apply_async(play_video)
+    summary = inference_times.close()
+    if summary['count'] > 0:
+        print()
+        print('Inference time over %d batches (ms): mean %.2f | p50 %.2f | p90 %.2f | p99 %.2f | max %.2f' % (
+            summary['count'], 1000 * summary['mean'], 1000 * summary['p50'], 1000 * summary['p90'],
+            1000 * summary['p99'], 1000 * summary['max']))
+        print('Saved to %s' % inference_times.path)
+    print(keyframes.format_summary())
+    keyframes.close()
+    vid.release()
+    cv2.destroyAllWindows()
+    exit()
+
+def evalvideo_realtime(net:Yolact, path:str):
+    """
+    Latency-bounded version of evalvideo. A FrameGrabber thread keeps only the newest frame from
+    the camera, and frames are taken, run and shown one at a time, so nothing queues up when the
+    network is slower than the camera. A frame that is older than --target_latency by the time it
+    is taken is dropped as stale, and the end-to-end latency (capture to display) of the frames
+    that are shown is recorded. Keyframes are scheduled on the index every frame has in the
+    stream, so the frames skipped in between count towards the next keyframe.
+    """
+    is_webcam = path.isdigit()
+    vid = cv2.VideoCapture(int(path)) if is_webcam else cv2.VideoCapture(path)
+    if not vid.isOpened():
+        print('Could not open video "%s"' % path)
+        exit(-1)
+    # Don't let the driver queue up frames behind our back
+    vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+    net = CustomDataParallel(net).cuda()
+    transform = torch.nn.DataParallel(FastBaseTransform()).cuda()
+    target_latency = args.target_latency / 1000
+    keyframes = make_keyframe_scheduler(args)
+    moving_statistics = {"conf_hist": []}
+    # Read these back with np.fromfile(path, dtype='<f8')
+    latencies = MetricsSink(args.video + '.latency.f64')
+
+    def eval_frame(frame_idx, frame):
+        with torch.no_grad():
+            frame = torch.from_numpy(frame).cuda().float()
+            imgs = transform(frame.unsqueeze(0))
+            if keyframes.decide(frame_idx, [frame]) or cfg.flow.warp_mode == 'none':
+                extras = {"backbone": "full", "interrupt": False, "keep_statistics": True,
+                          "moving_statistics": moving_statistics}
+                net_outs = net(imgs, extras=extras)
+                moving_statistics["feats"] = net_outs["feats"]
+                moving_statistics["lateral"] = net_outs["lateral"]
+            else:
+                extras = {"backbone": "partial", "interrupt": False, "keep_statistics": False,
+                          "moving_statistics": moving_statistics}
+                net_outs = net(imgs, extras=extras)
+            preds = net_outs["pred_outs"]
+            keyframes.observe(preds)
+            return prep_display(preds, frame, None, None, undo_transform=False, class_color=True)
 
-    active_frames = []
-    inference_times = []
-    MAX_BUFFER_SIZE = 10  # Maximum allowed frames in the buffer
+    grabber = FrameGrabber(vid, fps=None if is_webcam else vid.get(cv2.CAP_PROP_FPS))
+    grabber.start()
+
+    shown = 0
+    stale = 0
+    late = 0
+    latency_avg = MovingAverage(100)
 
     print()
-    while vid.isOpened() and running:
-        start_time = time.time()
-        # NEW CODE: Wait if frame_buffer size is too high
-        while frame_buffer.qsize() > MAX_BUFFER_SIZE:
-            time.sleep(0.01)
-
-        next_frames = pool.apply_async(get_next_frame, args=(vid,))
-        for frame in active_frames:
-            frame['value'] = pool.apply_async(sequence[frame['idx']], args=(frame['value'],))
-        for frame in active_frames:
-            if frame['idx'] == 0:
-                frame_buffer.put(frame['value'].get())
-        active_frames = [x for x in active_frames if x['idx'] > 0]
-        for frame in list(reversed(active_frames)):
-            frame['value'] = frame['value'].get()
-            frame['idx'] -= 1
-            if frame['idx'] == 0:
-                active_frames += [{'value': extract_frame(frame['value'], i), 'idx': 0} for i in range(1, args.video_multiframe)]
-                frame['value'] = extract_frame(frame['value'], 0)
-        active_frames.append({'value': next_frames.get(), 'idx': len(sequence) - 1})
-        inference_time = time.time() - start_time
-        frame_times.add(inference_time)
-        inference_times.append(inference_time)
-        fps = args.video_multiframe / frame_times.get_avg()
-        np.save(args.video, np.asarray(inference_times))
-        print('\rProcessing FPS: %.2f | Video Playback FPS: %.2f | Frames in Buffer: %d    ' %
-              (fps, video_fps, frame_buffer.qsize()), end='')
-    cleanup_and_exit()
+    try:
+        while True:
+            if cv2.waitKey(1) == 27:  # Press Escape to exit
+                break
+
+            try:
+                grabbed = grabber.get(timeout=0.01)
+            except Empty:
+                continue
+            if grabbed is None:
+                break
+
+            frame_idx, capture_time, frame = grabbed
+            if time.perf_counter() - capture_time > target_latency:
+                stale += 1
+                continue
+
+            cv2.imshow(path, eval_frame(frame_idx, frame))
+
+            latency = time.perf_counter() - capture_time
+            latencies.record(latency)
+            latency_avg.add(latency)
+            shown += 1
+            if latency > target_latency:
+                late += 1
+
+            print('\rLatency: %.1f ms | Shown: %d | Dropped: %d | Stale: %d | Over target: %d    ' %
+                  (1000 * latency_avg.get_avg(), shown, grabber.dropped, stale, late), end='')
+    except KeyboardInterrupt:
+        pass
+
+    grabber.stop()
+    print()
+    print()
+    print('Captured %d frames: %d shown, %d dropped unseen, %d stale, %d shown over the %.0f ms target' % (
+        grabber.captured, shown, grabber.dropped, stale, late, args.target_latency))
+
+    summary = latencies.close()
+    if summary['count'] > 0:
+        print('End-to-end latency (ms): mean %.2f | p50 %.2f | p90 %.2f | p99 %.2f | max %.2f' % (
+            1000 * summary['mean'], 1000 * summary['p50'], 1000 * summary['p90'],
+            1000 * summary['p99'], 1000 * summary['max']))
+        print('Saved to %s' % latencies.path)
+    print(keyframes.format_summary())
+    keyframes.close()
+    vid.release()
+    cv2.destroyAllWindows()
+    exit()
 
 def savevideo(net:Yolact, in_path:str, out_path:str):
     vid = cv2.VideoCapture(in_path)
@@ -711,12 +952,15 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
     frame_width  = round(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
     frame_height = round(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
     num_frames   = round(vid.get(cv2.CAP_PROP_FRAME_COUNT))
+    if args.display_scale != 1:
+        # prep_display draws at the reduced resolution
+        frame_width, frame_height = max(1, round(frame_width * args.display_scale)), max(1, round(frame_height * args.display_scale))
     out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), target_fps, (frame_width, frame_height))
     transform = FastBaseTransform()
     frame_times = MovingAverage()
     progress_bar = ProgressBar(30, num_frames)
     frame_idx = 0
-    every_k_frames = 5
+    keyframes = make_keyframe_scheduler(args)
     moving_statistics = {"conf_hist": []}
     try:
         for i in range(num_frames):
@@ -725,7 +969,7 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
             with timer.env('Video'):
                 frame = torch.from_numpy(vid.read()[1]).cuda().float()
                 batch = transform(frame.unsqueeze(0))
-                if frame_idx % every_k_frames == 0 or cfg.flow.warp_mode == 'none':
+                if keyframes.decide(frame_idx, [frame]) or cfg.flow.warp_mode == 'none':
                     extras = {"backbone": "full", "interrupt": False, "keep_statistics": True,
                               "moving_statistics": moving_statistics}
                     with torch.no_grad():
@@ -738,6 +982,7 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
                     with torch.no_grad():
                         net_outs = net(batch, extras=extras)
                 preds = net_outs["pred_outs"]
+                keyframes.observe(preds)
                 processed = prep_display(preds, frame, None, None, undo_transform=False, class_color=True)
                 out.write(processed)
             if i > 1:
@@ -752,9 +997,230 @@ def savevideo(net:Yolact, in_path:str, out_path:str):
     vid.release()
     out.release()
     print()
+    print(keyframes.format_summary())
+    keyframes.close()
+
+def parse_video_jobs(spec:str):
+    """ Turns --videos into a list of (input, output) paths. Every input can be a glob. """
+    inputs, out_folder = spec.rsplit(':', 1)
+    jobs = []
+    for pattern in inputs.split(','):
+        paths = sorted(glob.glob(pattern))
+        if len(paths) == 0:
+            print('No videos match "%s"' % pattern)
+        for path in paths:
+            name = os.path.splitext(os.path.basename(path))[0] + '.mp4'
+            jobs.append((path, os.path.join(out_folder, name)))
+
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    return jobs
+
+def savevideo_batched(net:Yolact, in_path:str, out_path:str):
+    """
+    Headless savevideo for batch jobs. Decoding, the network (video_multiframe frames at a time),
+    rendering and encoding each run in their own thread, joined by a Pipeline. The flow state and
+    keyframe scheduler belong to this video alone. Returns the number of frames written and the
+    time it took.
+    """
+    vid = cv2.VideoCapture(in_path)
+    if not vid.isOpened():
+        raise IOError('Could not open video "%s"' % in_path)
+    target_fps   = round(vid.get(cv2.CAP_PROP_FPS))
+    frame_width  = round(vid.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = round(vid.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    if args.display_scale != 1:
+        # prep_display draws at the reduced resolution
+        frame_width, frame_height = max(1, round(frame_width * args.display_scale)), max(1, round(frame_height * args.display_scale))
+    out = cv2.VideoWriter(out_path, cv2.VideoWriter_fourcc(*"mp4v"), target_fps, (frame_width, frame_height))
+    device = 'cuda' if args.cuda else 'cpu'
+    transform = FastBaseTransform()
+    frame_idx = 0
+    keyframe_batch = None
+    keyframes = make_keyframe_scheduler(args, log_path=os.path.splitext(out_path)[0] + '.keyframes.csv'
+                                        if args.keyframe_log is not None else None)
+    moving_statistics = {"conf_hist": []}
+
+    def read_frames():
+        frames = [vid.read()[1] for _ in range(args.video_multiframe)]
+        frames = [frame for frame in frames if frame is not None]
+        return frames if len(frames) > 0 else None
+
+    def eval_network(frames):
+        nonlocal frame_idx, keyframe_batch
+        with torch.no_grad():
+            frames = [torch.from_numpy(frame).to(device).float() for frame in frames]
+            imgs = transform(torch.stack(frames, 0))
+            # Features can only be warped onto a batch the size of the keyframe's, and the last one may be short
+            force = None
+            if cfg.flow.warp_mode == 'none':
+                force = 'no_warp'
+            elif keyframe_batch is not None and len(frames) != keyframe_batch:
+                force = 'batch_size'
+            if keyframes.decide(frame_idx, frames, force=force) or keyframe_batch is None:
+                extras = {"backbone": "full", "interrupt": False, "keep_statistics": True,
+                          "moving_statistics": moving_statistics}
+                net_outs = net(imgs, extras=extras)
+                moving_statistics["feats"] = net_outs["feats"]
+                moving_statistics["lateral"] = net_outs["lateral"]
+                keyframe_batch = len(frames)
+            else:
+                extras = {"backbone": "partial", "interrupt": False, "keep_statistics": False,
+                          "moving_statistics": moving_statistics}
+                net_outs = net(imgs, extras=extras)
+            preds = net_outs["pred_outs"]
+            keyframes.observe(preds)
+            frame_idx += 1
+        return [(frame, [pred]) for frame, pred in zip(frames, preds)]
+
+    def render(inp):
+        with torch.no_grad():
+            frame, preds = inp
+            return prep_display(preds, frame, None, None, undo_transform=False, class_color=True)
+
+    def write(img):
+        out.write(img)
+        return True
+
+    start_time = time.time()
+    written = 0
+    pipeline = Pipeline(queue_size=max(2, 2 * args.video_multiframe))
+    pipeline.add_source('decode', read_frames)
+    pipeline.add_stage('network', eval_network, expand=True)
+    pipeline.add_stage('render', render)
+    pipeline.add_stage('write', write)
+    pipeline.start()
+    try:
+        while pipeline.get() is not None:
+            written += 1
+    finally:
+        pipeline.stop()
+        vid.release()
+        out.release()
+        keyframes.close()
+
+    return written, time.time() - start_time
+
+def _init_worker(worker_args):
+    """ Sets up args and cfg in a spawned worker process like the main process does. """
+    global args
+    args = worker_args
+    set_cfg(args.config)
+    if args.detect:
+        cfg.eval_mask_branch = False
+    if args.dataset is not None:
+        set_dataset(args.dataset)
+    if args.cuda:
+        cudnn.benchmark = True
+        cudnn.fastest = True
+        torch.set_default_tensor_type('torch.cuda.FloatTensor')
+
+def _savevideos_worker(worker_args, jobs, results):
+    try:
+        _init_worker(worker_args)
+        with torch.no_grad():
+            net = load_net()
+        # What evaluate does for the single process path
+        set_detect_args(net.detect)
+        cfg.mask_proto_debug = args.mask_proto_debug
+    except Exception:
+        results.put(('failed', None, traceback.format_exc(), None))
+        return
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+        in_path, out_path = job
+        try:
+            num_frames, elapsed = savevideo_batched(net, in_path, out_path)
+            results.put(('done', in_path, num_frames, elapsed))
+        except Exception:
+            results.put(('error', in_path, traceback.format_exc(), None))
+
+def savevideos(net:Yolact):
+    """
+    Runs savevideo_batched over every video in --videos. With --video_workers > 1 the videos are
+    shared out among that many worker processes, each loading its own copy of the model, and net
+    is not used. A video that fails is reported and skipped.
+    """
+    jobs = parse_video_jobs(args.videos)
+    print('Processing %d videos with %d worker(s)...' % (len(jobs), args.video_workers))
+
+    start_time = time.time()
+    total_frames = 0
+    failed = 0
+
+    def report(status, in_path, result, elapsed):
+        nonlocal total_frames, failed
+        if status == 'done':
+            total_frames += result
+            print('%s: %d frames in %.1f s (%.2f fps)' % (in_path, result, elapsed, result / max(elapsed, 1e-9)))
+        else:
+            failed += 1
+            print('%s failed:\n%s' % (in_path, result))
+
+    if args.video_workers <= 1:
+        for in_path, out_path in jobs:
+            try:
+                num_frames, elapsed = savevideo_batched(net, in_path, out_path)
+                report('done', in_path, num_frames, elapsed)
+            except Exception:
+                report('error', in_path, traceback.format_exc(), None)
+    else:
+        ctx = mp.get_context('spawn')
+        job_queue = ctx.Queue()
+        results = ctx.Queue()
+        for job in jobs:
+            job_queue.put(job)
+        for _ in range(args.video_workers):
+            job_queue.put(None)
+
+        workers = [ctx.Process(target=_savevideos_worker, args=(args, job_queue, results), daemon=True)
+                   for _ in range(args.video_workers)]
+        for worker in workers:
+            worker.start()
+
+        remaining = len(jobs)
+        try:
+            while remaining > 0:
+                try:
+                    status, in_path, result, elapsed = results.get(timeout=1)
+                except Empty:
+                    if not any(worker.is_alive() for worker in workers):
+                        print('All workers exited with %d videos left.' % remaining)
+                        failed += remaining
+                        break
+                    continue
+                if status == 'failed':
+                    print('A worker failed to start:\n%s' % result)
+                    continue
+                report(status, in_path, result, elapsed)
+                remaining -= 1
+        finally:
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+
+    elapsed = time.time() - start_time
+    print()
+    print('Wrote %d frames from %d videos (%d failed) in %.1f s: %.2f fps aggregate' % (
+        total_frames, len(jobs) - failed, failed, elapsed, total_frames / max(elapsed, 1e-9)))
+
+def set_detect_args(detect:Detect):
+    """ Applies the NMS arguments to detect (and cfg). """
+    detect.use_fast_nms = args.fast_nms
+    if args.nms_thresh is not None:
+        detect.nms_thresh = args.nms_thresh
+    if args.nms_conf_thresh is not None:
+        detect.conf_thresh = args.nms_conf_thresh
+    if args.max_num_detections is not None:
+        cfg.max_num_detections = args.max_num_detections
 
 def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
-    net.detect.use_fast_nms = args.fast_nms
+    if net is not None:
+        set_detect_args(net.detect)
     cfg.mask_proto_debug = args.mask_proto_debug
     detections = None
     if args.output_coco_json and (args.image or args.images):
@@ -776,10 +1242,15 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
         if args.output_coco_json:
             detections.dump()
         return
+    elif args.videos is not None:
+        savevideos(net)
+        return
     elif args.video is not None:
         if ':' in args.video:
             inp, out = args.video.split(':')
             savevideo(net, inp, out)
+        elif args.realtime:
+            evalvideo_realtime(net, args.video)
         else:
             evalvideo(net, args.video)
         return
@@ -790,10 +1261,7 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
     progress_bar = ProgressBar(30, dataset_size)
     print()
     if not args.display and not args.benchmark:
-        ap_data = {
-            'box' : [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds],
-            'mask': [[APDataObject() for _ in cfg.dataset.class_names] for _ in iou_thresholds]
-        }
+        ap_data = new_ap_data()
         detections = Detections()
     else:
         timer.disable('Load Data')
@@ -805,6 +1273,10 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
         hashed = [badhash(x) for x in dataset.ids]
         dataset_indices.sort(key=lambda x: hashed[x])
     dataset_indices = dataset_indices[:dataset_size]
+    if use_shards(dataset):
+        evaluate_sharded(net, dataset, dataset_indices, train_mode)
+        return
+    raw_cache = None
     try:
         if dataset.name == "YouTube VIS":
             timer.enable_all()
@@ -882,17 +1354,36 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
                             print('\rProcessing Images  %s %6d / %6d (%5.2f%%)    %5.2f fps        '
                                   % (repr(progress_bar), it+1, dataset_size, progress, fps), end='')
         else:
-            for it, image_idx in enumerate(dataset_indices):
+            from yolact_edge.data.coco import COCODetectionEval, collate_fn_coco_eval
+            # Images come out in the order of dataset_indices no matter how many workers decode them
+            eval_dataset = COCODetectionEval(dataset, dataset_indices)
+            worker_kwargs = {}
+            if args.eval_workers > 0:
+                # Forked workers see the cfg set up in this process
+                worker_kwargs = {"prefetch_factor": args.eval_prefetch, "multiprocessing_context": "fork"}
+            data_loader = torch.utils.data.DataLoader(eval_dataset, num_workers=args.eval_workers, shuffle=False,
+                                                      collate_fn=collate_fn_coco_eval, pin_memory=args.cuda,
+                                                      **worker_kwargs)
+            data_loader_iter = iter(data_loader)
+            if args.save_raw_outputs:
+                raw_cache = RawOutputCache(args.raw_output_cache, 'w')
+            for it in range(len(eval_dataset)):
                 timer.reset()
                 with timer.env('Load Data'):
-                    img, gt, gt_masks, h, w, num_crowd = dataset.pull_item(image_idx)
+                    image_idx, (img, gt, gt_masks, h, w, num_crowd) = next(data_loader_iter)
                     batch = Variable(img.unsqueeze(0))
                     if args.cuda:
                         batch = batch.cuda()
                 with timer.env('Network Extra'):
                     extras = {"backbone": "full", "interrupt": False,
                               "moving_statistics": {"aligned_feats": []}}
+                    if raw_cache is not None:
+                        extras["raw_outputs"] = True
                     preds = net(batch, extras=extras)["pred_outs"]
+                if raw_cache is not None:
+                    with timer.env('Save Raw'):
+                        save_raw_outputs(raw_cache, preds, gt, gt_masks, h, w, num_crowd, dataset.ids[image_idx])
+                    preds = net.detect(preds)
                 if args.display:
                     img_numpy = prep_display(preds, img, h, w)
                 elif args.benchmark:
@@ -914,6 +1405,8 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
                     progress_bar.set_val(it+1)
                     print('\rProcessing Images  %s %6d / %6d (%5.2f%%)    %5.2f fps        '
                           % (repr(progress_bar), it+1, dataset_size, progress, fps), end='')
+            if raw_cache is not None:
+                raw_cache.close()
         if not args.display and not args.benchmark:
             print()
             if args.output_coco_json:
@@ -935,6 +1428,8 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
             avg_seconds = frame_times.get_avg()
             print('Average: %5.2f fps, %5.2f ms' % (1 / frame_times.get_avg(), 1000*avg_seconds))
     except KeyboardInterrupt:
+        if raw_cache is not None:
+            raw_cache.close()
         if not args.display and not args.benchmark:
             print()
             logger = logging.getLogger("yolact.eval")
@@ -947,6 +1442,304 @@ def evaluate(net:Yolact, dataset, train_mode=False, train_cfg=None):
             avg_seconds = frame_times.get_avg()
             print('Average: %5.2f fps, %5.2f ms' % (1 / frame_times.get_avg(), 1000*avg_seconds))
 
+def use_shards(dataset):
+    """ Whether mAP evaluation on dataset is split up with --eval_shards. """
+    return args.eval_shards > 1 and dataset is not None and dataset.name != "YouTube VIS"
+
+def weights_key():
+    """ Identifies the --trained_model weights by their path, size and modification time. """
+    if args.trained_model is None or not os.path.isfile(args.trained_model):
+        return args.trained_model
+    stat = os.stat(args.trained_model)
+    return (os.path.abspath(args.trained_model), stat.st_size, stat.st_mtime_ns)
+
+def shard_run_key():
+    """ Everything besides the images that ap_data depends on, so checkpoints of other runs aren't mixed in. """
+    return {'config': cfg.name, 'weights': weights_key(), 'score_threshold': args.score_threshold,
+            'fast_nms': args.fast_nms, 'crop': args.crop, 'top_k': args.top_k, 'nms_thresh': args.nms_thresh,
+            'nms_conf_thresh': args.nms_conf_thresh, 'max_num_detections': args.max_num_detections}
+
+def shard_path(shard_idx:int):
+    return os.path.join(args.shard_dir, 'shard_%d_of_%d.pkl' % (shard_idx, args.eval_shards))
+
+def save_shard(state:dict, path:str):
+    # Write to the side and swap it in, so a crash never leaves a broken checkpoint behind
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+def load_shard(path:str, image_ids:list=None):
+    """
+    Returns the checkpoint at path, or None if there is none or it was made for another run (other
+    weights, config or evaluation arguments, see shard_run_key) or (if image_ids is given) for
+    other images.
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if state.get('run') != shard_run_key() or (image_ids is not None and state['image_ids'] != image_ids):
+        logging.getLogger("yolact.eval").warning('Ignoring the checkpoint %s, which is for another run.' % path)
+        return None
+    return state
+
+def evaluate_shard(net:Yolact, dataset, indices:list, shard_idx:int, progress=None):
+    """
+    Accumulates ap_data over the images at indices, checkpointing it to shard_path(shard_idx)
+    every --checkpoint_every images, and returns the final checkpoint. If there's a checkpoint
+    for the same images already, this picks up where it left off. progress(done) is called
+    after every checkpoint.
+    """
+    path = shard_path(shard_idx)
+    image_ids = [dataset.ids[idx] for idx in indices]
+    state = load_shard(path, image_ids)
+    if state is None:
+        state = {'run': shard_run_key(), 'image_ids': image_ids, 'done': 0, 'ap_data': new_ap_data()}
+
+    from yolact_edge.data.coco import COCODetectionEval, collate_fn_coco_eval
+    eval_dataset = COCODetectionEval(dataset, indices[state['done']:])
+    worker_kwargs = {}
+    if args.eval_workers > 0:
+        worker_kwargs = {"prefetch_factor": args.eval_prefetch, "multiprocessing_context": "fork"}
+    data_loader = torch.utils.data.DataLoader(eval_dataset, num_workers=args.eval_workers, shuffle=False,
+                                              collate_fn=collate_fn_coco_eval, pin_memory=args.cuda,
+                                              **worker_kwargs)
+
+    for image_idx, (img, gt, gt_masks, h, w, num_crowd) in data_loader:
+        batch = Variable(img.unsqueeze(0))
+        if args.cuda:
+            batch = batch.cuda()
+        extras = {"backbone": "full", "interrupt": False, "moving_statistics": {"aligned_feats": []}}
+        preds = net(batch, extras=extras)["pred_outs"]
+        prep_metrics(state['ap_data'], preds, img, gt, gt_masks, h, w, num_crowd, dataset.ids[image_idx])
+
+        # Only ever checkpoint between images, so ap_data always covers exactly the first done images
+        state['done'] += 1
+        if state['done'] % args.checkpoint_every == 0:
+            save_shard(state, path)
+            if progress is not None:
+                progress(state['done'])
+
+    save_shard(state, path)
+    return state
+
+def _evaluate_shard_worker(worker_args, shard_idx, indices, results):
+    try:
+        _init_worker(worker_args)
+        if not args.cuda:
+            # Share the cores out among the shards
+            num_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+            torch.set_num_threads(max(1, num_cores // args.eval_shards))
+        dataset = COCODetection(cfg.dataset.valid_images, cfg.dataset.valid_info,
+                                transform=BaseTransform(), has_gt=cfg.dataset.has_gt)
+        with torch.no_grad():
+            net = load_net()
+            set_detect_args(net.detect)
+            cfg.mask_proto_debug = args.mask_proto_debug
+            state = evaluate_shard(net, dataset, indices, shard_idx,
+                                   progress=lambda done: results.put((shard_idx, 'progress', done)))
+        results.put((shard_idx, 'done', state['done']))
+    except Exception:
+        results.put((shard_idx, 'error', traceback.format_exc()))
+
+def evaluate_sharded(net:Yolact, dataset, dataset_indices:list, train_mode=False):
+    """
+    Splits dataset_indices into --eval_shards shards (every n-th image, so they take about as long)
+    and runs evaluate_shard on each, then merges the checkpoints and calculates mAP. The shards
+    each get their own process and copy of the model, and net isn't used, except with --shard,
+    where this process runs only that shard with net and leaves merging for --merge_shards.
+
+    Every shard resumes from its checkpoint, so after an interruption the same command carries on
+    where it stopped, and finished shards aren't run again.
+    """
+    logger = logging.getLogger("yolact.eval")
+    os.makedirs(args.shard_dir, exist_ok=True)
+    shards = [dataset_indices[shard_idx::args.eval_shards] for shard_idx in range(args.eval_shards)]
+
+    if args.shard is not None:
+        logger.info('Evaluating shard %d of %d (%d images)...' % (args.shard, args.eval_shards, len(shards[args.shard])))
+        evaluate_shard(net, dataset, shards[args.shard], args.shard)
+        logger.info('Shard %d done. Run with --merge_shards once every shard is.' % args.shard)
+        return
+
+    done = [0] * args.eval_shards
+    todo = []
+    for shard_idx, indices in enumerate(shards):
+        state = load_shard(shard_path(shard_idx), [dataset.ids[idx] for idx in indices])
+        done[shard_idx] = state['done'] if state is not None else 0
+        if done[shard_idx] < len(indices):
+            todo.append(shard_idx)
+
+    logger.info('Evaluating %d images in %d shards, %d already done...' % (len(dataset_indices), args.eval_shards, sum(done)))
+    progress_bar = ProgressBar(30, len(dataset_indices))
+
+    ctx = mp.get_context('spawn')
+    results = ctx.Queue()
+    workers = [ctx.Process(target=_evaluate_shard_worker, args=(args, shard_idx, shards[shard_idx], results), daemon=True)
+               for shard_idx in todo]
+    for worker in workers:
+        worker.start()
+
+    try:
+        remaining = len(todo)
+        while remaining > 0:
+            try:
+                shard_idx, status, result = results.get(timeout=1)
+            except Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    logger.warning('All shard workers exited with %d shards left.' % remaining)
+                    break
+                continue
+
+            if status == 'error':
+                logger.error('Shard %d failed:\n%s' % (shard_idx, result))
+                remaining -= 1
+                continue
+            done[shard_idx] = result
+            if status == 'done':
+                remaining -= 1
+
+            if not args.no_bar:
+                progress_bar.set_val(sum(done))
+                print('\rProcessing Images  %s %6d / %6d (%5.2f%%)        '
+                      % (repr(progress_bar), sum(done), len(dataset_indices), sum(done) / max(len(dataset_indices), 1) * 100), end='')
+        print()
+    except KeyboardInterrupt:
+        print()
+        logger.info('Stopping early, calculating AP based on the last checkpoints. Run the same command again to resume.')
+    finally:
+        for worker in workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+
+    merge_shards(train_mode)
+
+def merge_shards(train_mode=False):
+    """ Merges the checkpoints of the --eval_shards shards in --shard_dir, saves the result and calculates mAP. """
+    logger = logging.getLogger("yolact.eval")
+    ap_data = new_ap_data()
+    done, total = 0, 0
+
+    for shard_idx in range(args.eval_shards):
+        state = load_shard(shard_path(shard_idx))
+        if state is None:
+            logger.warning('Shard %d has no checkpoint for this run in %s.' % (shard_idx, args.shard_dir))
+            continue
+        if state['done'] < len(state['image_ids']):
+            logger.warning('Shard %d only covers %d of its %d images.' % (shard_idx, state['done'], len(state['image_ids'])))
+        merge_ap_data(ap_data, state['ap_data'])
+        done += state['done']
+        total += len(state['image_ids'])
+
+    logger.info('Merged %d shards covering %d / %d images.' % (args.eval_shards, done, total))
+    if not train_mode:
+        print('Saving data...')
+        with open(args.ap_data_file, 'wb') as f:
+            pickle.dump(ap_data, f)
+    calc_map(ap_data)
+    return ap_data
+
+def save_raw_outputs(raw_cache:RawOutputCache, pred_outs:dict, gt, gt_masks, h:int, w:int, num_crowd:int, image_id):
+    """
+    Adds the raw network outputs (for a batch of one) and ground truth of an image to raw_cache.
+    Detect drops every prior whose best score isn't above its conf_thresh before doing anything
+    else, so only priors above --raw_cache_conf_floor are kept. Detect gives the same results
+    on those for any conf_thresh at or above the floor.
+    """
+    if len(raw_cache.meta) == 0:
+        raw_cache.meta.update({'config': cfg.name, 'weights': weights_key(), 'conf_floor': args.raw_cache_conf_floor,
+                               'priors': pred_outs['priors'].cpu().numpy()})
+
+    conf = pred_outs['conf'][0]
+    prior_idx = torch.nonzero(conf[:, 1:].max(dim=1)[0] > args.raw_cache_conf_floor)[:, 0]
+
+    arrays = {'prior_idx': prior_idx.int().cpu().numpy()}
+    for name in ('loc', 'conf', 'mask', 'inst'):
+        if name in pred_outs:
+            arrays[name] = pred_outs[name][0, prior_idx].cpu().numpy()
+    if 'proto' in pred_outs:
+        proto = pred_outs['proto'][0].cpu().numpy()
+        arrays['proto'] = proto.astype(np.float16) if args.raw_cache_half else proto
+
+    info = {'image_id': image_id, 'h': h, 'w': w, 'num_crowd': num_crowd, 'has_gt': gt is not None}
+    if gt is not None:
+        arrays['gt'] = gt
+        arrays['gt_masks'] = np.packbits(np.asarray(gt_masks) > 0.5)
+        info['gt_masks_shape'] = np.asarray(gt_masks).shape
+
+    raw_cache.add(info, arrays)
+
+def rescore_raw_outputs():
+    """
+    Runs Detect, postprocess and prep_metrics again over the raw outputs saved with
+    --save_raw_outputs, with the NMS and postprocessing arguments given now, and calculates mAP
+    (or writes --output_coco_json results). Neither the network nor the dataset is loaded.
+    """
+    logger = logging.getLogger("yolact.eval")
+    raw_cache = RawOutputCache(args.raw_output_cache, 'r')
+    meta = raw_cache.meta
+    if len(raw_cache) == 0:
+        logger.error('No raw outputs in %s.' % args.raw_output_cache)
+        return
+    if meta['config'] != cfg.name:
+        logger.warning('The raw outputs are from %s, not %s.' % (meta['config'], cfg.name))
+    if args.trained_model is not None and meta.get('weights') != weights_key():
+        logger.warning('The raw outputs are from the weights %s, not %s.' % (meta.get('weights'), weights_key()))
+
+    # The same as Yolact's
+    detect = Detect(cfg.num_classes, bkg_label=0, top_k=200, conf_thresh=0.05, nms_thresh=0.5)
+    set_detect_args(detect)
+    cfg.mask_proto_debug = args.mask_proto_debug
+    if detect.conf_thresh < meta['conf_floor']:
+        logger.error('The raw outputs only cover --nms_conf_thresh >= %g.' % meta['conf_floor'])
+        return
+
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    priors = torch.from_numpy(np.array(meta['priors'])).to(device)
+
+    detections = None
+    if args.output_coco_json:
+        prep_coco_cats()
+        detections = Detections()
+    ap_data = new_ap_data()
+
+    logger.info('Rescoring %d images from %s...' % (len(raw_cache), args.raw_output_cache))
+    progress_bar = ProgressBar(30, len(raw_cache))
+    start_time = time.time()
+
+    for it in range(len(raw_cache)):
+        info, arrays = raw_cache[it]
+
+        pred_outs = {name: torch.from_numpy(arrays[name].astype(np.float32))[None].to(device)
+                     for name in ('loc', 'conf', 'mask', 'inst', 'proto') if name in arrays}
+        pred_outs['priors'] = priors[torch.from_numpy(arrays['prior_idx'].astype(np.int64)).to(device)]
+        preds = detect(pred_outs)
+
+        gt, gt_masks = None, None
+        if info['has_gt']:
+            gt = np.array(arrays['gt'])
+            gt_masks = np.unpackbits(arrays['gt_masks'], count=int(np.prod(info['gt_masks_shape'])))
+            gt_masks = gt_masks.reshape(info['gt_masks_shape'])
+
+        prep_metrics(ap_data, preds, None, gt, gt_masks, info['h'], info['w'], info['num_crowd'], info['image_id'], detections)
+
+        if not args.no_bar:
+            progress_bar.set_val(it+1)
+            print('\rRescoring Images  %s %6d / %6d (%5.2f%%)        '
+                  % (repr(progress_bar), it+1, len(raw_cache), (it+1) / len(raw_cache) * 100), end='')
+    print()
+    logger.info('Rescored in %.1f s.' % (time.time() - start_time))
+
+    if args.output_coco_json:
+        print('Dumping detections...')
+        detections.dump()
+    else:
+        print('Saving data...')
+        with open(args.ap_data_file, 'wb') as f:
+            pickle.dump(ap_data, f)
+        calc_map(ap_data)
+
 def calc_map(ap_data):
     logger = logging.getLogger("yolact.eval")
     logger.info('Calculating mAP...')
@@ -984,6 +1777,22 @@ def badhash(x):
     x = ((x >> 16) ^ x) & 0xFFFFFFFF
     return x
 
+def load_net():
+    """ Builds the network for args and loads its weights, converting parts to TensorRT where enabled. """
+    logger = logging.getLogger("yolact.eval")
+    logger.info('Loading model...')
+    net = Yolact(training=False)
+    if args.trained_model is not None:
+        net.load_weights(args.trained_model, args=args)
+    else:
+        logger.warning("No weights loaded!")
+    net.eval()
+    logger.info('Model loaded.')
+    convert_to_tensorrt(net, cfg, args, transform=BaseTransform())
+    if args.cuda:
+        net = net.cuda()
+    return net
+
 ##############################################
 # Main
 ##############################################
@@ -1025,7 +1834,17 @@ if __name__ == '__main__':
                 ap_data = pickle.load(f)
             calc_map(ap_data)
             exit()
-        if args.image is None and args.video is None and args.images is None:
+        if args.merge_shards:
+            merge_shards()
+            exit()
+        if args.rescore:
+            rescore_raw_outputs()
+            exit()
+        if args.videos is not None and args.video_workers > 1:
+            # The workers load the model themselves
+            savevideos(None)
+            exit()
+        if args.image is None and args.video is None and args.images is None and args.videos is None:
             if cfg.dataset.name == 'YouTube VIS':
                 dataset = YoutubeVIS(image_path=cfg.dataset.valid_images,
                                      info_file=cfg.dataset.valid_info,
@@ -1037,15 +1856,9 @@ if __name__ == '__main__':
             prep_coco_cats()
         else:
             dataset = None
-        logger.info('Loading model...')
-        net = Yolact(training=False)
-        if args.trained_model is not None:
-            net.load_weights(args.trained_model, args=args)
+        if use_shards(dataset) and args.shard is None:
+            # The shard workers load the model themselves
+            net = None
         else:
-            logger.warning("No weights loaded!")
-        net.eval()
-        logger.info('Model loaded.')
-        convert_to_tensorrt(net, cfg, args, transform=BaseTransform())
-        if args.cuda:
-            net = net.cuda()
+            net = load_net()
         evaluate(net, dataset)
@@ -1,6 +1,9 @@
 """
 Runs the coco-supplied cocoeval script to evaluate detections
 outputted by using the output_coco_json flag in eval.py.
+
+By default the vectorized FastCOCOeval (yolact_edge/utils/coco_eval.py) is used, which gives
+the same numbers as pycocotools' COCOeval much faster. Use --evaluator=pycocotools for the original.
 """
 
 
@@ -15,12 +18,18 @@ parser.add_argument('--bbox_det_file', default='results/bbox_detections.json', t
 parser.add_argument('--mask_det_file', default='results/mask_detections.json', type=str)
 parser.add_argument('--gt_ann_file',   default='data/coco/annotations/instances_val2017.json', type=str)
 parser.add_argument('--eval_type',     default='both', choices=['bbox', 'mask', 'both'], type=str)
+parser.add_argument('--evaluator',     default='fast', choices=['fast', 'pycocotools'], type=str)
+parser.add_argument('--workers',       default=None, type=int, help='Processes for --evaluator=fast (one per core this process may run on by default).')
 args = parser.parse_args()
 
 
 
 if __name__ == '__main__':
 
+	if args.evaluator == 'fast':
+		from yolact_edge.utils.coco_eval import FastCOCOeval
+		COCOeval = lambda gt, dt, iou_type: FastCOCOeval(gt, dt, iou_type, num_workers=args.workers)
+
 	eval_bbox = (args.eval_type in ('bbox', 'both'))
 	eval_mask = (args.eval_type in ('mask', 'both'))
 
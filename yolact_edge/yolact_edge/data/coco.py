@@ -254,3 +254,26 @@ class COCODetection(data.Dataset):
         tmp = '    Target Transforms (if any): '
         fmt_str += '{0}{1}'.format(tmp, self.target_transform.__repr__().replace('\n', '\n' + ' ' * len(tmp)))
         return fmt_str
+
+
+class COCODetectionEval(data.Dataset):
+    """
+    Serves pull_item of dataset for the images at indices, in that order, so evaluate() can
+    decode images and rasterize GT masks in DataLoader workers ahead of the network.
+    Each item is (index, pull_item(index)).
+    """
+
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __getitem__(self, idx):
+        image_idx = self.indices[idx]
+        return image_idx, self.dataset.pull_item(image_idx)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def collate_fn_coco_eval(batch):
+    return batch[0]
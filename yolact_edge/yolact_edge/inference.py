@@ -1,17 +1,23 @@
 import cv2
+import numpy as np
 import torch
 import torch.backends.cudnn as cudnn
+import torch.nn.functional as F
 import matplotlib.pyplot as plt
-from collections import defaultdict
 from yolact_edge.data.config import cfg, set_cfg
 from yolact_edge.yolact import Yolact
-from yolact_edge.utils.augmentations import FastBaseTransform, BaseTransform
-from yolact_edge.utils import timer
-from yolact_edge.layers.output_utils import postprocess, undo_image_transformation
-from yolact_edge.data import COLORS, set_dataset
+from yolact_edge.utils.augmentations import FastBaseTransform, FastUint8Transform, BaseTransform
+from yolact_edge.utils import timer, arena
+from yolact_edge.utils.arena import TensorArena
+from yolact_edge.layers.output_utils import postprocess, undo_image_transformation, LazyMasks
+from yolact_edge.data import set_dataset
 from yolact_edge.utils.tensorrt import convert_to_tensorrt
+from yolact_edge.utils.compiled_cache import CompiledYolact
+from yolact_edge.utils.overlay import OverlayRenderer
 import argparse
 import random
+import time
+import os
 
 
 def str2bool(v):
@@ -42,6 +48,8 @@ def parse_args(argv=None):
                         help='Whether or not to display text (class [score])')
     parser.add_argument('--display_scores', default=True, type=str2bool,
                         help='Whether or not to display scores in addition to classes')
+    parser.add_argument('--display_scale', default=1.0, type=float,
+                        help='Draw the output at this fraction of the input resolution, which is faster.')
     parser.add_argument('--display', dest='display', action='store_true',
                         help='Display qualitative results instead of quantitative ones.')
     parser.add_argument('--shuffle', dest='shuffle', action='store_true',
@@ -119,7 +127,8 @@ def parse_args(argv=None):
                         benchmark=False, no_sort=False, no_hash=False, mask_proto_debug=False, crop=True, detect=False)
 
     global args
-    args = parser.parse_args(argv)
+    # Unknown flags are ignored since this is usually embedded in a program with flags of its own
+    args = parser.parse_known_args(argv)[0]
 
     if args.output_web_json:
         args.output_coco_json = True
@@ -129,11 +138,56 @@ def parse_args(argv=None):
 
     return args
 
+def set_cpu_threads(num_threads=None, num_interop_threads=1):
+    """
+    Tunes the intra-op and inter-op thread pools used by PyTorch on the CPU.
+
+    If num_threads is None, one intra-op thread is used per core this process is allowed
+    to run on. A single inference stream gains nothing from inter-op parallelism, so by
+    default that pool is shrunk to one thread to keep it from competing for cores.
+    Returns the number of intra-op threads in use.
+    """
+    if num_threads is None:
+        if hasattr(os, 'sched_getaffinity'):
+            num_threads = len(os.sched_getaffinity(0))
+        else:
+            num_threads = os.cpu_count() or 1
+
+    torch.set_num_threads(num_threads)
+
+    if num_interop_threads is not None:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # This can only be set once, before any inter-op parallel work has started
+            pass
+
+    return torch.get_num_threads()
+
 class YOLACTEdgeInference(object):
 
-    def __init__(self, weights, model_config, dataset, calib_images, config_ovr={}, args_ovr={}):
+    def __init__(self, weights, model_config, dataset, calib_images, config_ovr={}, args_ovr={},
+                 device=None, num_threads=None, compile_cache=False, steady_state=False):
+        """
+        If device is None, CUDA is used when available and the CPU otherwise.
+        num_threads is only used on the CPU, see set_cpu_threads.
+
+        weights is a path to a state_dict file or, to share weights between processes, the
+        state_dict of an already loaded Yolact (see Yolact.use_shared_weights and pool.py).
+
+        If compile_cache is True (or a directory to keep the artifacts in), parts of the network
+        that aren't converted to TensorRT run as TorchScript from the persistent compiled cache
+        (see utils/compiled_cache.py), so only the first run for a given input shape pays for tracing.
+
+        steady_state=True is meant for long runs at a fixed resolution (e.g. video): the big
+        per-frame intermediates (network outputs, NMS, masks and the display image) are kept in a
+        TensorArena and reused instead of being allocated again every frame. The rendered image
+        predict() returns then lives in that arena as well and is only valid until the next call,
+        so copy it if you hold on to it. See allocation_report to check what's still allocated.
+        """
         print("Configuring YOLACT edge...")
-        self.color_cache = defaultdict(lambda: {})
+        self.renderer = OverlayRenderer()
+        self.arena = TensorArena() if steady_state else None
 
         global cfg
         set_cfg(model_config)
@@ -148,43 +202,79 @@ class YOLACTEdgeInference(object):
         set_dataset(args.dataset)
         for item in args_ovr:
             if item in args:
-                args[item] = args_ovr[item]
+                setattr(args, item, args_ovr[item])
+
+        if device is None:
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.device = torch.device(device)
+
+        if self.device.type == 'cuda' and not torch.cuda.is_available():
+            print("CUDA missing... Falling back to the CPU...")
+            self.device = torch.device('cpu')
 
         with torch.no_grad():
-            if torch.cuda.is_available():
+            if self.device.type == 'cuda':
                 cudnn.fastest = True
                 cudnn.deterministic = True
                 cudnn.benchmark = False
                 torch.set_default_tensor_type('torch.cuda.FloatTensor')
             else:
-                print("CUDA missing... Exiting...")
-                exit(1)
+                # TensorRT only targets the GPU
+                args.cuda = False
+                args.disable_tensorrt = True
+                torch.set_default_tensor_type('torch.FloatTensor')
+                print("Running on the CPU with %d threads..." % set_cpu_threads(num_threads))
 
             print("Loading YOLACT edge model...")
             net = Yolact(training=False)
-            net.load_weights(weights, args=args)
+            if isinstance(weights, dict):
+                net.use_shared_weights(weights)
+            else:
+                net.load_weights(weights, args=args)
             net.eval()
             convert_to_tensorrt(net, cfg, args, transform=BaseTransform())
-            net = net.cuda()
+            net = net.to(self.device)
+
+            # TensorRT modules can't be traced, so the cache is only used without them
+            use_tensorrt = any(v is True for k, v in vars(cfg).items() if k.startswith('torch2trt_'))
+            if compile_cache and not use_tensorrt:
+                net = CompiledYolact(net, weights_path=weights if isinstance(weights, str) else None,
+                                     cache_dir=compile_cache if isinstance(compile_cache, str) else None)
+
             self.net = net
+            self.transform = FastBaseTransform().to(self.device)
+            self.uint8_transform = FastUint8Transform()
             print("Model ready for inference...")
 
-    def prep_output(self, dets_out, img, h, w, undo_transform=True, class_color=False, mask_alpha=0.45):
+    def synchronize(self):
+        """ Waits for queued work on the inference device to finish. A no-op on the CPU. """
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def prep_output(self, dets_out, img, h, w, undo_transform=True, class_color=False, mask_alpha=0.45, batch_idx=0,
+                    render=True):
         """
         Note: If undo_transform=False then im_h and im_w are allowed to be None.
+        batch_idx selects which image of a batched Detect output to prepare.
+
+        If render=False, the image is neither reconstructed nor drawn on and a dict of the
+        structured detections is returned instead (see make_detections).
         """
-        if undo_transform:
-            img_numpy = undo_image_transformation(img, w, h)
-            img_gpu = torch.Tensor(img_numpy).cuda()
-        else:
-            img_gpu = img / 255.0
+        if not undo_transform:
             h, w, _ = img.shape
 
+        # Drawing at a reduced resolution saves making the masks at full size in the first place
+        scale = args.display_scale if render else 1
+        if scale != 1:
+            h, w = max(1, round(h * scale)), max(1, round(w * scale))
+
         with timer.env('Postprocess'):
-            t = postprocess(dets_out, w, h, visualize_lincomb=args.display_lincomb,
+            t = postprocess(dets_out, w, h, batch_idx=batch_idx,
+                            visualize_lincomb=args.display_lincomb,
                             crop_masks=args.crop,
-                            score_threshold=args.score_threshold)
-            torch.cuda.synchronize()
+                            score_threshold=args.score_threshold,
+                            lazy_masks=not render)
+            self.synchronize()
 
         with timer.env('Copy'):
             if cfg.eval_mask_branch:
@@ -199,104 +289,140 @@ class YOLACTEdgeInference(object):
                 num_dets_to_consider = j
                 break
 
+        if not render:
+            return self.make_detections(classes, scores, boxes, masks if cfg.eval_mask_branch else None,
+                                        num_dets_to_consider, h, w)
+
         if num_dets_to_consider == 0:
             # No detections found so just output the original image
             return None
 
-        # Quick and dirty lambda for selecting the color for a particular index
-        # Also keeps track of a per-gpu color cache for maximum speed
-        def get_color(j, on_gpu=None):
-            color_idx = (
-                classes[j] * 5 if class_color else j * 5) % len(COLORS)
+        if undo_transform:
+            img_numpy = undo_image_transformation(img, w, h)
+            img_gpu = torch.Tensor(img_numpy).to(self.device)
+        else:
+            if scale != 1:
+                img = F.interpolate(img.permute(2, 0, 1)[None].float(), size=(h, w), mode='area')[0].permute(1, 2, 0)
+            img_gpu = torch.div(img, 255.0, out=arena.empty('display.img.%d' % batch_idx, img.shape, device=img.device))
 
-            if on_gpu is not None and color_idx in self.color_cache[on_gpu]:
-                return self.color_cache[on_gpu][color_idx]
-            else:
-                color = COLORS[color_idx]
-                if not undo_transform:
-                    # The image might come in as RGB or BRG, depending
-                    color = (color[2], color[1], color[0])
-                if on_gpu is not None:
-                    color = torch.Tensor(color).to(on_gpu).float() / 255.
-                    self.color_cache[on_gpu][color_idx] = color
-                return color
+        # The image might come in as RGB or BGR, depending
+        bgr = not undo_transform
+        color_idx = self.renderer.color_indices(classes[:num_dets_to_consider], class_color)
 
         # First, draw the masks on the GPU where we can do it really fast
-        # Beware: very fast but possibly unintelligible mask-drawing code ahead
-        # I wish I had access to OpenGL or Vulkan but alas, I guess Pytorch tensor operations will have to suffice
         if args.display_masks and cfg.eval_mask_branch:
-            # After this, mask is of size [num_dets, h, w, 1]
-            masks = masks[:num_dets_to_consider, :, :, None]
-
-            # Prepare the RGB images for each mask given their color (size [num_dets, h, w, 1])
-            colors = torch.cat([get_color(j, on_gpu=img_gpu.device.index).view(
-                1, 1, 1, 3) for j in range(num_dets_to_consider)], dim=0)
-            masks_color = masks.repeat(1, 1, 1, 3) * colors * mask_alpha
-
-            # This is 1 everywhere except for 1-mask_alpha where the mask is
-            inv_alph_masks = masks * (-mask_alpha) + 1
-
-            # I did the math for this on pen and paper. This whole block should be equivalent to:
-            #    for j in range(num_dets_to_consider):
-            #        img_gpu = img_gpu * inv_alph_masks[j] + masks_color[j]
-            masks_color_summand = masks_color[0]
-            if num_dets_to_consider > 1:
-                inv_alph_cumul = inv_alph_masks[:(
-                    num_dets_to_consider-1)].cumprod(dim=0)
-                masks_color_cumul = masks_color[1:] * inv_alph_cumul
-                masks_color_summand += masks_color_cumul.sum(dim=0)
-
-            img_gpu = img_gpu * \
-                inv_alph_masks.prod(dim=0) + masks_color_summand
+            img_gpu = self.renderer.draw_masks(img_gpu, masks, color_idx, bgr, mask_alpha)
 
         # Then draw the stuff that needs to be done on the cpu
         # Note, make sure this is a uint8 tensor or opencv will not anti alias text for whatever reason
-        img_numpy = (img_gpu * 255).byte().cpu().numpy()
+        img_numpy = arena.empty('display.out.%d' % batch_idx, img_gpu.shape, dtype=torch.uint8, device=img_gpu.device)
+        img_numpy = img_numpy.copy_(img_gpu.mul_(255)).cpu().numpy()
 
         if args.display_text or args.display_bboxes:
-            for j in reversed(range(num_dets_to_consider)):
-                x1, y1, x2, y2 = boxes[j, :]
-                color = get_color(j)
-                score = scores[j]
+            texts = None
+            if args.display_text:
+                names = [cfg.dataset.class_names[classes[j]] for j in range(num_dets_to_consider)]
+                texts = ['%s: %.2f' % (name, score) for name, score in zip(names, scores)] if args.display_scores else names
+            self.renderer.draw_boxes(img_numpy, boxes, color_idx, bgr, texts=texts, draw_boxes=args.display_bboxes)
+
+        return (img_numpy, classes, scores, masks)
 
-                if args.display_bboxes:
-                    cv2.rectangle(img_numpy, (x1, y1), (x2, y2), color, 1)
+    def make_detections(self, classes, scores, boxes, masks, num_dets, h, w):
+        """
+        Packs the first num_dets detections into a dict of numpy arrays:
+            - class [num_dets]: The class idx of each detection (see cfg.dataset.class_names).
+            - score [num_dets]: The confidence of each detection.
+            - box   [num_dets, 4]: The box of each detection as absolute x1, y1, x2, y2.
+            - mask  [num_dets, h, w]: Boolean full image masks, or None without a mask branch.
+
+        For lincomb models mask is a LazyMasks that only builds the masks you index into (use
+        np.asarray on it to get all of them at once, or see LazyMasks for cropped / downscaled ones).
+        """
+        if num_dets == 0:
+            # postprocess returns shapeless tensors when there's nothing left, so give these a proper shape
+            return {"class": np.zeros(0, dtype=np.int64), "score": np.zeros(0, dtype=np.float32),
+                    "box": np.zeros((0, 4), dtype=np.int64),
+                    "mask": np.zeros((0, h, w), dtype=bool) if masks is not None else None}
 
-                if args.display_text:
-                    _class = cfg.dataset.class_names[classes[j]]
-                    text_str = '%s: %.2f' % (
-                        _class, score) if args.display_scores else _class
+        if isinstance(masks, LazyMasks):
+            masks = masks[:num_dets]
+        elif masks is not None:
+            with timer.env('Copy'):
+                masks = masks[:num_dets].bool().cpu().numpy()
 
-                    font_face = cv2.FONT_HERSHEY_DUPLEX
-                    font_scale = 0.6
-                    font_thickness = 1
+        return {"class": classes[:num_dets], "score": scores[:num_dets], "box": boxes[:num_dets], "mask": masks}
 
-                    text_w, text_h = cv2.getTextSize(
-                        text_str, font_face, font_scale, font_thickness)[0]
+    def ingest(self, images):
+        """
+        Turns a list of HWC BGR images into (frames, batch) where frames are the images as tensors
+        on the inference device and batch is the network input of size [n, 3, max_size, max_size].
 
-                    text_pt = (x1, y1 - 3)
-                    text_color = [255, 255, 255]
+        uint8 numpy images (what cv2 gives you) take a zero-copy path: the frames just wrap the
+        caller's buffers on the CPU (on the GPU they are uploaded as uint8) and FastUint8Transform
+        writes the batch into a reusable tensor that is only valid until the next call.
+        Anything else goes through FastBaseTransform as a float tensor.
+        """
+        if all(isinstance(img, np.ndarray) and img.dtype == np.uint8 for img in images):
+            frames = [torch.from_numpy(img if img.flags.c_contiguous else np.ascontiguousarray(img)).to(self.device)
+                      for img in images]
+            return frames, self.uint8_transform(frames)
 
-                    cv2.rectangle(img_numpy, (x1, y1),
-                                  (x1 + text_w, y1 - text_h - 4), color, -1)
-                    cv2.putText(img_numpy, text_str, text_pt, font_face,
-                                font_scale, text_color, font_thickness, cv2.LINE_AA)
+        frames = [torch.Tensor(img).to(self.device).float() for img in images]
 
-        return (img_numpy, classes, scores, masks)
+        if all(frame.shape == frames[0].shape for frame in frames):
+            batch = self.transform(torch.stack(frames, 0))
+        else:
+            batch = torch.cat([self.transform(frame.unsqueeze(0)) for frame in frames], 0)
+
+        return frames, batch
 
-    def predict(self, img, show=False):
-        frame = torch.Tensor(img).cuda().float()
-        batch = FastBaseTransform()(frame.unsqueeze(0))
+    def predict(self, img, show=False, render=True):
+        """
+        Returns a dict with the rendered image ("img"), classes, scores and masks of img, or None if
+        nothing was detected. With render=False nothing is drawn and the structured detections of
+        make_detections are returned instead (empty arrays if nothing was detected).
+        """
+        frames, batch = self.ingest([img])
 
         extras = {"backbone": "full", "interrupt": False,
                   "keep_statistics": False, "moving_statistics": None}
 
-        with torch.no_grad():
+        with torch.no_grad(), arena.env(self.arena):
             preds = self.net(batch, extras=extras)["pred_outs"]
 
             out = self.prep_output(
-                preds, frame, None, None, undo_transform=False)
+                preds, frames[0], None, None, undo_transform=False, render=render)
+
+        return self.make_result(out, show) if render else out
+
+    def predict_batch(self, images, show=False, render=True):
+        """
+        Runs a single forward pass over a list of HWC BGR images and returns a list with one
+        predict()-style result per image (None for images without detections).
+
+        Every frame is resized to cfg.max_size exactly like in predict(), so frames of different
+        sizes can share a batch and each result matches what predict() returns for that frame.
+        With TensorRT, len(images) must not exceed the --trt_batch_size the model was built for.
+        render is the same as in predict().
+        """
+        if len(images) == 0:
+            return []
+
+        frames, batch = self.ingest(images)
+
+        extras = {"backbone": "full", "interrupt": False,
+                  "keep_statistics": False, "moving_statistics": None}
+
+        with torch.no_grad(), arena.env(self.arena):
+            preds = self.net(batch, extras=extras)["pred_outs"]
 
+            outs = [self.prep_output(preds, frame, None, None, undo_transform=False, batch_idx=idx, render=render)
+                    for idx, frame in enumerate(frames)]
+
+        return [self.make_result(out, show) for out in outs] if render else outs
+
+    def make_result(self, out, show=False):
+        """ Turns a rendered prep_output result into predict()'s dict (None if nothing was detected). """
         if out == None:
             print("No predictions!")
             return None
@@ -308,4 +434,75 @@ class YOLACTEdgeInference(object):
             plt.title("YOLACT Edge Predictions")
             plt.show()
 
-        return {"img": img_numpy, "class": classes, "score": scores, "mask": masks.squeeze()}
\ No newline at end of file
+        return {"img": img_numpy, "class": classes, "score": scores, "mask": masks.squeeze()}
+
+    def benchmark(self, img, samples=200, warmup=10, render=True):
+        """
+        Times predict() on img and returns (fps, ms per frame) averaged over samples runs.
+        The first warmup runs are not timed so that one-off allocations don't skew the result.
+        """
+        for _ in range(warmup):
+            self.predict(img, False, render=render)
+        self.synchronize()
+
+        start = time.perf_counter()
+        for _ in range(samples):
+            self.predict(img, False, render=render)
+        self.synchronize()
+        avg_seconds = (time.perf_counter() - start) / samples
+
+        print("%s%s: %5.2f fps, %5.2f ms" % (self.device.type.upper(), "" if render else " (results only)",
+                                              1 / avg_seconds, 1000 * avg_seconds))
+        return 1 / avg_seconds, 1000 * avg_seconds
+
+    def benchmark_render(self, img, samples=200, warmup=10):
+        """ Benchmarks predict() with and without rendering and returns the ms per frame that render=False saves. """
+        _, render_ms = self.benchmark(img, samples, warmup, render=True)
+        _, results_ms = self.benchmark(img, samples, warmup, render=False)
+
+        print("Skipping rendering saves %5.2f ms per frame (%4.1f%%)" % (render_ms - results_ms,
+                                                                      100 * (render_ms - results_ms) / render_ms))
+        return render_ms - results_ms
+
+    def allocation_report(self, img, frames=10, warmup=3, render=True):
+        """
+        Counts the tensor allocations predict() makes per frame with the PyTorch profiler,
+        after warmup frames so that one-off allocations (and filling the arena) aren't counted.
+        Returns (allocations per frame, MB allocated per frame).
+        """
+        from torch.profiler import profile, ProfilerActivity
+
+        for _ in range(warmup):
+            self.predict(img, render=render)
+        self.synchronize()
+
+        activities = [ProfilerActivity.CPU]
+        if self.device.type == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+
+        with profile(activities=activities, profile_memory=True) as prof:
+            for _ in range(frames):
+                self.predict(img, render=render)
+            self.synchronize()
+
+        # Every op that allocates gets the memory attributed to it (frees are negative)
+        allocations = 0
+        allocated = 0
+        for event in prof.events():
+            size = max(event.self_cpu_memory_usage,
+                       getattr(event, 'self_device_memory_usage', getattr(event, 'self_cuda_memory_usage', 0)))
+            if size > 0:
+                allocations += 1
+                allocated += size
+
+        allocations /= frames
+        allocated_mb = allocated / frames / 1024 / 1024
+
+        print("%s%s: %.1f allocations (%.2f MB) per frame" % (
+            "Steady state" if self.arena is not None else "Default", "" if render else " (results only)",
+            allocations, allocated_mb))
+        if self.arena is not None:
+            print("Arena: %d buffers, %.2f MB, %d (re)allocations in total" % (
+                len(self.arena.buffers), self.arena.nbytes() / 1024 / 1024, self.arena.allocations))
+
+        return allocations, allocated_mb
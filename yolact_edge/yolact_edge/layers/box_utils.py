@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 import torch
-from yolact_edge.utils import timer
+from yolact_edge.utils import timer, arena
 from yolact_edge.data import cfg
 
 @torch.jit.script
@@ -79,6 +79,34 @@ def jaccard(box_a, box_b, iscrowd:bool=False):
     out = inter / area_a if iscrowd else inter / union
     return out if use_batch else out.squeeze(0)
 
+def self_jaccard(boxes, capacity=None):
+    """
+    Same as jaccard(boxes, boxes) for boxes of shape [n, A, 4], but the [n, A, A] intermediates
+    come from the active tensor arena (see utils/arena.py). capacity is passed on to the arena.
+    Note: the result is an arena buffer too, so it's overwritten by the next call.
+    """
+    n, A, _ = boxes.size()
+    x1, y1, x2, y2 = [boxes[:, :, i] for i in range(4)]
+
+    inter = arena.empty('self_jaccard.inter', (n, A, A), dtype=boxes.dtype, device=boxes.device, capacity=capacity)
+    tmp_a = arena.empty('self_jaccard.tmp_a', (n, A, A), dtype=boxes.dtype, device=boxes.device, capacity=capacity)
+    tmp_b = arena.empty('self_jaccard.tmp_b', (n, A, A), dtype=boxes.dtype, device=boxes.device, capacity=capacity)
+
+    # Intersection width times height
+    torch.min(x2[:, :, None], x2[:, None, :], out=inter)
+    torch.max(x1[:, :, None], x1[:, None, :], out=tmp_a)
+    inter.sub_(tmp_a).clamp_(min=0)
+    torch.min(y2[:, :, None], y2[:, None, :], out=tmp_a)
+    torch.max(y1[:, :, None], y1[:, None, :], out=tmp_b)
+    inter.mul_(tmp_a.sub_(tmp_b).clamp_(min=0))
+
+    # Union
+    area = (x2 - x1) * (y2 - y1)
+    torch.add(area[:, :, None], area[:, None, :], out=tmp_a)
+    tmp_a.sub_(inter)
+
+    return inter.div_(tmp_a)
+
 def elemwise_box_iou(box_a, box_b):
     """ Does the same as above but instead of pairwise, elementwise along the inner dimension. """
     max_xy = torch.min(box_a[:, 2:], box_b[:, 2:])
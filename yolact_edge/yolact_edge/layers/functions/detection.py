@@ -1,7 +1,7 @@
 import torch
 import torch.nn.functional as F
-from ..box_utils import decode, jaccard, index2d
-from yolact_edge.utils import timer
+from ..box_utils import decode, jaccard, self_jaccard, index2d
+from yolact_edge.utils import timer, arena
 
 from yolact_edge.data import cfg, mask_type
 
@@ -68,7 +68,9 @@ class Detect(object):
             batch_size = loc_data.size(0)
             num_priors = prior_data.size(0)
 
-            conf_preds = conf_data.view(batch_size, num_priors, self.num_classes).transpose(2, 1).contiguous()
+            conf_preds = arena.empty('detect.conf_preds', (batch_size, self.num_classes, num_priors),
+                                     dtype=conf_data.dtype, device=conf_data.device)
+            conf_preds.copy_(conf_data.view(batch_size, num_priors, self.num_classes).transpose(2, 1))
 
             for batch_idx in range(batch_size):
                 decoded_boxes = decode(loc_data[batch_idx], prior_data)
@@ -174,7 +176,7 @@ class Detect(object):
         boxes = boxes[idx.view(-1), :].view(num_classes, num_dets, 4)
         masks = masks[idx.view(-1), :].view(num_classes, num_dets, -1)
 
-        iou = jaccard(boxes, boxes)
+        iou = self_jaccard(boxes, capacity=num_classes * top_k * top_k)
         iou.triu_(diagonal=1)
         iou_max, _ = iou.max(dim=1)
 
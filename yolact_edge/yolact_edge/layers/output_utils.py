@@ -1,6 +1,7 @@
 """ Contains functions used to sanitize and prepare the output of Yolact. """
 
 
+import numbers
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -9,11 +10,11 @@ import cv2
 
 from yolact_edge.data import cfg, mask_type, MEANS, STD, activation_func
 from yolact_edge.utils.augmentations import Resize
-from yolact_edge.utils import timer
+from yolact_edge.utils import timer, arena
 from .box_utils import crop, sanitize_coordinates, center_size
 
 def postprocess(det_output, w, h, batch_idx=0, interpolation_mode='bilinear',
-                visualize_lincomb=False, crop_masks=True, score_threshold=0):
+                visualize_lincomb=False, crop_masks=True, score_threshold=0, lazy_masks=False):
     """
     Postprocesses the output of Yolact on testing mode into a format that makes sense,
     accounting for all the possible configuration settings.
@@ -24,12 +25,13 @@ def postprocess(det_output, w, h, batch_idx=0, interpolation_mode='bilinear',
         - h: The real height of the image.
         - batch_idx: If you have multiple images for this batch, the image's index in the batch.
         - interpolation_mode: Can be 'nearest' | 'area' | 'bilinear' (see torch.nn.functional.interpolate)
+        - lazy_masks: If the masks are lincomb masks, return a LazyMasks instead of computing them all.
 
     Returns 4 torch Tensors (in the following order):
         - classes [num_det]: The class idx for each detection.
         - scores  [num_det]: The confidence score for each detection.
         - boxes   [num_det, 4]: The bounding box for each detection in absolute point form.
-        - masks   [num_det, h, w]: Full image masks for each detection.
+        - masks   [num_det, h, w]: Full image masks for each detection (or a LazyMasks, see above).
     """
     
     dets = det_output[batch_idx]
@@ -87,31 +89,53 @@ def postprocess(det_output, w, h, batch_idx=0, interpolation_mode='bilinear',
         if visualize_lincomb:
             display_lincomb(proto_data, masks)
 
-        masks = proto_data @ masks.t()
-        masks = cfg.mask_proto_mask_activation(masks)
-
-        # Crop masks before upsampling because you know why
-        if crop_masks:
-            masks = crop(masks, boxes)
-
-        # Permute into the correct output shape [num_dets, proto_h, proto_w]
-        masks = masks.permute(2, 0, 1).contiguous()
-
-        # Scale masks up to the full image
-        if cfg.preserve_aspect_ratio:
-            # Undo padding
-            masks = masks[:, :int(r_h/cfg.max_size*proto_data.size(1)), :int(r_w/cfg.max_size*proto_data.size(2))]
+        if lazy_masks:
+            # Keep the relative boxes around for cropping since they get sanitized in place below
+            masks = LazyMasks(proto_data, masks, boxes.clone(), h, w, crop_masks=crop_masks,
+                              interpolation_mode=interpolation_mode,
+                              proto_extent=(int(r_h/cfg.max_size*proto_data.size(1)), int(r_w/cfg.max_size*proto_data.size(2)))
+                                           if cfg.preserve_aspect_ratio else None)
+        else:
+            proto_h, proto_w, _ = proto_data.size()
+            num_dets = masks.size(0)
+            max_numel = proto_h * proto_w * max(num_dets, cfg.max_num_detections)
+
+            masks = torch.matmul(proto_data, masks.t(), out=arena.empty(
+                'postprocess.masks', (proto_h, proto_w, num_dets), dtype=proto_data.dtype,
+                device=proto_data.device, capacity=max_numel))
+
+            if cfg.mask_proto_mask_activation is activation_func.sigmoid:
+                # Nothing else needs the raw product, so this can go in place
+                masks.sigmoid_()
+            else:
+                masks = cfg.mask_proto_mask_activation(masks)
+
+            # Crop masks before upsampling because you know why
+            if crop_masks:
+                masks = crop(masks, boxes)
+
+            # Permute into the correct output shape [num_dets, proto_h, proto_w]
+            masks = arena.empty('postprocess.masks_permuted', (num_dets, proto_h, proto_w), dtype=masks.dtype,
+                                device=masks.device, capacity=max_numel).copy_(masks.permute(2, 0, 1))
+
+            # Scale masks up to the full image
+            if cfg.preserve_aspect_ratio:
+                # Undo padding
+                masks = masks[:, :int(r_h/cfg.max_size*proto_data.size(1)), :int(r_w/cfg.max_size*proto_data.size(2))]
         
-        masks = F.interpolate(masks.unsqueeze(0), (h, w), mode=interpolation_mode, align_corners=False).squeeze(0)
+            masks = F.interpolate(masks.unsqueeze(0), (h, w), mode=interpolation_mode, align_corners=False).squeeze(0)
 
-        # Binarize the masks
-        masks.gt_(0.5)
+            # Binarize the masks
+            masks.gt_(0.5)
 
     
     boxes[:, 0], boxes[:, 2] = sanitize_coordinates(boxes[:, 0], boxes[:, 2], b_w, cast=False)
     boxes[:, 1], boxes[:, 3] = sanitize_coordinates(boxes[:, 1], boxes[:, 3], b_h, cast=False)
     boxes = boxes.long()
 
+    if isinstance(masks, LazyMasks):
+        masks.boxes = boxes
+
     if cfg.mask_type == mask_type.direct and cfg.eval_mask_branch:
         # Upscale masks
         full_masks = torch.zeros(masks.size(0), h, w)
@@ -139,6 +163,115 @@ def postprocess(det_output, w, h, batch_idx=0, interpolation_mode='bilinear',
     
 
 
+class LazyMasks(object):
+    """
+    Holds what it takes to assemble lincomb masks (the prototypes and each detection's coefficients
+    and box) and only builds a mask once somebody actually asks for it.
+
+    Indexing (masks[i], masks[:k], masks[keep]) gives a LazyMasks of just those detections and is
+    free, so pick the detections you care about first. Then:
+        - masks.full():        [n, h, w] binary float masks, exactly what postprocess would return.
+        - masks.resized(h, w): [n, h, w] binary float masks at some other (usually lower) resolution.
+        - masks.cropped(i):    The full resolution binary mask of detection i inside its box only.
+        - np.asarray(masks):   full() as a boolean numpy array.
+
+    Only the prototype sized masks of the selected detections are ever computed, plus whatever
+    output resolution was asked for.
+    """
+
+    def __init__(self, proto, coeffs, rel_boxes, h, w, crop_masks=True, interpolation_mode='bilinear',
+                 proto_extent=None, boxes=None):
+        self.proto = proto              # [proto_h, proto_w, mask_dim]
+        self.coeffs = coeffs            # [n, mask_dim]
+        self.rel_boxes = rel_boxes      # [n, 4] relative point form, used for cropping
+        self.boxes = boxes              # [n, 4] absolute point form (filled in by postprocess)
+        self.h, self.w = h, w
+        self.crop_masks = crop_masks
+        self.interpolation_mode = interpolation_mode
+        self.proto_extent = proto_extent # The unpadded part of the prototypes with preserve_aspect_ratio
+
+    def __len__(self):
+        return self.coeffs.size(0)
+
+    @property
+    def shape(self):
+        """ The shape full() would have. """
+        return (len(self), self.h, self.w)
+
+    def __getitem__(self, idx):
+        # numpy integers (from argsort, say) too, which torch would otherwise index down a dimension with
+        if isinstance(idx, numbers.Integral):
+            idx = int(idx)
+            idx = slice(idx, idx + 1 if idx != -1 else None)
+
+        return LazyMasks(self.proto, self.coeffs[idx], self.rel_boxes[idx], self.h, self.w, self.crop_masks,
+                         self.interpolation_mode, self.proto_extent,
+                         self.boxes[idx] if self.boxes is not None else None)
+
+    def proto_masks(self):
+        """ Returns the soft masks of size [n, proto_h, proto_w] at prototype resolution. """
+        masks = self.proto @ self.coeffs.t()
+        masks = cfg.mask_proto_mask_activation(masks)
+
+        # Crop masks before upsampling because you know why
+        if self.crop_masks:
+            masks = crop(masks, self.rel_boxes)
+
+        masks = masks.permute(2, 0, 1).contiguous()
+
+        if self.proto_extent is not None:
+            # Undo padding
+            masks = masks[:, :self.proto_extent[0], :self.proto_extent[1]]
+
+        return masks
+
+    def resized(self, h, w):
+        """ Returns the binarized masks scaled to [n, h, w]. """
+        if len(self) == 0:
+            return torch.zeros(0, h, w, device=self.coeffs.device)
+
+        masks = F.interpolate(self.proto_masks().unsqueeze(0), (h, w), mode=self.interpolation_mode,
+                              align_corners=False).squeeze(0)
+        return masks.gt_(0.5)
+
+    def full(self):
+        return self.resized(self.h, self.w)
+
+    def cropped(self, i):
+        """
+        Returns detection i's full resolution mask inside its box as a [y2-y1, x2-x1] tensor and the
+        box (x1, y1, x2, y2) it covers, without building the rest of the full image mask.
+        """
+        x1, y1, x2, y2 = [int(x) for x in self.boxes[i]]
+
+        if self.interpolation_mode != 'bilinear':
+            return self[i].full()[0, y1:y2, x1:x2], (x1, y1, x2, y2)
+
+        masks = self[i].proto_masks()
+        _, proto_h, proto_w = masks.size()
+        device = masks.device
+
+        # Where F.interpolate(align_corners=False) would sample each pixel of the box from in the full
+        # image mask, converted to the normalized coordinates of grid_sample. The border padding mode
+        # clamps these the same way F.interpolate does at the edges.
+        ys = (torch.arange(y1, y2, device=device, dtype=torch.float32) + 0.5) * (proto_h / self.h) - 0.5
+        xs = (torch.arange(x1, x2, device=device, dtype=torch.float32) + 0.5) * (proto_w / self.w) - 0.5
+        gy = (2 * ys + 1) / proto_h - 1
+        gx = (2 * xs + 1) / proto_w - 1
+        grid = torch.stack([gx[None, :].expand(len(gy), len(gx)), gy[:, None].expand(len(gy), len(gx))], dim=-1)
+
+        mask = F.grid_sample(masks.unsqueeze(0), grid.unsqueeze(0), mode='bilinear', padding_mode='border',
+                             align_corners=False)[0, 0]
+        return mask.gt_(0.5), (x1, y1, x2, y2)
+
+    def numpy(self):
+        return self.full().bool().cpu().numpy()
+
+    def __array__(self, dtype=None, copy=None):
+        masks = self.numpy()
+        return masks if dtype is None else masks.astype(dtype)
+
+
 def undo_image_transformation(img, w, h):
     """
     Takes a transformed image tensor and returns a numpy ndarray that is untransformed.
@@ -0,0 +1,246 @@
+"""
+Serves several video streams (e.g. the cameras of a vehicle) with one model.
+
+Every stream keeps its own flow state: the keyframe features the partial backbone warps from and
+a KeyframeScheduler deciding when to refresh them. Each step takes the newest frame of every
+stream and runs at most two forward passes no matter how many streams there are: one full pass
+over the streams that are due a keyframe, and one partial pass over the rest, with the keyframe
+features of those streams concatenated along the batch dimension. Flow warping works on every
+batch element independently, so each stream only ever sees its own keyframe.
+
+To run it on cameras and/or video files:
+    python -m yolact_edge.multistream --trained_model=weights/yolact_edge_resnet50_54_800000.pth \\
+        --config=yolact_edge_resnet50_config --streams=0,1,path/to/video.mp4 --display
+"""
+
+import argparse
+import time
+from collections import deque
+from queue import Empty
+
+import cv2
+import numpy as np
+import torch
+
+from yolact_edge.data.config import cfg
+from yolact_edge.utils.functions import MovingAverage
+from yolact_edge.utils.keyframes import FixedKeyframeScheduler, AdaptiveKeyframeScheduler
+from yolact_edge.utils.pipeline import FrameGrabber
+
+
+class StreamState(object):
+    """ Flow state and latency counters of one stream. """
+
+    def __init__(self, stream_id, scheduler, window=1000):
+        self.stream_id = stream_id
+        self.scheduler = scheduler
+        self.feats = None
+        self.lateral = None
+        self.next_idx = 0
+
+        self.frames = 0
+        self.keyframes = 0
+        self.latency = MovingAverage(100)
+        self.latencies = deque(maxlen=window)
+
+    def get_stats(self):
+        latencies = np.array(self.latencies) if len(self.latencies) > 0 else np.zeros(1)
+        p50, p99 = np.percentile(latencies, (50, 99))
+        return {
+            'frames': self.frames,
+            'keyframes': self.keyframes,
+            'latency_ms': 1000 * self.latency.get_avg(),
+            'p50_ms': 1000 * p50,
+            'p99_ms': 1000 * p99,
+        }
+
+
+class MultiStreamInference(object):
+    """
+    Runs model (a YOLACTEdgeInference) over frames from several streams, see the module docstring.
+
+    make_scheduler(stream_id) returns the KeyframeScheduler of a new stream, by default a keyframe
+    every 5 frames. With TensorRT, the number of streams must not exceed the --trt_batch_size the
+    model was built for. The steady-state arena of model isn't used, since the two passes of a
+    step would share its buffers.
+    """
+
+    def __init__(self, model, make_scheduler=None):
+        self.model = model
+        self.make_scheduler = make_scheduler if make_scheduler is not None else (lambda stream_id: FixedKeyframeScheduler(5))
+        self.streams = {}
+
+    def stream(self, stream_id):
+        if stream_id not in self.streams:
+            self.streams[stream_id] = StreamState(stream_id, self.make_scheduler(stream_id))
+        return self.streams[stream_id]
+
+    def reset(self, stream_id):
+        """ Drops the flow state of a stream, e.g. after its camera reconnected. """
+        self.streams.pop(stream_id, None)
+
+    def predict(self, frames, frame_indices=None, capture_times=None, render=False):
+        """
+        frames maps stream ids to the newest HWC BGR image of that stream. Streams without a new
+        frame are simply left out. Returns a dict with a result per stream: make_detections' dict,
+        or with render=True a predict()-style dict (None without detections).
+
+        frame_indices gives the index of each frame within its stream, for streams that drop
+        frames (by default they're numbered consecutively). Latency is measured from the
+        capture_times given (time.perf_counter() values) or else from this call.
+        """
+        start_time = time.perf_counter()
+        stream_ids = list(frames.keys())
+        if len(stream_ids) == 0:
+            return {}
+
+        imgs, batch = self.model.ingest([frames[stream_id] for stream_id in stream_ids])
+        use_flow = cfg.flow is not None and cfg.flow.warp_mode != 'none'
+
+        full, partial = [], []
+        for idx, stream_id in enumerate(stream_ids):
+            state = self.stream(stream_id)
+            frame_idx = frame_indices[stream_id] if frame_indices is not None else state.next_idx
+            state.next_idx = frame_idx + 1
+
+            keyframe = state.scheduler.decide(frame_idx, [imgs[idx]])
+            (full if keyframe or not use_flow or state.feats is None else partial).append(idx)
+
+        results = {}
+
+        with torch.no_grad():
+            if len(full) > 0:
+                extras = {"backbone": "full", "interrupt": False, "keep_statistics": use_flow,
+                          "moving_statistics": {"conf_hist": []}}
+                net_outs = self.model.net(batch[full], extras=extras)
+
+                if use_flow:
+                    for j, idx in enumerate(full):
+                        state = self.streams[stream_ids[idx]]
+                        # Copies, so the batch they came from can be freed
+                        state.feats = [feat[j:j + 1].clone() for feat in net_outs["feats"]]
+                        state.lateral = net_outs["lateral"][j:j + 1].clone()
+                        state.keyframes += 1
+
+                self._finish(stream_ids, full, imgs, net_outs["pred_outs"], render, results)
+
+            if len(partial) > 0:
+                states = [self.streams[stream_ids[idx]] for idx in partial]
+                moving_statistics = {
+                    "feats": [torch.cat(level, 0) for level in zip(*[state.feats for state in states])],
+                    "lateral": torch.cat([state.lateral for state in states], 0),
+                    "conf_hist": [],
+                }
+                extras = {"backbone": "partial", "interrupt": False, "keep_statistics": False,
+                          "moving_statistics": moving_statistics}
+                net_outs = self.model.net(batch[partial], extras=extras)
+
+                self._finish(stream_ids, partial, imgs, net_outs["pred_outs"], render, results)
+
+        for stream_id in stream_ids:
+            state = self.streams[stream_id]
+            since = capture_times[stream_id] if capture_times is not None else start_time
+            latency = results[stream_id][1] - since
+            state.latency.add(latency)
+            state.latencies.append(latency)
+            state.frames += 1
+
+        return {stream_id: result for stream_id, (result, _) in results.items()}
+
+    def _finish(self, stream_ids, group, imgs, preds, render, results):
+        """ Prepares the outputs of one forward pass, which covered the streams at the indices in group. """
+        for j, idx in enumerate(group):
+            stream_id = stream_ids[idx]
+            self.streams[stream_id].scheduler.observe([preds[j]])
+
+            out = self.model.prep_output(preds, imgs[idx], None, None, undo_transform=False, batch_idx=j, render=render)
+            result = self.model.make_result(out) if render and out is not None else out
+            results[stream_id] = (result, time.perf_counter())
+
+    def get_stats(self):
+        return {stream_id: state.get_stats() for stream_id, state in self.streams.items()}
+
+    def format_stats(self):
+        lines = ['%-20s %8s %9s %12s %8s %8s' % ('Stream', 'Frames', 'Keyframes', 'Latency (ms)', 'p50', 'p99')]
+        for stream_id, stats in self.get_stats().items():
+            lines.append('%-20s %8d %9d %12.2f %8.2f %8.2f' % (
+                stream_id, stats['frames'], stats['keyframes'], stats['latency_ms'], stats['p50_ms'], stats['p99_ms']))
+        return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='YOLACT Edge multi-stream inference')
+    parser.add_argument('--trained_model', required=True, type=str,
+                        help='Trained state_dict file path to open.')
+    parser.add_argument('--config', required=True, type=str,
+                        help='The config object to use.')
+    parser.add_argument('--dataset', default='coco2017_dataset', type=str,
+                        help='The dataset whose class names are reported.')
+    parser.add_argument('--streams', required=True, type=str,
+                        help='Comma-separated webcam indices and/or video files.')
+    parser.add_argument('--keyframe_scheduler', default='fixed', choices=['fixed', 'adaptive'], type=str,
+                        help='Keyframe scheduler of every stream, see utils/keyframes.py.')
+    parser.add_argument('--keyframe_interval', default=5, type=int,
+                        help='Frames between keyframes with --keyframe_scheduler=fixed.')
+    parser.add_argument('--display', default=False, dest='display', action='store_true',
+                        help='Show every stream in its own window.')
+    return parser.parse_known_args(argv)[0]
+
+
+if __name__ == '__main__':
+    from yolact_edge.inference import YOLACTEdgeInference
+
+    stream_args = parse_args()
+    sources = stream_args.streams.split(',')
+
+    model = YOLACTEdgeInference(stream_args.trained_model, stream_args.config, stream_args.dataset, None,
+                                args_ovr={'trt_batch_size': len(sources)})
+    if stream_args.keyframe_scheduler == 'fixed':
+        runner = MultiStreamInference(model, lambda stream_id: FixedKeyframeScheduler(stream_args.keyframe_interval))
+    else:
+        runner = MultiStreamInference(model, lambda stream_id: AdaptiveKeyframeScheduler())
+
+    grabbers = {}
+    for source in sources:
+        vid = cv2.VideoCapture(int(source)) if source.isdigit() else cv2.VideoCapture(source)
+        if not vid.isOpened():
+            print('Could not open stream "%s"' % source)
+            exit(-1)
+        vid.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        grabbers[source] = FrameGrabber(vid, fps=None if source.isdigit() else vid.get(cv2.CAP_PROP_FPS))
+        grabbers[source].start()
+
+    try:
+        while len(grabbers) > 0:
+            frames, frame_indices, capture_times = {}, {}, {}
+            for source, grabber in list(grabbers.items()):
+                try:
+                    grabbed = grabber.get(timeout=0)
+                except Empty:
+                    continue
+                if grabbed is None:
+                    del grabbers[source]
+                    continue
+                frame_indices[source], capture_times[source], frames[source] = grabbed
+
+            if len(frames) == 0:
+                time.sleep(0.001)
+                continue
+
+            results = runner.predict(frames, frame_indices, capture_times, render=stream_args.display)
+
+            if stream_args.display:
+                for source, result in results.items():
+                    cv2.imshow(source, result['img'] if result is not None else frames[source])
+                if cv2.waitKey(1) == 27:  # Press Escape to exit
+                    break
+            else:
+                print('\r' + ' | '.join('%s %.1f ms' % (source, stats['latency_ms'])
+                                        for source, stats in runner.get_stats().items()) + '    ', end='')
+    except KeyboardInterrupt:
+        pass
+
+    for grabber in grabbers.values():
+        grabber.stop()
+    print()
+    print(runner.format_stats())
@@ -0,0 +1,301 @@
+"""
+Process-pool CPU inference: a single network can't keep a many-core host busy, so this runs one
+YOLACTEdgeInference per worker process, each pinned to its own share of the cores.
+
+The weights are loaded once in the parent and put in shared memory, and every worker points its
+network at them (see Yolact.use_shared_weights), so the pool costs one copy of the weights no
+matter how many workers it has. Frames are handed over through per-worker shared-memory slots
+instead of being pickled, and results come back in the order the frames went in.
+
+Workers are started with spawn, so scripts using InferencePool need an
+if __name__ == '__main__': guard. To run it over an image folder:
+    python -m yolact_edge.pool --trained_model=weights/yolact_edge_resnet50_54_800000.pth \\
+        --config=yolact_edge_resnet50_config --images=path/to/images
+"""
+
+import argparse
+import os
+import time
+import traceback
+from collections import deque
+from queue import Empty
+
+import cv2
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from yolact_edge.data.config import cfg, set_cfg
+from yolact_edge.yolact import Yolact
+
+
+def _worker(worker_id, cores, weights, slots, model_kwargs, render, tasks, results):
+    if cores is not None:
+        # Pin before torch sizes its thread pools so they match the cores we're given
+        os.sched_setaffinity(0, cores)
+
+    try:
+        from yolact_edge.inference import YOLACTEdgeInference
+        model = YOLACTEdgeInference(weights, device='cpu', num_threads=len(cores) if cores is not None else None,
+                                    **model_kwargs)
+    except Exception:
+        results.put(('error', worker_id, None, traceback.format_exc()))
+        return
+    results.put(('ready', worker_id, None, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        seq, slot, shape = task
+        # A view straight into the shared slot, so the frame is never copied on this side
+        img = slots[slot, :int(np.prod(shape))].view(*shape).numpy()
+
+        try:
+            result = model.predict(img, render=render)
+            if result is not None and result['mask'] is not None:
+                result['mask'] = np.asarray(result['mask'].cpu() if torch.is_tensor(result['mask']) else result['mask'])
+            results.put(('result', worker_id, seq, result))
+        except Exception:
+            results.put(('error', worker_id, seq, traceback.format_exc()))
+
+
+class WorkerDied(RuntimeError):
+    """ Raised when a worker process exits while the pool is waiting on it. """
+    pass
+
+
+class InferencePool(object):
+    """
+    Runs predict() over frames with num_workers CPU processes and returns results in input order.
+
+    The cores this process may run on are split into num_workers contiguous chunks (cores_per_worker
+    each, by default 4) and every worker is pinned to its chunk with one intra-op thread per core.
+    Each worker gets slots_per_worker shared frame buffers of max_frame_size bytes, which is also
+    how many frames it can have queued. Frames must be HWC BGR uint8 arrays, like cv2 gives you.
+
+    With render=False (the default) each result is a make_detections dict with the masks as a
+    boolean numpy array. With render=True it's predict()'s dict (or None without detections).
+    model_kwargs (config_ovr, args_ovr, compile_cache, ...) are passed on to YOLACTEdgeInference.
+    compile_cache gives every worker a private copy of the weights, since frozen graphs inline them.
+    """
+
+    def __init__(self, weights, model_config, dataset, num_workers=None, cores_per_worker=None,
+                 slots_per_worker=2, max_frame_size=1920 * 1080 * 3, render=False, config_ovr={}, **model_kwargs):
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else None
+        num_cores = len(cores) if cores is not None else (os.cpu_count() or 1)
+
+        if num_workers is None:
+            num_workers = max(1, num_cores // (cores_per_worker if cores_per_worker is not None else 4))
+        if cores_per_worker is None:
+            cores_per_worker = max(1, num_cores // num_workers)
+
+        if cores is not None and num_workers * cores_per_worker <= num_cores:
+            worker_cores = [cores[i * cores_per_worker:(i + 1) * cores_per_worker] for i in range(num_workers)]
+        else:
+            # More threads than cores asked for, so leave the scheduling to the OS
+            worker_cores = [None] * num_workers
+
+        print("Loading shared weights for %d workers..." % num_workers)
+        self.shared_weights = self.load_shared_weights(weights, model_config, config_ovr)
+
+        self.num_workers = num_workers
+        self.slots_per_worker = slots_per_worker
+        self.max_frame_size = max_frame_size
+
+        ctx = mp.get_context('spawn')
+        self.results = ctx.Queue()
+        self.tasks = []
+        self.slots = []
+        self.workers = []
+
+        model_kwargs = dict(model_kwargs, model_config=model_config, dataset=dataset, calib_images=None,
+                            config_ovr=config_ovr)
+
+        for worker_id in range(num_workers):
+            slots = torch.zeros((slots_per_worker, max_frame_size), dtype=torch.uint8).share_memory_()
+            tasks = ctx.Queue()
+            worker = ctx.Process(target=_worker, daemon=True,
+                                 args=(worker_id, worker_cores[worker_id], self.shared_weights, slots, model_kwargs,
+                                       render, tasks, self.results))
+            worker.start()
+
+            self.slots.append(slots)
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+
+        for _ in range(num_workers):
+            try:
+                status, worker_id, _, error = self._get_result()
+            except RuntimeError:
+                self.close()
+                raise
+            if status == 'error':
+                self.close()
+                raise RuntimeError("Worker %d failed to start:\n%s" % (worker_id, error))
+
+        # The frame buffers of each worker that aren't holding a queued frame
+        self.free_slots = [deque(range(slots_per_worker)) for _ in range(num_workers)]
+        # Sequence numbers run on across imap calls, and in_flight maps every queued frame's to its
+        # (worker, slot), so results left over from a call that stopped early are never taken for
+        # another call's
+        self.next_seq = 0
+        self.in_flight = {}
+        print("Inference pool ready with %d workers..." % num_workers)
+
+    @staticmethod
+    def load_shared_weights(weights, model_config, config_ovr):
+        """ Loads weights into a Yolact once and returns its state_dict, moved into shared memory. """
+        set_cfg(model_config)
+        cfg.replace(cfg.copy(config_ovr))
+
+        net = Yolact(training=False)
+        net.load_weights(weights)
+        net.eval()
+        net.share_memory()
+        return net.state_dict()
+
+    def _check_frame(self, img):
+        if img.dtype != np.uint8 or img.ndim != 3:
+            raise ValueError("InferencePool takes HWC uint8 frames, got %s %s" % (img.dtype, img.shape))
+        if img.size > self.max_frame_size:
+            raise ValueError("Frame of %d bytes doesn't fit in max_frame_size=%d" % (img.size, self.max_frame_size))
+
+    def _dispatch(self, img):
+        """ Queues img on the worker with the most free slots and returns its sequence number. """
+        # The worker with the most free slots has the shortest queue
+        worker_id = max(range(self.num_workers), key=lambda i: len(self.free_slots[i]))
+        slot = self.free_slots[worker_id].popleft()
+
+        seq = self.next_seq
+        self.next_seq += 1
+        self.in_flight[seq] = (worker_id, slot)
+
+        self.slots[worker_id][slot, :img.size].numpy().reshape(img.shape)[...] = img
+        self.tasks[worker_id].put((seq, slot, img.shape))
+        return seq
+
+    def _get_result(self):
+        """ results.get(), but raises WorkerDied instead of waiting forever once a worker has died. """
+        while True:
+            try:
+                return self.results.get(timeout=1)
+            except Empty:
+                for worker_id, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        raise WorkerDied("Worker %d exited with code %s" % (worker_id, worker.exitcode))
+
+    def _collect(self, pending, done):
+        """
+        Waits for a result and frees its slot. Results of frames in pending go in done (or are
+        raised, for errors), anything else is left over from an earlier call and dropped.
+        """
+        status, worker_id, seq, result = self._get_result()
+        self.free_slots[worker_id].append(self.in_flight.pop(seq)[1])
+        if seq not in pending:
+            return
+        pending.remove(seq)
+
+        if status == 'error':
+            raise RuntimeError("Worker %d failed on frame %d:\n%s" % (worker_id, seq, result))
+        done[seq] = result
+
+    def imap(self, frames):
+        """
+        Yields the result for every frame in frames, in order. frames can be any iterable (a
+        generator reading cameras, say), and it's only consumed as fast as the workers keep up.
+        Interleave the frames of several cameras to share the pool between them.
+
+        If this stops early (a bad frame, a worker error or the caller not reading to the end),
+        the frames still queued are waited for and their results dropped. If a worker process dies,
+        WorkerDied is raised and the pool can't be used anymore.
+        """
+        order = deque()
+        pending = set()
+        done = {}
+
+        try:
+            for img in frames:
+                self._check_frame(img)
+                while not any(self.free_slots):
+                    self._collect(pending, done)
+                    while len(order) > 0 and order[0] in done:
+                        yield done.pop(order.popleft())
+
+                seq = self._dispatch(img)
+                order.append(seq)
+                pending.add(seq)
+
+            while len(order) > 0:
+                while order[0] not in done:
+                    self._collect(pending, done)
+                yield done.pop(order.popleft())
+        finally:
+            # Get the slots back, ignoring the errors of frames nobody will see
+            while len(pending) > 0:
+                try:
+                    self._collect(pending, done)
+                except WorkerDied:
+                    break
+                except RuntimeError:
+                    pass
+
+    def map(self, frames):
+        """ Returns the list of results for frames, see imap. """
+        return list(self.imap(frames))
+
+    def predict(self, img):
+        return self.map([img])[0]
+
+    def close(self):
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(timeout=10)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.tasks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='YOLACT Edge process-pool CPU inference')
+    parser.add_argument('--trained_model', required=True, type=str,
+                        help='Trained state_dict file path to open.')
+    parser.add_argument('--config', required=True, type=str,
+                        help='The config object to use.')
+    parser.add_argument('--dataset', default='coco2017_dataset', type=str,
+                        help='The dataset whose class names are reported.')
+    parser.add_argument('--images', required=True, type=str,
+                        help='A folder of images to run on.')
+    parser.add_argument('--num_workers', default=None, type=int,
+                        help='Number of worker processes. Defaults to one per --cores_per_worker cores.')
+    parser.add_argument('--cores_per_worker', default=None, type=int,
+                        help='Cores each worker is pinned to (4 if neither this nor --num_workers is set).')
+    parser.add_argument('--slots_per_worker', default=2, type=int,
+                        help='Frames each worker can have queued.')
+    return parser.parse_known_args(argv)[0]
+
+
+if __name__ == '__main__':
+    pool_args = parse_args()
+
+    paths = sorted(os.path.join(pool_args.images, name) for name in os.listdir(pool_args.images))
+    paths = [path for path in paths if os.path.splitext(path)[1].lower() in ('.jpg', '.jpeg', '.png', '.bmp')]
+
+    with InferencePool(pool_args.trained_model, pool_args.config, pool_args.dataset, num_workers=pool_args.num_workers,
+                       cores_per_worker=pool_args.cores_per_worker,
+                       slots_per_worker=pool_args.slots_per_worker) as pool:
+        start = time.perf_counter()
+        for path, result in zip(paths, pool.imap(cv2.imread(path) for path in paths)):
+            print('%s: %d detections' % (path, len(result['class'])))
+        elapsed = time.perf_counter() - start
+
+    print('%d images in %.2f s (%.2f fps)' % (len(paths), elapsed, len(paths) / max(elapsed, 1e-9)))
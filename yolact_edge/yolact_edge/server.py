@@ -0,0 +1,312 @@
+"""
+A small asyncio inference server that micro-batches concurrent requests into
+YOLACTEdgeInference.predict_batch calls.
+
+Run it with:
+    python -m yolact_edge.server --trained_model=weights/yolact_edge_resnet50_54_800000.pth \
+        --config=yolact_edge_resnet50_config --port=8000
+
+Then POST an encoded image (jpg, png, ...) to /predict. GET /stats returns the batching counters.
+Pass --unix_socket=/tmp/yolact.sock to listen on a Unix socket instead of TCP.
+"""
+
+import asyncio
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import cv2
+import numpy as np
+
+from yolact_edge.data import cfg
+
+
+class Overloaded(Exception):
+    """ Raised by MicroBatcher.submit when a request is shed instead of queued. """
+    pass
+
+
+class MicroBatcher:
+    """
+    Queues single-image requests and feeds them to one model worker in micro-batches.
+
+    A batch is closed as soon as it holds max_batch_size images or max_wait_ms has passed since
+    its first image was dequeued, whichever comes first. Under light load requests therefore pay
+    at most max_wait_ms of extra latency, and under heavy load batches fill up and the per-call
+    overhead of the network is shared by up to max_batch_size requests.
+
+    Admission control: once max_queue_size requests are waiting, new ones are rejected with
+    Overloaded right away rather than queued behind work they would time out on. Requests that
+    already waited longer than max_queue_delay_ms (or whose client went away) are shed when a
+    batch is formed so the model never runs on stale work.
+
+    model should have a predict_batch(images) method, like YOLACTEdgeInference. predict_kwargs
+    are passed on to every predict_batch call.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=5, max_queue_size=64, max_queue_delay_ms=1000,
+                 predict_kwargs={}):
+        self.model = model
+        self.predict_kwargs = predict_kwargs
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue_size = max_queue_size
+        self.max_queue_delay = max_queue_delay_ms / 1000
+
+        self.queue = None
+        self.worker = None
+        # The model is not thread safe, so all batches go through this single thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.stats = {'requests': 0, 'rejected': 0, 'shed': 0, 'batches': 0, 'images': 0,
+                      'max_batch': 0, 'busy_time': 0.0}
+
+    def start(self):
+        """ Starts the batching worker on the running event loop. """
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+        self.executor.shutdown(wait=True)
+
+    async def submit(self, img):
+        """ Queues img (an HWC BGR uint8 array) and waits for its predict_batch result. """
+        self.stats['requests'] += 1
+
+        if self.queue.qsize() >= self.max_queue_size:
+            self.stats['rejected'] += 1
+            raise Overloaded('%d requests already queued' % self.queue.qsize())
+
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, future, time.perf_counter()))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Drop whatever nobody is waiting for anymore or that has gone stale in the queue
+        now = time.perf_counter()
+        live = []
+        for img, future, enqueued in batch:
+            if future.done():
+                self.stats['shed'] += 1
+            elif now - enqueued > self.max_queue_delay:
+                self.stats['shed'] += 1
+                future.set_exception(Overloaded('Request waited %.0f ms in the queue' % (1000 * (now - enqueued))))
+            else:
+                live.append((img, future))
+        return live
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = await self._next_batch()
+            if len(batch) == 0:
+                continue
+
+            images = [img for img, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = await loop.run_in_executor(self.executor, partial(self.model.predict_batch, images,
+                                                                            **self.predict_kwargs))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.stats['busy_time'] += time.perf_counter() - start
+            self.stats['batches'] += 1
+            self.stats['images'] += len(batch)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queued'] = self.queue.qsize() if self.queue is not None else 0
+        stats['avg_batch'] = stats['images'] / max(stats['batches'], 1)
+        return stats
+
+
+##############################################
+# HTTP front-end
+##############################################
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large',
+            500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+def result_to_json(result):
+    """ Converts a predict(render=False) result into something json serializable (masks are dropped). """
+    return {'detections': [{'class': cfg.dataset.class_names[int(c)], 'score': float(s), 'box': [int(x) for x in b]}
+                           for c, s, b in zip(result['class'], result['score'], result['box'])]}
+
+async def _write_response(writer, status, body, extra_headers=()):
+    payload = json.dumps(body).encode('utf-8')
+    head = ['HTTP/1.1 %d %s' % (status, _reasons[status]),
+            'Content-Type: application/json',
+            'Content-Length: %d' % len(payload),
+            'Connection: close'] + list(extra_headers)
+    writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + payload)
+    await writer.drain()
+
+async def _submit_while_connected(batcher, reader, writer, img):
+    """
+    batcher.submit(img), but if the client's connection breaks first the request is cancelled (so
+    the batcher sheds it) and ConnectionError is raised. A client that only closed its side for
+    writing (end of file, with the transport still open) may still be waiting for the reply, so
+    its request goes ahead. A plain close looks the same until the reset, so only resets count.
+    """
+    request = asyncio.ensure_future(batcher.submit(img))
+    # Clients send nothing after the body, so the read only finishes once they close or reset
+    disconnect = asyncio.ensure_future(reader.read(1))
+    try:
+        await asyncio.wait([request, disconnect], return_when=asyncio.FIRST_COMPLETED)
+        if not request.done() and (disconnect.exception() is not None or writer.transport.is_closing()):
+            raise ConnectionError('Client disconnected')
+        return await request
+    finally:
+        request.cancel()
+        disconnect.cancel()
+
+def make_handler(batcher, max_body_size=32 * 1024 * 1024):
+    """ Returns an asyncio.start_server callback that serves POST /predict and GET /stats. """
+
+    async def handle(reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) < 2:
+                return
+            method, path = request_line[0], request_line[1]
+
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                key, _, value = line.partition(':')
+                headers[key.strip().lower()] = value.strip()
+
+            if method == 'GET' and path == '/stats':
+                await _write_response(writer, 200, batcher.get_stats())
+                return
+            if method != 'POST' or path != '/predict':
+                await _write_response(writer, 404, {'error': 'Use POST /predict or GET /stats'})
+                return
+
+            try:
+                length = int(headers.get('content-length', 0))
+            except ValueError:
+                length = -1
+            if length < 0:
+                await _write_response(writer, 400, {'error': 'Invalid Content-Length'})
+                return
+            if length > max_body_size:
+                await _write_response(writer, 413, {'error': 'Image too large'})
+                return
+
+            body = await reader.readexactly(length)
+            img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                await _write_response(writer, 400, {'error': 'Could not decode image'})
+                return
+
+            try:
+                result = await _submit_while_connected(batcher, reader, writer, img)
+            except Overloaded as e:
+                await _write_response(writer, 503, {'error': str(e)}, ['Retry-After: 1'])
+                return
+
+            await _write_response(writer, 200, result_to_json(result))
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        except Exception as e:
+            await _write_response(writer, 500, {'error': repr(e)})
+        finally:
+            writer.close()
+
+    return handle
+
+async def serve(model, host='127.0.0.1', port=8000, unix_socket=None, **batcher_kwargs):
+    """ Serves model until cancelled. batcher_kwargs are passed on to MicroBatcher. """
+    # Nothing gets drawn since clients only receive the structured detections
+    batcher = MicroBatcher(model, predict_kwargs={'render': False}, **batcher_kwargs)
+    batcher.start()
+
+    handler = make_handler(batcher)
+    if unix_socket is not None:
+        server = await asyncio.start_unix_server(handler, path=unix_socket)
+        print('Serving on unix socket %s' % unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host=host, port=port)
+        print('Serving on http://%s:%d' % (host, port))
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await batcher.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='YOLACT Edge micro-batching inference server')
+    parser.add_argument('--trained_model', required=True, type=str,
+                        help='Trained state_dict file path to open.')
+    parser.add_argument('--config', required=True, type=str,
+                        help='The config object to use.')
+    parser.add_argument('--dataset', default='coco2017_dataset', type=str,
+                        help='The dataset whose class names are reported.')
+    parser.add_argument('--calib_images', default=None, type=str,
+                        help='Directory of images for TensorRT INT8 calibration.')
+    parser.add_argument('--device', default=None, type=str,
+                        help='cuda or cpu. Defaults to cuda when it is available.')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix_socket', default=None, type=str,
+                        help='Listen on this Unix socket path instead of host:port.')
+    parser.add_argument('--max_batch_size', default=8, type=int,
+                        help='Largest micro-batch handed to the model. Must be <= --trt_batch_size with TensorRT.')
+    parser.add_argument('--max_wait_ms', default=5, type=float,
+                        help='How long a batch waits to fill up after its first request arrives.')
+    parser.add_argument('--max_queue_size', default=64, type=int,
+                        help='Requests beyond this queue depth are rejected with 503.')
+    parser.add_argument('--max_queue_delay_ms', default=1000, type=float,
+                        help='Requests that waited longer than this in the queue are shed with 503.')
+    return parser.parse_known_args(argv)[0]
+
+
+if __name__ == '__main__':
+    server_args = parse_args()
+
+    from yolact_edge.inference import YOLACTEdgeInference
+    model = YOLACTEdgeInference(server_args.trained_model, server_args.config, server_args.dataset,
+                                server_args.calib_images, device=server_args.device)
+
+    try:
+        asyncio.run(serve(model, host=server_args.host, port=server_args.port, unix_socket=server_args.unix_socket,
+                          max_batch_size=server_args.max_batch_size, max_wait_ms=server_args.max_wait_ms,
+                          max_queue_size=server_args.max_queue_size,
+                          max_queue_delay_ms=server_args.max_queue_delay_ms))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,87 @@
+"""
+Reusable tensor buffers for steady-state inference.
+
+Code that would allocate a fresh intermediate every frame asks for it with empty(name, shape)
+instead. Normally that's just torch.empty, but inside an env(arena) block the buffer called name
+is handed out again and again and only reallocated if it has to grow. Buffers are sized to their
+capacity (e.g. the largest detection count) the first time, so once every buffer has been seen
+a steady stream of same-size frames stops allocating them.
+
+Anything taken from the arena is only valid until the same name is asked for again, i.e. the next
+frame. The arena is ignored while tracing since a traced graph would capture the buffers.
+"""
+
+from contextlib import contextmanager
+
+import torch
+
+_active_arena = None
+
+
+class TensorArena(object):
+    """ Named, growable buffers. See the module docstring. """
+
+    def __init__(self):
+        self.buffers = {}
+        # How many times a buffer had to be (re)allocated
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=torch.float32, device=None, capacity=None):
+        """
+        Returns the buffer called name viewed as shape. capacity is the number of elements to
+        allocate the first time (at least the size of shape) so that later, larger requests fit.
+        """
+        numel = 1
+        for s in shape:
+            numel *= s
+
+        buffer = self.buffers.get(name, None)
+        if (buffer is None or buffer.numel() < numel or buffer.dtype != dtype
+                or (device is not None and not _same_device(buffer.device, torch.device(device)))):
+            buffer = torch.empty(max(numel, capacity if capacity is not None else 0), dtype=dtype, device=device)
+            self.buffers[name] = buffer
+            self.allocations += 1
+
+        return buffer[:numel].view(shape)
+
+    def nbytes(self):
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    def clear(self):
+        self.buffers.clear()
+
+
+def _same_device(actual, requested):
+    # torch.device('cuda') means whichever GPU is current, which the buffer was allocated on
+    return actual.type == requested.type and (requested.index is None or actual.index == requested.index)
+
+@contextmanager
+def env(arena):
+    """ Makes arena the one empty() draws from in this block. arena can be None to disable it. """
+    global _active_arena
+    previous = _active_arena
+    _active_arena = arena
+    try:
+        yield arena
+    finally:
+        _active_arena = previous
+
+def active():
+    """ Returns the arena in use, or None. """
+    return _active_arena if not torch.jit.is_tracing() else None
+
+def empty(name, shape, dtype=torch.float32, device=None, capacity=None):
+    """ torch.empty, but from the active arena if there is one. See TensorArena.get. """
+    arena = active()
+    if arena is None:
+        return torch.empty(shape, dtype=dtype, device=device)
+    return arena.get(name, shape, dtype=dtype, device=device, capacity=capacity)
+
+def cat(name, tensors, dim=0):
+    """ torch.cat into an arena buffer if there is an active arena. """
+    if active() is None:
+        return torch.cat(tensors, dim)
+
+    shape = list(tensors[0].shape)
+    shape[dim] = sum(t.size(dim) for t in tensors)
+    return torch.cat(tensors, dim, out=empty(name, shape, dtype=tensors[0].dtype, device=tensors[0].device))
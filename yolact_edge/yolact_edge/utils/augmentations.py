@@ -843,7 +843,7 @@ import torch.nn.functional as F
 
 class FastBaseTransform(torch.nn.Module):
     """
-    Transform that does all operations on the GPU for super speed.
+    Transform that does all operations on the device of the input for super speed.
     This doesn't suppport a lot of config settings and should only be used for production.
     Maintain this as necessary.
     """
@@ -851,8 +851,9 @@ class FastBaseTransform(torch.nn.Module):
     def __init__(self):
         super().__init__()
 
-        self.mean = torch.Tensor(MEANS).float().cuda()[None, :, None, None]
-        self.std  = torch.Tensor( STD ).float().cuda()[None, :, None, None]
+        # These follow the input to whatever device it lives on (see forward)
+        self.mean = torch.Tensor(MEANS).float()[None, :, None, None]
+        self.std  = torch.Tensor( STD ).float()[None, :, None, None]
         self.transform = cfg.backbone.transform
 
     def forward(self, img):
@@ -884,6 +885,112 @@ class FastBaseTransform(torch.nn.Module):
         # Return value is in channel order [n, c, h, w] and RGB
         return img
 
+class FastUint8Transform(torch.nn.Module):
+    """
+    Does the same as FastBaseTransform, but straight from uint8 BGR frames of size [h, w, c]
+    (e.g., torch.from_numpy on what cv2 gives you, which doesn't copy anything).
+
+    Bilinear resizing only ever looks at 4 source pixels per output pixel, so instead of
+    converting the whole frame to float, permuting it and then resizing it, this gathers just
+    those taps from the uint8 frame and does the float conversion, interpolation, normalization
+    and BGR -> RGB swap on output sized buffers. The result is written into a reusable
+    [n, 3, h, w] input tensor, so the returned batch is only valid until the next call.
+    """
+
+    def __init__(self):
+        super().__init__()
+
+        if cfg.preserve_aspect_ratio:
+            raise NotImplementedError
+        if cfg.backbone.transform.channel_order != 'RGB':
+            raise NotImplementedError
+
+        if type(cfg.max_size) == tuple:
+            self.out_w, self.out_h = cfg.max_size
+        else:
+            self.out_w, self.out_h = cfg.max_size, cfg.max_size
+
+        # Fold whatever normalization the backbone wants into x * scale + bias (per BGR channel)
+        transform = cfg.backbone.transform
+        mean = torch.Tensor(MEANS).float()
+        std  = torch.Tensor( STD ).float()
+        if transform.normalize:
+            scale, bias = 1 / std, -mean / std
+        elif transform.subtract_means:
+            scale, bias = torch.ones(3), -mean
+        elif transform.to_float:
+            scale, bias = torch.ones(3) / 255, torch.zeros(3)
+        else:
+            scale, bias = torch.ones(3), torch.zeros(3)
+
+        self.scale = scale[:, None]
+        self.bias  = bias[:, None]
+        self.bgr_to_rgb = torch.LongTensor([2, 1, 0])
+
+        self.tap_cache = {}
+        self.out = None
+        self.acc = None
+
+    def _taps(self, h, w, device):
+        """ Returns the flat source index [4, out_h*out_w] and weight of every bilinear tap for an [h, w] frame. """
+        key = (h, w, device)
+
+        if key not in self.tap_cache:
+            def source_index(in_size, out_size):
+                # Same as F.interpolate(mode='bilinear', align_corners=False)
+                src = ((torch.arange(out_size, dtype=torch.float32, device=device) + 0.5) * (in_size / out_size) - 0.5).clamp_(min=0)
+                i0 = src.long()
+                i1 = (i0 + 1).clamp_(max=in_size - 1)
+                l1 = src - i0.float()
+                return i0, i1, 1 - l1, l1
+
+            y0, y1, wy0, wy1 = [x[:, None] for x in source_index(h, self.out_h)]
+            x0, x1, wx0, wx1 = [x[None, :] for x in source_index(w, self.out_w)]
+
+            idx = torch.stack([y0 * w + x0, y0 * w + x1, y1 * w + x0, y1 * w + x1]).view(4, -1)
+            weights = torch.stack([wy0 * wx0, wy0 * wx1, wy1 * wx0, wy1 * wx1]).view(4, -1)
+            self.tap_cache[key] = (idx, weights)
+
+        return self.tap_cache[key]
+
+    def forward(self, frames):
+        """
+        frames is either a uint8 tensor of size [n, h, w, 3] or a list of [h, w, 3] uint8 tensors,
+        which may differ in size. Returns a float tensor of size [n, 3, out_h, out_w] in RGB.
+        """
+        n = len(frames)
+        device = frames[0].device
+
+        if self.out is None or self.out.size(0) < n or self.out.device != device:
+            self.out = torch.empty((n, 3, self.out_h, self.out_w), dtype=torch.float32, device=device)
+            self.acc = torch.empty((3, self.out_h * self.out_w), dtype=torch.float32, device=device)
+            self.scale = self.scale.to(device)
+            self.bias = self.bias.to(device)
+            self.bgr_to_rgb = self.bgr_to_rgb.to(device)
+
+        for i in range(n):
+            frame = frames[i]
+            h, w, c = frame.size()
+            if c != 3:
+                raise ValueError('Expected a BGR frame, got %d channels' % c)
+            if not frame.is_contiguous():
+                frame = frame.contiguous()
+
+            idx, weights = self._taps(h, w, device)
+
+            # [4, 3, out_h*out_w] view of only the pixels bilinear interpolation needs (still BGR uint8)
+            taps = frame.view(-1, 3).index_select(0, idx.view(-1)).view(4, -1, 3).permute(0, 2, 1)
+
+            acc = torch.mul(taps[0], weights[0], out=self.acc)
+            for k in range(1, 4):
+                acc.addcmul_(taps[k], weights[k])
+            acc.mul_(self.scale).add_(self.bias)
+
+            torch.index_select(acc, 0, self.bgr_to_rgb, out=self.out[i].view(3, -1))
+
+        # Return value is in channel order [n, c, h, w] and RGB
+        return self.out[:n]
+
 def do_nothing(img=None, masks=None, boxes=None, labels=None, seeds=None, require_seeds=False):
     if require_seeds:
         return None, (img, masks, boxes, labels)
@@ -0,0 +1,235 @@
+"""
+A drop-in replacement for pycocotools' COCOeval on bbox and segm results, for re-evaluating
+the files --output_coco_json writes.
+
+COCOeval.evaluateImg matches detections to ground truth with a Python loop over every IoU
+threshold, area range, detection and ground truth. Here the 10 thresholds and 4 area ranges of an
+image and category are matched together as 40 lanes of numpy arrays, one detection at a time
+(matching is greedy, so detections have to go in order), and detections that can't match
+anything are skipped outright. Images are spread over worker processes. accumulate works on whole
+arrays too. IoUs come from the same maskUtils.iou call and every comparison is done the way
+COCOeval does it, so precision, recall and summarize()'s stats come out the same.
+
+Only useCats=1 (the default) is supported.
+"""
+
+import copy
+import multiprocessing
+import os
+import time
+
+import numpy as np
+from pycocotools import mask as maskUtils
+from pycocotools.cocoeval import COCOeval
+
+
+# Set to the evaluator in the parent before forking the workers, which only read it
+_evaluator = None
+
+
+def _evaluate_image_worker(img_idx):
+    return _evaluator.evaluate_image(img_idx)
+
+
+class FastCOCOeval(COCOeval):
+    """
+    Use like COCOeval: evaluate(), accumulate() and summarize(). num_workers processes (by default
+    one per core this process may run on) evaluate the images (0 evaluates them in this process).
+    evalImgs isn't filled in, since accumulate works on the arrays evaluate_image returns.
+    """
+
+    def __init__(self, cocoGt=None, cocoDt=None, iouType='segm', num_workers=None):
+        super().__init__(cocoGt, cocoDt, iouType)
+        if num_workers is None:
+            num_workers = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else multiprocessing.cpu_count()
+        self.num_workers = num_workers
+
+    def evaluate(self):
+        tic = time.time()
+        print('Running per image evaluation...')
+        p = self.params
+        if p.useSegm is not None:
+            p.iouType = 'segm' if p.useSegm == 1 else 'bbox'
+        if p.iouType not in ('segm', 'bbox') or not p.useCats:
+            raise ValueError('FastCOCOeval only supports bbox and segm evaluation with useCats=1.')
+        print('Evaluate annotation type *{}*'.format(p.iouType))
+        p.imgIds = list(np.unique(p.imgIds))
+        p.catIds = list(np.unique(p.catIds))
+        p.maxDets = sorted(p.maxDets)
+        self.params = p
+
+        self._prepare()
+
+        # What each image has, by category index
+        cat_idx = {cat_id: k for k, cat_id in enumerate(p.catIds)}
+        self._img_cats = [{} for _ in p.imgIds]
+        img_idx = {img_id: i for i, img_id in enumerate(p.imgIds)}
+        for (img_id, cat_id) in set(self._gts.keys()) | set(self._dts.keys()):
+            if img_id in img_idx and cat_id in cat_idx:
+                self._img_cats[img_idx[img_id]][cat_idx[cat_id]] = (img_id, cat_id)
+
+        global _evaluator
+        if self.num_workers > 1 and len(p.imgIds) > 1:
+            _evaluator = self
+            try:
+                with multiprocessing.get_context('fork').Pool(self.num_workers) as pool:
+                    chunksize = max(1, len(p.imgIds) // (self.num_workers * 16))
+                    self._img_results = pool.map(_evaluate_image_worker, range(len(p.imgIds)), chunksize=chunksize)
+            finally:
+                _evaluator = None
+        else:
+            self._img_results = [self.evaluate_image(i) for i in range(len(p.imgIds))]
+
+        self._paramsEval = copy.deepcopy(self.params)
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
+
+    def evaluate_image(self, img_idx):
+        """
+        Evaluates every category of an image. Returns {category index: (scores [D], matched
+        [A, T, D], ignored [A, T, D], number of non-ignored gt [A])}, with the detections sorted by
+        score and cut to the largest maxDets, as COCOeval.evaluateImg does.
+        """
+        results = {}
+        for k, (img_id, cat_id) in self._img_cats[img_idx].items():
+            results[k] = self.evaluate_image_category(self._gts[img_id, cat_id], self._dts[img_id, cat_id])
+        return results
+
+    def evaluate_image_category(self, gt, dt):
+        p = self.params
+        iou_thrs = np.minimum(p.iouThrs, 1 - 1e-10)
+        area_rngs = np.array(p.areaRng, dtype=np.float64)
+        T, A = len(iou_thrs), len(area_rngs)
+
+        dt_order = np.argsort([-d['score'] for d in dt], kind='mergesort')[:p.maxDets[-1]]
+        dt = [dt[i] for i in dt_order]
+        G, D = len(gt), len(dt)
+
+        scores = np.array([d['score'] for d in dt], dtype=np.float64)
+        dt_area = np.array([d['area'] for d in dt], dtype=np.float64)
+        gt_area = np.array([g['area'] for g in gt], dtype=np.float64)
+        crowd = np.array([int(g['iscrowd']) for g in gt], dtype=bool)
+        ignore = np.array([bool(g['ignore']) for g in gt], dtype=bool)
+
+        # [A, G]: whether each gt is ignored in each area range
+        gt_ignored = ignore[None, :] | (gt_area[None, :] < area_rngs[:, :1]) | (gt_area[None, :] > area_rngs[:, 1:])
+        num_gt = (~gt_ignored).sum(axis=1)
+
+        matched = np.zeros((A, T, D), dtype=bool)
+        dt_ignored = np.zeros((A, T, D), dtype=bool)
+
+        if G > 0 and D > 0:
+            if p.iouType == 'segm':
+                ious = maskUtils.iou([d['segmentation'] for d in dt], [g['segmentation'] for g in gt], list(crowd.astype(int)))
+            else:
+                ious = maskUtils.iou([d['bbox'] for d in dt], [g['bbox'] for g in gt], list(crowd.astype(int)))
+            ious = np.asarray(ious, dtype=np.float64).reshape(D, G)
+
+            # Lanes are (area range, threshold) pairs. COCOeval visits the gt of an area range
+            # with the ignored ones last (a stable sort), so position is where each gt comes then.
+            lane_ignored = np.repeat(gt_ignored, T, axis=0)
+            lane_thrs = np.tile(iou_thrs, A)[:, None]
+            position = np.repeat(np.argsort(np.argsort(gt_ignored, axis=1, kind='mergesort'), axis=1), T, axis=0)
+            gt_taken = np.zeros((A * T, G), dtype=bool)
+            lanes = np.arange(A * T)
+
+            for d in range(D):
+                iou = ious[d]
+                if not (iou >= iou_thrs[0]).any():
+                    continue
+
+                # A gt can be matched if it isn't taken (crowds never are) and has a high enough IoU.
+                # The best match is the last gt (in COCOeval's order) with the highest IoU, looking
+                # at the ignored gt only if none of the others can be matched.
+                free = (~gt_taken | crowd[None, :]) & (iou[None, :] >= lane_thrs)
+                candidates = free & ~lane_ignored
+                regular = candidates.any(axis=1)
+                candidates[~regular] = (free & lane_ignored)[~regular]
+
+                best = np.where(candidates, iou[None, :], -1).max(axis=1)
+                m = np.where(candidates & (iou[None, :] == best[:, None]), position, -1).argmax(axis=1)
+                found = candidates.any(axis=1)
+
+                gt_taken[lanes[found], m[found]] = True
+                matched[:, :, d] = found.reshape(A, T)
+                dt_ignored[:, :, d] = (found & lane_ignored[lanes, m]).reshape(A, T)
+
+        # Unmatched detections outside of the area range are ignored
+        dt_outside = (dt_area[None, :] < area_rngs[:, :1]) | (dt_area[None, :] > area_rngs[:, 1:])
+        dt_ignored |= ~matched & dt_outside[:, None, :]
+
+        return scores, matched, dt_ignored, num_gt
+
+    def accumulate(self, p=None):
+        print('Accumulating evaluation results...')
+        tic = time.time()
+        if p is None:
+            p = self.params
+        T = len(p.iouThrs)
+        R = len(p.recThrs)
+        K = len(p.catIds)
+        A = len(p.areaRng)
+        M = len(p.maxDets)
+        precision = -np.ones((T, R, K, A, M))
+        recall = -np.ones((T, K, A, M))
+        scores = -np.ones((T, R, K, A, M))
+
+        # Gather every image's results by category, in image order
+        per_cat = [[] for _ in range(K)]
+        for img_results in self._img_results:
+            for k, result in img_results.items():
+                per_cat[k].append(result)
+
+        for k in range(K):
+            if len(per_cat[k]) == 0:
+                continue
+            dt_scores = np.concatenate([r[0] for r in per_cat[k]])
+            dt_rank = np.concatenate([np.arange(len(r[0])) for r in per_cat[k]])
+            dt_matched = np.concatenate([r[1] for r in per_cat[k]], axis=2)
+            dt_ignored = np.concatenate([r[2] for r in per_cat[k]], axis=2)
+            num_gt = np.sum([r[3] for r in per_cat[k]], axis=0)
+
+            for m, max_det in enumerate(p.maxDets):
+                keep = dt_rank < max_det
+                # mergesort, to be consistent with COCOeval (and the Matlab implementation)
+                inds = np.argsort(-dt_scores[keep], kind='mergesort')
+                scores_sorted = dt_scores[keep][inds]
+
+                for a in range(A):
+                    npig = num_gt[a]
+                    if npig == 0:
+                        continue
+                    dtm = dt_matched[a][:, keep][:, inds]
+                    dtig = dt_ignored[a][:, keep][:, inds]
+
+                    tp_sum = np.cumsum(dtm & ~dtig, axis=1).astype(dtype=float)
+                    fp_sum = np.cumsum(~dtm & ~dtig, axis=1).astype(dtype=float)
+                    nd = tp_sum.shape[1]
+
+                    rc = tp_sum / npig
+                    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+                    recall[:, k, a, m] = rc[:, -1] if nd else 0
+
+                    # Precision at every recall is the best precision at that recall or above
+                    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+                    for t in range(T):
+                        pis = np.searchsorted(rc[t], p.recThrs, side='left')
+                        valid = pis < nd
+                        q = np.zeros(R)
+                        ss = np.zeros(R)
+                        q[valid] = pr[t, pis[valid]]
+                        ss[valid] = scores_sorted[pis[valid]]
+                        precision[t, :, k, a, m] = q
+                        scores[t, :, k, a, m] = ss
+
+        self.eval = {
+            'params': p,
+            'counts': [T, R, K, A, M],
+            'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'precision': precision,
+            'recall': recall,
+            'scores': scores,
+        }
+        toc = time.time()
+        print('DONE (t={:0.2f}s).'.format(toc-tic))
@@ -0,0 +1,210 @@
+"""
+A persistent cache of compiled Yolact networks that works without TensorRT.
+
+The dense part of the network (backbone, FPN, protonet and prediction heads) is traced with
+TorchScript and frozen, which takes a while, so the result is saved to disk and loaded on the next
+start instead. Every artifact is keyed on a fingerprint of everything it was built from: the
+weights, the cfg the traced part depends on, the input shape, the device type and the torch
+version. Change any of those and a different key comes out, so a stale artifact is never loaded
+(the metadata stored inside each artifact is checked again on load) and it gets pruned once its
+replacement is saved.
+Artifacts are written to a temporary file and renamed into place, so a crash or a concurrent
+writer can never leave a half-written artifact behind.
+
+Detect stays eager since NMS is data dependent and doesn't trace.
+"""
+
+import functools
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+import torch
+import torch.nn as nn
+
+from yolact_edge.data.config import Config, cfg
+
+# Bump this whenever the way artifacts are built changes so older ones are ignored
+CACHE_VERSION = 1
+
+# Config entries that never reach the network
+_ignored_cfg_keys = ('name', 'dataset', 'joint_dataset')
+
+# Config entries only Detect and postprocessing read, which stay eager, so artifacts are shared by
+# processes that only differ in these (instead of pruning each other's on every save)
+_postprocess_cfg_keys = ('nms_top_k', 'nms_conf_thresh', 'nms_thresh', 'max_num_detections', 'mask_proto_debug')
+
+
+def _stable_repr(value):
+    """ Like repr, but without memory addresses, so it's stable from one process to the next. """
+    if isinstance(value, Config):
+        value = vars(value)
+    if isinstance(value, dict):
+        return '{%s}' % ', '.join('%r: %s' % (k, _stable_repr(v)) for k, v in sorted(value.items(), key=lambda kv: str(kv[0])))
+    if isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(_stable_repr(v) for v in value)
+    if isinstance(value, functools.partial):
+        return 'partial(%s, %s, %s)' % (_stable_repr(value.func), _stable_repr(value.args), _stable_repr(value.keywords))
+    if callable(value):
+        return '%s.%s' % (getattr(value, '__module__', ''), getattr(value, '__qualname__', type(value).__name__))
+    return repr(value)
+
+def cfg_fingerprint():
+    """
+    Hashes every cfg entry that can change the traced network (everything but the dataset, the
+    name and the NMS and postprocessing settings).
+    """
+    entries = {k: v for k, v in vars(cfg).items() if k not in _ignored_cfg_keys and k not in _postprocess_cfg_keys}
+    return hashlib.sha256(_stable_repr(entries).encode('utf-8')).hexdigest()
+
+def weights_fingerprint(net):
+    """ Hashes the names, shapes and contents of everything in net.state_dict(). """
+    h = hashlib.sha256()
+    for name, tensor in net.state_dict().items():
+        tensor = tensor.detach().cpu().contiguous()
+        h.update(('%s %s %s' % (name, str(tensor.dtype), tuple(tensor.shape))).encode('utf-8'))
+        h.update(tensor.view(-1).view(torch.uint8).numpy())
+    return h.hexdigest()
+
+
+class DenseYolact(nn.Module):
+    """ Runs the full-backbone forward of a Yolact up to (but not including) Detect. Traceable. """
+
+    def __init__(self, net):
+        super().__init__()
+        self.net = net
+
+    def forward(self, x):
+        extras = {"backbone": "full", "interrupt": False, "keep_statistics": False,
+                  "moving_statistics": None, "raw_outputs": True}
+        return self.net(x, extras=extras)["pred_outs"]
+
+
+class CompiledYolact(nn.Module):
+    """
+    Wraps a Yolact in eval mode and can be called just like it, but runs the dense part of the
+    network through TorchScript modules from the compiled cache (one per input shape).
+
+    Only the plain full-backbone forward is compiled. Anything else (a partial backbone for
+    video, keep_statistics, interrupt) falls through to the eager network. Input shapes without
+    an artifact are compiled (and saved) on first use.
+
+    cache_dir defaults to the directory of weights_path, like the TensorRT cache. The artifact
+    file names start with the weights file name.
+    """
+
+    backend = 'torchscript'
+
+    def __init__(self, net, weights_path=None, cache_dir=None):
+        super().__init__()
+        self.net = net
+        self.compiled = {}
+
+        if cache_dir is None:
+            cache_dir = os.path.dirname(os.path.abspath(weights_path)) if weights_path is not None else '.'
+        self.cache_dir = cache_dir
+        self.prefix = os.path.splitext(os.path.basename(weights_path))[0] if weights_path is not None else 'yolact'
+
+        # Hashing the weights isn't free, so only do it once
+        self.weights_hash = weights_fingerprint(net)
+
+    @property
+    def detect(self):
+        return self.net.detect
+
+    def forward(self, x, extras=None):
+        if extras is not None and (extras.get("backbone", "full") != "full" or extras.get("keep_statistics", False)
+                                   or extras.get("interrupt", False) or extras.get("raw_outputs", False)):
+            return self.net(x, extras=extras)
+
+        shape = tuple(x.shape)
+        if shape not in self.compiled:
+            self.compiled[shape] = self.load_or_compile(x)
+
+        pred_outs = self.compiled[shape](x)
+        return {"pred_outs": self.net.detect(dict(pred_outs))}
+
+    def metadata(self, x):
+        """ Everything the artifact for input x depends on. """
+        return {
+            'version': CACHE_VERSION,
+            'backend': self.backend,
+            'torch': torch.__version__,
+            'device': x.device.type,
+            'dtype': str(x.dtype),
+            'input_shape': list(x.shape),
+            'weights': self.weights_hash,
+            'cfg': cfg_fingerprint(),
+        }
+
+    def cache_path(self, meta):
+        key = hashlib.sha256(json.dumps(meta, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, '{}.{}.{}_{}.{}.pt'.format(
+            self.prefix, self.backend, meta['device'], 'x'.join(str(s) for s in meta['input_shape']), key))
+
+    def load_or_compile(self, x):
+        logger = logging.getLogger("yolact.model.load")
+        meta = self.metadata(x)
+        path = self.cache_path(meta)
+
+        module = self.load(path, meta, x.device)
+        if module is not None:
+            logger.info("Loaded compiled network from {}".format(path))
+            return module
+
+        logger.info("Compiling the network for input shape {}...".format(tuple(x.shape)))
+        with torch.no_grad():
+            module = torch.jit.trace(DenseYolact(self.net).eval(), x, strict=False, check_trace=False)
+            module = torch.jit.freeze(module)
+
+        try:
+            self.save(module, path, meta)
+            logger.info("Saved compiled network to {}".format(path))
+        except OSError as e:
+            # A read-only cache dir shouldn't stop inference, it just means compiling again next time
+            logger.warning("Could not save the compiled network to {}: {}".format(path, e))
+
+        return module
+
+    def load(self, path, meta, device):
+        """ Returns the artifact at path, or None if it is missing, unreadable or was built from something else. """
+        if not os.path.isfile(path):
+            return None
+
+        extra_files = {'meta.json': ''}
+        try:
+            module = torch.jit.load(path, map_location=device, _extra_files=extra_files)
+            stored_meta = json.loads(extra_files['meta.json'])
+        except Exception as e:
+            logging.getLogger("yolact.model.load").warning("Ignoring unreadable compiled network {}: {}".format(path, e))
+            return None
+
+        return module if stored_meta == meta else None
+
+    def save(self, module, path, meta):
+        """ Atomically writes module to path and prunes the artifacts it replaces. """
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=os.path.basename(path) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.jit.save(module, f, _extra_files={'meta.json': json.dumps(meta, sort_keys=True)})
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        # Same weights file, backend, device and shape but a different key means it's stale
+        stale_pattern = glob.escape(path[:path.rindex('.', 0, -len('.pt'))]) + '.*.pt'
+        for stale_path in glob.glob(stale_pattern):
+            if stale_path != path:
+                try:
+                    os.remove(stale_path)
+                except OSError:
+                    pass
@@ -0,0 +1,133 @@
+"""
+Writes --output_coco_json results out while the evaluation runs, instead of keeping them all in
+memory and dumping them at the end.
+
+Results go to JSON lines files, one result per line, in the order they were added. Boxes are
+written right away. Masks are collected into batches, bit-packed and RLE-encoded by a pool of
+worker processes, and written as the encodings come back (still in order). At most max_pending
+batches are out at a time, so memory stays bounded however large the dataset is.
+
+convert_to_json turns a JSON lines file into the JSON list that COCO.loadRes (and so
+run_coco_eval.py) reads, byte for byte what json.dump of the list would write. It streams, so it
+also takes next to no memory. To run it by hand:
+    python -m yolact_edge.utils.detections_writer results/mask_detections.jsonl results/mask_detections.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import multiprocessing.pool
+from collections import deque
+
+import numpy as np
+import pycocotools.mask
+
+
+def encode_masks(packed, shape):
+    """ RLE-encodes the [n, h, w] masks bit-packed into packed, in the COCO results format. """
+    masks = np.unpackbits(packed, count=int(np.prod(shape))).reshape(shape)
+    rles = pycocotools.mask.encode(np.asfortranarray(masks.transpose(1, 2, 0)))
+    for rle in rles:
+        rle['counts'] = rle['counts'].decode('ascii')
+    return rles
+
+
+def convert_to_json(lines_path, json_path):
+    """ Writes the results in the JSON lines file lines_path to json_path as one JSON list. """
+    with open(lines_path, 'r') as lines, open(json_path, 'w') as out:
+        out.write('[')
+        first = True
+        for line in lines:
+            line = line.rstrip('\n')
+            if len(line) == 0:
+                continue
+            if not first:
+                out.write(', ')
+            out.write(line)
+            first = False
+        out.write(']')
+
+
+class DetectionsWriter(object):
+    """
+    Appends bbox results to bbox_path and mask results to mask_path, see the module docstring.
+    With num_workers=0 masks are encoded on the calling thread, batch by batch.
+    Call close() at the end to write what's left.
+    """
+
+    def __init__(self, bbox_path, mask_path, num_workers=2, batch_size=100, max_pending=None):
+        self.bbox_file = open(bbox_path, 'w')
+        self.mask_file = open(mask_path, 'w')
+        self.batch_size = batch_size
+        self.max_pending = max_pending if max_pending is not None else 2 * max(num_workers, 1)
+
+        # Forked like the eval DataLoader workers. The workers only ever run encode_masks.
+        self.pool = multiprocessing.get_context('fork').Pool(num_workers) if num_workers > 0 else None
+        self.pending = deque()
+
+        self.batch_results = []
+        self.batch_masks = []
+
+    def add_bbox(self, result:dict):
+        self.bbox_file.write(json.dumps(result) + '\n')
+
+    def add_mask(self, result:dict, mask:np.ndarray):
+        """ The 'segmentation' of result is filled in with the RLE of mask ([h, w]) once it's encoded. """
+        if len(self.batch_masks) > 0 and mask.shape != self.batch_masks[0].shape:
+            self._submit()
+
+        self.batch_results.append(result)
+        self.batch_masks.append(mask)
+        if len(self.batch_masks) >= self.batch_size:
+            self._submit()
+
+    def _submit(self):
+        if len(self.batch_masks) == 0:
+            return
+
+        # Nonzero after a cast to uint8, which is what encoding segmentation.astype(np.uint8) counts as set
+        masks = np.stack(self.batch_masks).astype(np.uint8) > 0
+        packed = np.packbits(masks)
+        if self.pool is not None:
+            rles = self.pool.apply_async(encode_masks, (packed, masks.shape))
+        else:
+            rles = encode_masks(packed, masks.shape)
+        self.pending.append((self.batch_results, rles))
+        self.batch_results, self.batch_masks = [], []
+
+        # Write whatever is done, and wait for the oldest batch if too many are out
+        while len(self.pending) > 0 and (len(self.pending) > self.max_pending or self._ready(self.pending[0][1])):
+            self._write_oldest()
+
+    @staticmethod
+    def _ready(rles):
+        return rles.ready() if isinstance(rles, multiprocessing.pool.AsyncResult) else True
+
+    def _write_oldest(self):
+        results, rles = self.pending.popleft()
+        if isinstance(rles, multiprocessing.pool.AsyncResult):
+            rles = rles.get()
+        for result, rle in zip(results, rles):
+            result['segmentation'] = rle
+            self.mask_file.write(json.dumps(result) + '\n')
+
+    def close(self):
+        self._submit()
+        while len(self.pending) > 0:
+            self._write_oldest()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.bbox_file.close()
+        self.mask_file.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts JSON lines detections to a COCO results JSON file')
+    parser.add_argument('lines_path', type=str, help='JSON lines file written by DetectionsWriter.')
+    parser.add_argument('json_path', type=str, help='Where to write the COCO results JSON.')
+    convert_args = parser.parse_args()
+
+    convert_to_json(convert_args.lines_path, convert_args.json_path)
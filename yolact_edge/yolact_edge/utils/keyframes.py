@@ -0,0 +1,202 @@
+"""
+Keyframe scheduling for flow-warped video inference.
+
+On a keyframe the full backbone runs and its features are kept. Every other frame only runs the
+partial backbone and warps those features with flow. A scheduler decides which frames are
+keyframes: decide() is called before every forward pass and observe() with the Detect output
+after it. Every decision goes to the "yolact.keyframes" logger (at debug level) and, if a
+log_path is given, to a CSV file with one line per decision.
+
+Intervals are measured in frame indices, not calls, so a caller that drops frames passes the
+index each frame had in the stream and skipped frames still count towards the next keyframe.
+"""
+
+import logging
+
+import torch
+import torch.nn.functional as F
+
+
+class KeyframeScheduler:
+    """ Base class. Subclasses implement _decide. """
+
+    def __init__(self, log_path=None):
+        self.logger = logging.getLogger("yolact.keyframes")
+        self.log_file = None
+        if log_path is not None:
+            self.log_file = open(log_path, 'w')
+            self.log_file.write('frame,keyframe,reason,motion,confidence\n')
+
+        self.last_keyframe_idx = None
+        self.counts = {}
+        self.motion = float('nan')
+        self.confidence = float('nan')
+
+    def decide(self, frame_idx, frames, force=None):
+        """
+        Returns True if frame_idx should be a keyframe. frames is the list of HWC BGR frames
+        (as float tensors in [0, 255]) going through the network this time.
+
+        A caller that has to run the full backbone anyway passes the reason as force. The frame is
+        then logged and counted as a keyframe with that reason, and the next keyframe is measured
+        from it.
+        """
+        if force is not None:
+            keyframe, reason = True, force
+            self._force(frame_idx, frames)
+        else:
+            keyframe, reason = self._decide(frame_idx, frames)
+
+        if keyframe:
+            self.last_keyframe_idx = frame_idx
+        self.counts[reason] = self.counts.get(reason, 0) + 1
+
+        self.logger.debug('frame %d: %s (%s, motion %.4f, confidence %.3f)' % (
+            frame_idx, 'keyframe' if keyframe else 'warp', reason, self.motion, self.confidence))
+        if self.log_file is not None:
+            self.log_file.write('%d,%d,%s,%.6f,%.6f\n' % (frame_idx, keyframe, reason, self.motion, self.confidence))
+
+        return keyframe
+
+    def _decide(self, frame_idx, frames):
+        """ Returns (keyframe, reason). """
+        raise NotImplementedError
+
+    def _force(self, frame_idx, frames):
+        """ Called instead of _decide for a forced keyframe, to update the state a keyframe would. """
+        pass
+
+    def observe(self, preds):
+        """ Called with the list of Detect outputs of the frames from the last decide. """
+        pass
+
+    def reset(self):
+        """ Forgets everything about the stream, so the next frame will be a keyframe. """
+        self.last_keyframe_idx = None
+
+    def close(self):
+        if self.log_file is not None:
+            self.log_file.close()
+            self.log_file = None
+
+    def format_summary(self):
+        keyframes = sum(count for reason, count in self.counts.items() if reason != 'warp')
+        total = sum(self.counts.values())
+        return 'Keyframes: %d / %d batches (%s)' % (
+            keyframes, total, ', '.join('%s %d' % (reason, count) for reason, count in sorted(self.counts.items())))
+
+
+class FixedKeyframeScheduler(KeyframeScheduler):
+    """ Every interval-th frame is a keyframe. This is what evalvideo and savevideo always did. """
+
+    def __init__(self, interval=5, log_path=None):
+        super().__init__(log_path)
+        self.interval = interval
+
+    def _decide(self, frame_idx, frames):
+        if self.last_keyframe_idx is None or frame_idx - self.last_keyframe_idx >= self.interval:
+            return True, 'interval'
+        return False, 'warp'
+
+
+class AdaptiveKeyframeScheduler(KeyframeScheduler):
+    """
+    Refreshes the keyframe when the picture or the detections have changed enough since the
+    last one, so static scenes get by with few full passes and fast motion gets more of them.
+
+    Motion is the mean absolute difference between 32x32 grayscale thumbnails (in [0, 1]) of the
+    current frame and the last keyframe, which costs next to nothing next to the network.
+        - motion_threshold: Refresh once motion exceeds this, but not within min_interval frames of the last keyframe.
+        - scene_threshold:  Refresh right away once motion exceeds this (a cut or a sudden change of view).
+        - confidence_drop:  Refresh on the next frame when the mean of the top 5 scores of a warped frame
+                            drops this fraction below that of the keyframe. Set to None to disable.
+        - max_interval:     Refresh at least this often no matter what.
+    """
+
+    def __init__(self, motion_threshold=0.03, scene_threshold=0.15, confidence_drop=0.25,
+                 min_interval=2, max_interval=15, thumbnail_size=32, log_path=None):
+        super().__init__(log_path)
+        self.motion_threshold = motion_threshold
+        self.scene_threshold = scene_threshold
+        self.confidence_drop = confidence_drop
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.thumbnail_size = thumbnail_size
+
+        self.reset()
+
+    def reset(self):
+        super().reset()
+        self.keyframe_thumbnail = None
+        self.keyframe_confidence = None
+        self.confidence_dropped = False
+
+    def thumbnail(self, frame):
+        gray = frame.float().mean(dim=-1)[None, None] / 255
+        return F.adaptive_avg_pool2d(gray, self.thumbnail_size)
+
+    def _decide(self, frame_idx, frames):
+        thumbnails = [self.thumbnail(frame) for frame in frames]
+
+        if self.last_keyframe_idx is None or thumbnails[0].shape != self.keyframe_thumbnail.shape:
+            keyframe, reason = True, 'start'
+            self.motion = float('nan')
+        else:
+            self.motion = max((thumbnail - self.keyframe_thumbnail).abs().mean().item() for thumbnail in thumbnails)
+            since = frame_idx - self.last_keyframe_idx
+
+            if self.motion > self.scene_threshold:
+                keyframe, reason = True, 'scene'
+            elif since >= self.max_interval:
+                keyframe, reason = True, 'max_interval'
+            elif since < self.min_interval:
+                keyframe, reason = False, 'warp'
+            elif self.confidence_dropped:
+                keyframe, reason = True, 'confidence'
+            elif self.motion > self.motion_threshold:
+                keyframe, reason = True, 'motion'
+            else:
+                keyframe, reason = False, 'warp'
+
+        if keyframe:
+            self.keyframe_thumbnail = thumbnails[-1]
+            self.keyframe_confidence = None
+        self.confidence_dropped = False
+        self.is_keyframe = keyframe
+
+        return keyframe, reason
+
+    def _force(self, frame_idx, frames):
+        self.motion = float('nan')
+        self.keyframe_thumbnail = self.thumbnail(frames[-1])
+        self.keyframe_confidence = None
+        self.confidence_dropped = False
+        self.is_keyframe = True
+
+    def observe(self, preds):
+        scores = [det['score'].sort(descending=True)[0][:5] for det in preds if det is not None]
+        self.confidence = torch.cat(scores).mean().item() if len(scores) > 0 else 0.0
+
+        if self.is_keyframe:
+            self.keyframe_confidence = self.confidence
+        elif self.confidence_drop is not None and self.keyframe_confidence:
+            self.confidence_dropped = self.confidence < self.keyframe_confidence * (1 - self.confidence_drop)
+
+
+def make_keyframe_scheduler(args, log_path=None):
+    """
+    Builds the scheduler selected with eval.py's --keyframe_* arguments. log_path overrides
+    --keyframe_log, for when there are several streams.
+    """
+    log_path = log_path if log_path is not None else args.keyframe_log
+
+    if args.keyframe_scheduler == 'fixed':
+        return FixedKeyframeScheduler(args.keyframe_interval, log_path=log_path)
+    elif args.keyframe_scheduler == 'adaptive':
+        return AdaptiveKeyframeScheduler(motion_threshold=args.keyframe_motion_threshold,
+                                         scene_threshold=args.keyframe_scene_threshold,
+                                         confidence_drop=args.keyframe_confidence_drop if args.keyframe_confidence_drop > 0 else None,
+                                         max_interval=args.keyframe_max_interval,
+                                         log_path=log_path)
+    else:
+        raise ValueError('Unknown keyframe scheduler: %s' % args.keyframe_scheduler)
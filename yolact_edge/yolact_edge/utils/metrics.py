@@ -0,0 +1,97 @@
+"""
+A metrics sink for long runs: record() only writes into a fixed-size ring buffer, and a
+background thread appends whatever is new to a file every flush_interval seconds. Recording
+therefore costs the same on the first frame as on the millionth, and nothing grows in memory.
+
+The file is raw little-endian float64, one value per sample, so it can be read back with
+    np.fromfile(path, dtype='<f8')
+"""
+
+import threading
+
+import numpy as np
+
+
+class MetricsSink:
+    """
+    Records one series of values (e.g. inference times in seconds) to path. The file is
+    truncated when the sink is created and only ever appended to after that.
+
+    capacity is the size of the ring buffer. The flush thread is woken up early once it's half
+    full, and only if it falls a whole buffer behind does record() write to the file itself, so
+    no value is ever lost. record() should always be called from the same thread.
+    """
+
+    def __init__(self, path, capacity=4096, flush_interval=1.0):
+        self.path = path
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+
+        self.buffer = np.zeros(capacity, dtype='<f8')
+        self.count = 0     # Values recorded so far
+        self.flushed = 0   # Values taken out of the buffer for the file so far
+        self.lock = threading.Lock()
+        # Keeps flushes (and so the values in the file) in order
+        self.write_lock = threading.Lock()
+
+        self.file = open(path, 'wb')
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+        self.thread = threading.Thread(target=self._flush_loop, name='metrics-flush', daemon=True)
+        self.thread.start()
+
+    def record(self, value):
+        if self.count - self.flushed >= self.capacity:
+            # The flush thread didn't keep up, so write the buffer out here rather than overwrite it
+            self.flush()
+
+        with self.lock:
+            self.buffer[self.count % self.capacity] = value
+            self.count += 1
+            unflushed = self.count - self.flushed
+
+        if unflushed == self.capacity // 2:
+            self.wake_event.set()
+
+    def _flush_loop(self):
+        while not self.stop_event.is_set():
+            self.wake_event.wait(self.flush_interval)
+            self.wake_event.clear()
+            self.flush()
+
+    def flush(self):
+        """ Appends everything recorded since the last flush to the file. """
+        with self.write_lock:
+            with self.lock:
+                idx = np.arange(self.flushed, self.count) % self.capacity
+                values = self.buffer[idx]
+                self.flushed = self.count
+
+            if len(values) > 0:
+                self.file.write(values.tobytes())
+                self.file.flush()
+
+    def close(self):
+        """ Stops the background thread, writes what's left and returns get_summary(). """
+        if not self.file.closed:
+            self.stop_event.set()
+            self.wake_event.set()
+            self.thread.join()
+            self.flush()
+            self.file.close()
+        return self.get_summary()
+
+    def get_summary(self, percentiles=(50, 90, 95, 99)):
+        """
+        Returns count, mean, min, max and the given percentiles over every value in the file.
+        Call this after close() to include everything.
+        """
+        values = np.fromfile(self.path, dtype='<f8')
+        summary = {'count': len(values)}
+
+        if len(values) > 0:
+            summary.update({'mean': float(values.mean()), 'min': float(values.min()), 'max': float(values.max())})
+            for p, v in zip(percentiles, np.percentile(values, percentiles)):
+                summary['p%g' % p] = float(v)
+
+        return summary
@@ -0,0 +1,144 @@
+"""
+Draws detections over an image for display: masks, boxes and class labels.
+
+All masks are composited in one pass. Every pixel gets the index of the top (highest scoring)
+detection covering it, and one lookup into a table of per-detection colors gives what to blend
+in, so the cost barely grows with the number of detections. Where masks overlap the top one is
+shown, rather than a stack of blended colors. Labels are rendered once into small sprites that
+are cached and pasted, instead of measuring and rasterizing the text for every box every frame.
+"""
+
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+import torch
+
+from yolact_edge.data import COLORS
+
+
+class OverlayRenderer(object):
+    """
+    Keeps the color tables (per device) and label sprites (up to max_sprites) across frames, so
+    use one renderer for the whole stream.
+
+    Colors are COLORS[color_idx], with the channels swapped if bgr is True, as in prep_display.
+    """
+
+    def __init__(self, font_face=cv2.FONT_HERSHEY_DUPLEX, font_scale=0.6, font_thickness=1, max_sprites=1024):
+        self.font_face = font_face
+        self.font_scale = font_scale
+        self.font_thickness = font_thickness
+        self.max_sprites = max_sprites
+
+        self.palettes = {}
+        self.sprites = OrderedDict()
+
+    def color_indices(self, classes, class_color):
+        """ Index into COLORS of every detection: by class, or by rank if class_color is False. """
+        idx = np.asarray(classes) if class_color else np.arange(len(classes))
+        return (idx * 5) % len(COLORS)
+
+    def palette(self, bgr, device=None):
+        """ COLORS as a [len(COLORS), 3] uint8 array, or as floats in [0, 1] on device. """
+        key = (bgr, str(device) if device is not None else None)
+        if key not in self.palettes:
+            palette = np.array(COLORS, dtype=np.uint8)
+            if bgr:
+                palette = np.ascontiguousarray(palette[:, ::-1])
+            if device is not None:
+                palette = torch.from_numpy(palette).to(device).float() / 255
+            self.palettes[key] = palette
+        return self.palettes[key]
+
+    def draw_masks(self, img, masks, color_idx, bgr, mask_alpha=0.45):
+        """
+        Blends masks ([n, h, w], or [n, h, w, 1]) into img ([h, w, 3] floats in [0, 1]), in place.
+        Detection 0 is on top.
+        """
+        n = len(color_idx)
+        if n == 0:
+            return img
+
+        hits = masks.view(masks.size(0), masks.size(1), masks.size(2))[:n] > 0.5
+        covered = hits.any(dim=0)
+        # argmax returns the first of equal maxima, which is the top detection covering the pixel
+        labels = torch.where(covered, hits.byte().argmax(dim=0) + 1, torch.zeros_like(covered, dtype=torch.long))
+
+        colors = self.palette(bgr, img.device)[torch.from_numpy(color_idx).to(img.device)]
+        # Label 0 is the background, which is left as it is
+        add = torch.cat([colors.new_zeros((1, 3)), colors * mask_alpha], dim=0)
+        keep = torch.cat([colors.new_ones(1), colors.new_full((n,), 1 - mask_alpha)], dim=0)
+
+        return img.mul_(keep[labels].unsqueeze(-1)).add_(add[labels])
+
+    def draw_boxes(self, img_numpy, boxes, color_idx, bgr, texts=None, draw_boxes=True):
+        """ Draws the boxes and/or the labels in texts (one per box) on a uint8 image, in place. """
+        palette = self.palette(bgr)
+
+        for j in reversed(range(len(color_idx))):
+            x1, y1, x2, y2 = [int(x) for x in boxes[j, :]]
+            color = tuple(int(c) for c in palette[color_idx[j]])
+
+            if draw_boxes:
+                cv2.rectangle(img_numpy, (x1, y1), (x2, y2), color, 1)
+            if texts is not None:
+                self.paste(img_numpy, self.label_sprite(texts[j], color), x1, y1)
+
+        return img_numpy
+
+    def label_sprite(self, text, color):
+        """
+        Returns (box, tail_keep, tail_add) for a label. box is the uint8 patch of white text on
+        color that covers the image. The tail is the text hanging below it (descenders), blended
+        in as image * tail_keep / 255 + tail_add, or None if nothing hangs below.
+        """
+        key = (text, color)
+        sprite = self.sprites.get(key, None)
+        if sprite is not None:
+            self.sprites.move_to_end(key)
+            return sprite
+
+        (text_w, text_h), baseline = cv2.getTextSize(text, self.font_face, self.font_scale, self.font_thickness)
+        box_h = text_h + 5
+        coverage = np.zeros((box_h + baseline, text_w + 1), dtype=np.uint8)
+        cv2.putText(coverage, text, (0, text_h + 1), self.font_face, self.font_scale, 255,
+                    self.font_thickness, cv2.LINE_AA)
+        coverage = coverage.astype(np.float32)[:, :, None] / 255
+
+        color = np.array(color, dtype=np.float32)
+        box = (color * (1 - coverage[:box_h]) + 255 * coverage[:box_h] + 0.5).astype(np.uint8)
+        tail = coverage[box_h:]
+        if tail.any():
+            tail_keep = np.repeat(255 * (1 - tail) + 0.5, 3, axis=2).astype(np.uint8)
+            tail_add = np.repeat(255 * tail + 0.5, 3, axis=2).astype(np.uint8)
+            sprite = (box, tail_keep, tail_add)
+        else:
+            sprite = (box, None, None)
+
+        self.sprites[key] = sprite
+        if len(self.sprites) > self.max_sprites:
+            self.sprites.popitem(last=False)
+        return sprite
+
+    def paste(self, img_numpy, sprite, x, y):
+        """ Puts sprite on img_numpy with the bottom left of its box at (x, y). """
+        box, tail_keep, tail_add = sprite
+        h, w = img_numpy.shape[:2]
+        x0, x1 = max(x, 0), min(x + box.shape[1], w)
+        if x0 >= x1:
+            return
+
+        # The box covers rows top to y
+        top = y - box.shape[0] + 1
+        y0, y1 = max(top, 0), min(y + 1, h)
+        if y0 < y1:
+            img_numpy[y0:y1, x0:x1] = box[y0 - top:y1 - top, x0 - x:x1 - x]
+
+        if tail_keep is None:
+            return
+        y0, y1 = max(y + 1, 0), min(y + 1 + tail_keep.shape[0], h)
+        if y0 < y1:
+            rows, cols = slice(y0 - y - 1, y1 - y - 1), slice(x0 - x, x1 - x)
+            region = img_numpy[y0:y1, x0:x1]
+            region[...] = cv2.add(cv2.multiply(region, tail_keep[rows, cols], scale=1 / 255), tail_add[rows, cols])
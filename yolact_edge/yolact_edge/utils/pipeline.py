@@ -0,0 +1,277 @@
+"""
+Threads joined by bounded queues, for streaming frames through read -> transform -> network -> ...
+
+Every stage runs in its own thread and passes its results to the next one through a queue that
+holds at most queue_size items. When a stage falls behind, the queue in front of it fills up and
+the stages before it block on put (backpressure), so the whole pipeline settles at the speed of
+its slowest stage instead of piling frames up in memory. Each stage keeps counters (see
+Stage.get_stats) that show which one that is.
+
+For live sources where latency matters more than seeing every frame, FrameGrabber does the
+opposite: it holds just the newest frame and drops the ones nobody got to in time.
+"""
+
+import threading
+import time
+import traceback
+from queue import Queue, Empty, Full
+
+from yolact_edge.utils.functions import MovingAverage
+
+# Passed down the pipeline once a source runs dry
+_end_of_stream = object()
+
+
+class Stage(threading.Thread):
+    """
+    Calls fn on every item from inbox and puts the result in outbox. A stage without an inbox is
+    a source: fn is called without arguments and returns None once there's nothing left.
+    If expand is True, fn returns a list of items that are passed on one by one.
+    """
+
+    def __init__(self, name, fn, inbox, outbox, stop_event, expand=False):
+        super().__init__(name=name, daemon=True)
+        self.fn = fn
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stop_event = stop_event
+        self.expand = expand
+
+        self.items = 0
+        self.busy_time = 0.0
+        self.blocked_time = 0.0
+        self.latency = MovingAverage(100)
+        self.occupancy = MovingAverage(100)
+        self.max_occupancy = 0
+        self.start_time = None
+        self.error = None
+
+    def run(self):
+        self.start_time = time.perf_counter()
+
+        try:
+            while not self.stop_event.is_set():
+                if self.inbox is None:
+                    start = time.perf_counter()
+                    result = self.fn()
+                    if result is None:
+                        break
+                else:
+                    occupancy = self.inbox.qsize()
+                    self.occupancy.add(occupancy)
+                    self.max_occupancy = max(self.max_occupancy, occupancy)
+
+                    item = self._get()
+                    if item is _end_of_stream:
+                        break
+                    start = time.perf_counter()
+                    result = self.fn(item)
+
+                elapsed = time.perf_counter() - start
+                self.busy_time += elapsed
+                self.latency.add(elapsed)
+                self.items += 1
+
+                for out in (result if self.expand else [result]):
+                    if not self._put(out):
+                        return
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+            self.stop_event.set()
+        finally:
+            self._put(_end_of_stream)
+
+    def _get(self):
+        while not self.stop_event.is_set():
+            try:
+                return self.inbox.get(timeout=0.05)
+            except Empty:
+                pass
+        return _end_of_stream
+
+    def _put(self, item):
+        """ Blocks until there's room in outbox. Returns False if the pipeline was stopped in the meantime. """
+        start = time.perf_counter()
+        try:
+            while True:
+                try:
+                    self.outbox.put(item, timeout=0.05)
+                    return True
+                except Full:
+                    if self.stop_event.is_set():
+                        return False
+        finally:
+            self.blocked_time += time.perf_counter() - start
+
+    def get_stats(self):
+        """
+        Returns a dict of counters for this stage:
+            - items:      How many items fn has processed.
+            - latency_ms: Average time fn took on the last 100 items.
+            - busy:       Fraction of the time spent in fn. The slowest stage is the one close to 1.
+            - blocked:    Fraction of the time spent waiting for room in the next queue (backpressure).
+            - queue:      Average number of items waiting in front of this stage, and its maximum.
+        """
+        elapsed = max(time.perf_counter() - self.start_time, 1e-9) if self.start_time is not None else 1e-9
+        return {
+            'items': self.items,
+            'latency_ms': 1000 * self.latency.get_avg(),
+            'busy': self.busy_time / elapsed,
+            'blocked': self.blocked_time / elapsed,
+            'queue': self.occupancy.get_avg(),
+            'queue_max': self.max_occupancy,
+        }
+
+
+class Pipeline:
+    """
+    A chain of stages, starting with a source. Use get() to take results off the end.
+
+    Example:
+        pipeline = Pipeline(queue_size=4)
+        pipeline.add_source('read', read_frame)
+        pipeline.add_stage('network', run_network)
+        pipeline.start()
+        result = pipeline.get()
+        while result is not None:
+            ...
+            result = pipeline.get()
+        pipeline.stop()
+    """
+
+    def __init__(self, queue_size=4):
+        self.queue_size = queue_size
+        self.stop_event = threading.Event()
+        self.stages = []
+        self.output = None
+
+    def add_source(self, name, fn):
+        assert len(self.stages) == 0, 'The source has to be the first stage'
+        self.output = Queue(maxsize=self.queue_size)
+        self.stages.append(Stage(name, fn, None, self.output, self.stop_event))
+
+    def add_stage(self, name, fn, expand=False):
+        assert len(self.stages) > 0, 'Add a source first'
+        inbox = self.output
+        self.output = Queue(maxsize=self.queue_size)
+        self.stages.append(Stage(name, fn, inbox, self.output, self.stop_event, expand=expand))
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def get(self, timeout=None):
+        """
+        Returns the next result of the last stage, or None at the end of the stream.
+        Raises queue.Empty if nothing came out within timeout seconds, and re-raises the
+        exception of a stage that failed.
+        """
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+
+        while True:
+            wait = 0.05 if deadline is None else max(min(0.05, deadline - time.perf_counter()), 0)
+            try:
+                item = self.output.get(timeout=wait)
+                break
+            except Empty:
+                # After a stop the end of the stream might never make it into the queue
+                if self.stop_event.is_set() and not any(stage.is_alive() for stage in self.stages):
+                    item = _end_of_stream
+                    break
+                if deadline is not None and time.perf_counter() >= deadline:
+                    raise
+
+        if item is _end_of_stream:
+            for stage in self.stages:
+                if stage.error is not None:
+                    raise stage.error
+            return None
+        return item
+
+    def buffered(self):
+        """ Number of results waiting to be taken with get(). """
+        return self.output.qsize()
+
+    def stop(self):
+        self.stop_event.set()
+        for stage in self.stages:
+            stage.join(timeout=1)
+
+    def get_stats(self):
+        return {stage.name: stage.get_stats() for stage in self.stages}
+
+    def format_stats(self):
+        lines = ['%-12s %8s %12s %7s %8s %7s %9s' % ('Stage', 'Items', 'Latency (ms)', 'Busy', 'Blocked', 'Queue', 'Queue max')]
+        for name, stats in self.get_stats().items():
+            lines.append('%-12s %8d %12.2f %6.1f%% %7.1f%% %7.2f %9d' % (
+                name, stats['items'], stats['latency_ms'], 100 * stats['busy'], 100 * stats['blocked'],
+                stats['queue'], stats['queue_max']))
+        return '\n'.join(lines)
+
+
+class FrameGrabber(threading.Thread):
+    """
+    Reads a cv2.VideoCapture as fast as it delivers and keeps only the newest frame, so a consumer
+    slower than the camera always gets the latest picture instead of working through a backlog.
+    Frames replaced before anyone took them are counted in dropped. Set fps to read a video file
+    at its frame rate as if it were a camera, rather than as fast as it decodes.
+    """
+
+    def __init__(self, capture, fps=None):
+        super().__init__(name='grab', daemon=True)
+        self.capture = capture
+        self.fps = fps
+        self.stop_event = threading.Event()
+        self.condition = threading.Condition()
+
+        self.latest = None  # (index, capture time, frame)
+        self.taken = -1     # Index of the last frame handed out
+        self.captured = 0
+        self.dropped = 0
+        self.finished = False
+
+    def run(self):
+        next_time = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                ok, frame = self.capture.read()
+                capture_time = time.perf_counter()
+                if not ok or frame is None:
+                    break
+
+                with self.condition:
+                    if self.latest is not None and self.latest[0] > self.taken:
+                        self.dropped += 1
+                    self.latest = (self.captured, capture_time, frame)
+                    self.captured += 1
+                    self.condition.notify_all()
+
+                if self.fps:
+                    next_time += 1 / self.fps
+                    time.sleep(max(next_time - time.perf_counter(), 0))
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify_all()
+
+    def _has_new(self):
+        return self.latest is not None and self.latest[0] > self.taken
+
+    def get(self, timeout=None):
+        """
+        Returns the newest frame not handed out yet as (index, capture time, frame), where index
+        counts every frame read and capture time is a time.perf_counter() value. Returns None at
+        the end of the stream and raises queue.Empty if no new frame came within timeout seconds.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.finished or self._has_new(), timeout):
+                raise Empty
+            if not self._has_new():
+                return None
+            self.taken = self.latest[0]
+            return self.latest
+
+    def stop(self):
+        self.stop_event.set()
+        self.join(timeout=1)
@@ -0,0 +1,98 @@
+"""
+An append-only, memory-mapped store of per-image numpy arrays, used by eval.py to keep the raw
+network outputs (what goes into Detect) and ground truth of a dataset around, so that NMS and
+postprocessing settings can be re-scored later without running the network again.
+
+The store is a directory: data.bin holds the bytes of every array back to back (each starting at
+a multiple of ALIGNMENT), and index.pkl the meta of the store and, for every image, its info and
+the dtype, shape and offset of each of its arrays. Reading memory-maps data.bin, so opening a
+store is instant and only the arrays actually used are read from disk.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+ALIGNMENT = 64
+
+
+class RawOutputCache(object):
+    """
+    Opens the store at path for reading (mode 'r') or creates it, replacing any store there,
+    for writing (mode 'w'). meta is a dict for anything that applies to the whole store.
+
+    While writing, the index is rewritten every index_interval images, so a store cut short
+    still opens with the images written up to then.
+    """
+
+    def __init__(self, path, mode='r', index_interval=100):
+        self.path = path
+        self.mode = mode
+        self.index_interval = index_interval
+
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+            self.data_file = open(os.path.join(path, 'data.bin'), 'wb')
+            self.offset = 0
+            self.meta = {}
+            self.records = []
+            # Replace the index of any store that was here, which doesn't go with the new data
+            self._write_index()
+        elif mode == 'r':
+            with open(os.path.join(path, 'index.pkl'), 'rb') as f:
+                index = pickle.load(f)
+            self.meta = index['meta']
+            self.records = index['records']
+
+            data_path = os.path.join(path, 'data.bin')
+            if os.path.getsize(data_path) > 0:
+                self.data = np.memmap(data_path, dtype=np.uint8, mode='r')
+            else:
+                self.data = np.zeros(0, dtype=np.uint8)
+        else:
+            raise ValueError('Unknown mode: %s' % mode)
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, info:dict, arrays:dict):
+        """ Appends an image: info is a dict of small values, arrays a dict of numpy arrays. """
+        fields = {}
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+
+            padding = -self.offset % ALIGNMENT
+            if padding > 0:
+                self.data_file.write(bytes(padding))
+                self.offset += padding
+
+            fields[name] = (self.offset, array.dtype.str, array.shape)
+            self.data_file.write(array.tobytes())
+            self.offset += array.nbytes
+
+        self.records.append({'info': info, 'fields': fields})
+        if len(self.records) % self.index_interval == 0:
+            self._write_index()
+
+    def __getitem__(self, idx):
+        """ Returns (info, arrays) of the idx-th image. The arrays are read-only views into the store. """
+        record = self.records[idx]
+        arrays = {}
+        for name, (offset, dtype, shape) in record['fields'].items():
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            arrays[name] = self.data[offset:offset + nbytes].view(dtype).reshape(shape)
+        return record['info'], arrays
+
+    def _write_index(self):
+        self.data_file.flush()
+        index_path = os.path.join(self.path, 'index.pkl')
+        with open(index_path + '.tmp', 'wb') as f:
+            pickle.dump({'meta': self.meta, 'records': self.records}, f)
+        os.replace(index_path + '.tmp', index_path)
+
+    def close(self):
+        if self.mode == 'w' and not self.data_file.closed:
+            self._write_index()
+            self.data_file.close()
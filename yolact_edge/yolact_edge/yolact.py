@@ -4,7 +4,7 @@ import torch.nn.functional as F
 from torchvision.models.resnet import Bottleneck, conv1x1, conv3x3
 import numpy as np
 from functools import partial
-from itertools import product, chain
+from itertools import chain
 from math import sqrt
 from typing import List, Tuple, Optional
 from torch import Tensor
@@ -16,7 +16,7 @@ from yolact_edge.layers.warp_utils import deform_op
 from yolact_edge.backbone import construct_backbone
 
 import torch.backends.cudnn as cudnn
-from yolact_edge.utils import timer
+from yolact_edge.utils import timer, arena
 from yolact_edge.utils.functions import MovingAverage
 
 import logging
@@ -112,6 +112,73 @@ def make_net(in_channels, conf, include_last_relu=True):
     return nn.Sequential(*(net)), in_channels
 
 
+# Priors only depend on the size of their level and the prior settings, so every module (and
+# every Yolact) in the process shares them. The concatenations Yolact.forward needs are kept too.
+_prior_cache = {}
+_concat_prior_cache = {}
+
+def make_priors(conv_h, conv_w, scales, aspect_ratios, device=None):
+    """
+    Returns the [conv_h*conv_w*num_priors, 4] priors of a conv_h x conv_w level as [x,y,width,height]
+    where (x,y) is the center of the box. The result is cached, so don't modify it in place.
+    """
+    key = (conv_h, conv_w, tuple(scales), tuple(tuple(ars) for ars in aspect_ratios), cfg.max_size,
+           cfg.backbone.preapply_sqrt, cfg.backbone.use_pixel_scales, cfg.backbone.use_square_anchors,
+           str(device) if device is not None else None)
+
+    if key not in _prior_cache:
+        # The box sizes are the same in every cell, only the centers change
+        sizes = []
+        for scale, ars in zip(scales, aspect_ratios):
+            for ar in ars:
+                if not cfg.backbone.preapply_sqrt:
+                    ar = sqrt(ar)
+
+                if cfg.backbone.use_pixel_scales:
+                    if type(cfg.max_size) == tuple:
+                        width, height = cfg.max_size
+                        w = scale * ar / width
+                        h = scale / ar / height
+                    else:
+                        w = scale * ar / cfg.max_size
+                        h = scale / ar / cfg.max_size
+                else:
+                    w = scale * ar / conv_w
+                    h = scale / ar / conv_h
+
+                # This is for backward compatability with a bug where I made everything square by accident
+                if cfg.backbone.use_square_anchors:
+                    h = w
+
+                sizes.append((w, h))
+
+        # Iteration order is important (it has to sync up with the convout): rows, columns, then sizes
+        # +0.5 because priors are in center-size notation
+        xs = (np.arange(conv_w, dtype=np.float64) + 0.5) / conv_w
+        ys = (np.arange(conv_h, dtype=np.float64) + 0.5) / conv_h
+        sizes = np.array(sizes, dtype=np.float64).reshape(-1, 2)
+
+        prior_data = np.empty((conv_h, conv_w, sizes.shape[0], 4), dtype=np.float64)
+        prior_data[..., 0] = xs[None, :, None]
+        prior_data[..., 1] = ys[:, None, None]
+        prior_data[..., 2:] = sizes[None, None, :, :]
+
+        priors = torch.Tensor(prior_data.astype(np.float32)).view(-1, 4)
+        _prior_cache[key] = priors.to(device) if device is not None else priors
+
+    return _prior_cache[key]
+
+def concat_priors(level_priors):
+    """ Concatenates the (cached) priors of every level, caching the result as well. """
+    # The cache keeps the levels alive, so their ids can't be reused by other tensors
+    key = tuple(id(priors) for priors in level_priors)
+
+    if key not in _concat_prior_cache:
+        _concat_prior_cache[key] = (tuple(level_priors), torch.cat(level_priors, -2))
+
+    return _concat_prior_cache[key][1]
+
+
 class PredictionModule(nn.Module):
     """
     The (c) prediction module adapted from DSSD:
@@ -255,7 +322,7 @@ class PredictionModule(nn.Module):
                     gate = src.gate_layer(x).permute(0, 2, 3, 1).contiguous().view(x.size(0), -1, self.mask_dim)
                     mask = mask * torch.sigmoid(gate)
         
-        priors = self.make_priors(conv_h, conv_w)
+        priors = self.make_priors(conv_h, conv_w, device=x.device)
 
         preds = { 'loc': bbox, 'conf': conf, 'mask': mask, 'priors': priors }
 
@@ -264,44 +331,12 @@ class PredictionModule(nn.Module):
         
         return preds
     
-    def make_priors(self, conv_h, conv_w):
+    def make_priors(self, conv_h, conv_w, device=None):
         """ Note that priors are [x,y,width,height] where (x,y) is the center of the box. """
         
         with timer.env('makepriors'):
-            if self.last_conv_size != (conv_w, conv_h):
-                prior_data = []
-
-                # Iteration order is important (it has to sync up with the convout)
-                for j, i in product(range(conv_h), range(conv_w)):
-                    # +0.5 because priors are in center-size notation
-                    x = (i + 0.5) / conv_w
-                    y = (j + 0.5) / conv_h
-                    
-                    for scale, ars in zip(self.scales, self.aspect_ratios):
-                        for ar in ars:
-                            if not cfg.backbone.preapply_sqrt:
-                                ar = sqrt(ar)
-
-                            if cfg.backbone.use_pixel_scales:
-                                if type(cfg.max_size) == tuple:
-                                    width, height = cfg.max_size
-                                    w = scale * ar / width
-                                    h = scale / ar / height
-                                else:
-                                    w = scale * ar / cfg.max_size
-                                    h = scale / ar / cfg.max_size
-                            else:
-                                w = scale * ar / conv_w
-                                h = scale / ar / conv_h
-                            
-                            # This is for backward compatability with a bug where I made everything square by accident
-                            if cfg.backbone.use_square_anchors:
-                                h = w
-
-                            prior_data += [x, y, w, h]
-                
-                self.priors = torch.Tensor(prior_data).view(-1, 4)
-                self.last_conv_size = (conv_w, conv_h)
+            self.priors = make_priors(conv_h, conv_w, self.scales, self.aspect_ratios, device)
+            self.last_conv_size = (conv_w, conv_h)
         
         return self.priors
 
@@ -579,7 +614,7 @@ class PredictionModuleTRTWrapper(nn.Module):
         conv_w = x.size(3)
         
         bbox, conf, mask = self.pred_layer(x)
-        priors = self.pred_layer_torch.make_priors(conv_h, conv_w)
+        priors = self.pred_layer_torch.make_priors(conv_h, conv_w, device=x.device)
         
         preds = { 'loc': bbox, 'conf': conf, 'mask': mask, 'priors': priors }
         
@@ -1268,6 +1303,27 @@ class Yolact(nn.Module):
             if cfg.torch2trt_flow_net or cfg.torch2trt_flow_net_int8:
                 self.create_embed_flow_net()
 
+    def use_shared_weights(self, state_dict):
+        """
+        Points every parameter and buffer at the tensor with the same name in state_dict instead
+        of copying it. If those tensors are in shared memory (see Tensor.share_memory_), every
+        process given the same state_dict runs off a single copy of the weights.
+
+        state_dict should be the state_dict() of a Yolact built with the same config after
+        load_weights, so it already includes the partial backbone.
+        """
+        if not self.training:
+            self.create_partial_backbone()
+
+        own_state_dict = self.state_dict(keep_vars=True)
+        missing = [key for key in own_state_dict if key not in state_dict]
+        if len(missing) > 0:
+            raise KeyError("Shared weights are missing: {}".format(", ".join(missing)))
+
+        with torch.no_grad():
+            for key, tensor in own_state_dict.items():
+                tensor.set_(state_dict[key])
+
     def init_weights(self, backbone_path):
         """ Initialize weights for training. """
         # Initialize the backbone with the pretrained weights.
@@ -1771,7 +1827,10 @@ class Yolact(nn.Module):
                     pred_outs[k].append(v)
 
         for k, v in pred_outs.items():
-            pred_outs[k] = torch.cat(v, -2)
+            if k == 'priors':
+                pred_outs[k] = concat_priors(v)
+            else:
+                pred_outs[k] = arena.cat('pred_outs.' + k, v, -2)
 
         if proto_out is not None:
             pred_outs['proto'] = proto_out
@@ -1797,7 +1856,11 @@ class Yolact(nn.Module):
             else:
                 pred_outs['conf'] = F.softmax(pred_outs['conf'], -1)
 
-            outs_wrapper["pred_outs"] = self.detect(pred_outs)
+            # raw_outputs skips Detect so the activated head outputs can be used (or Detect run) elsewhere
+            if extras is not None and extras.get("raw_outputs", False):
+                outs_wrapper["pred_outs"] = pred_outs
+            else:
+                outs_wrapper["pred_outs"] = self.detect(pred_outs)
         return outs_wrapper
 
 